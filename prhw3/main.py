@@ -3,7 +3,7 @@ from utils import parse as parser
 from utils import pcr as pcr 
 from utils import icp as icp
 from utils import write_out as writer
-from utils.kdtree import KDTreeTriangles as kdtree
+from utils.kdtree import KDTreeTriangles as kdtree, load_or_build_index
 import time 
 
 data_sets = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'J']
@@ -17,6 +17,9 @@ triangles = np.array(vertices_inds[:, :3], dtype=int) # Only i1,i2,i3 needed
 vertices  = np.array(vertices_ct, dtype=float)
 
 start = time.perf_counter()
+# the mesh is the same for every dataset, so its index is built once and saved
+# under ./cache keyed by the mesh file contents, later runs just load it
+mesh_tree = load_or_build_index("data/Problem3Mesh.sur", vertices, triangles, "./cache", index_cls=kdtree)
 for letter in data_sets:
     print(f"----------Processing dataset {letter}----------")
 
@@ -29,8 +32,6 @@ for letter in data_sets:
     body_A_markers_tr = np.array(body_A_markers_tr)
     body_B_markers_tr = np.array(body_B_markers_tr)
 
-    mesh_tree = kdtree(vertices, triangles)
-
     # Compute F_A,k and F_B,k for each sample frame using PCR
     F_A = []
     F_B = []
@@ -63,16 +64,7 @@ for letter in data_sets:
     s = np.array(s)
 
     # Find closest points on mesh and compute errors
-    closest_points = []
-    errors = []
-    tri_idxs = []
-    for k in d:
-        c_k, e_k, idx = mesh_tree.closest_point(k)
-        closest_points.append(c_k)
-        errors.append(e_k)
-        tri_idxs.append(idx)
-    closest_points = np.asarray(closest_points)
-    errors = np.asarray(errors)
+    closest_points, errors, tri_idxs = mesh_tree.closest_points(d)
 
     # Write out 
     output_path = f"./out/PA3-{letter}-{prefix}-Output.txt"
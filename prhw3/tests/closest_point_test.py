@@ -4,7 +4,7 @@ import numpy as np
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
-from utils.icp import find_closest_point, project_on_segment
+from utils.icp import find_closest_point, find_closest_points, project_on_segment
 
 
 def assert_close(x, y, msg):
@@ -80,5 +80,68 @@ def run_tests():
     print("All tests PASS")
 
 
+def reference_closest_point(a, p, q, r):
+    # face projection if it lands inside the triangle, otherwise the best edge projection
+    n = np.cross(q - p, r - p)
+    c = a - np.dot(a - p, n) / np.dot(n, n) * n
+    inside = [np.dot(np.cross(v1 - v0, c - v0), n) >= 0 for v0, v1 in [(p, q), (q, r), (r, p)]]
+    if all(inside):
+        return c
+    edges = [project_on_segment(a, p, q), project_on_segment(a, q, r), project_on_segment(a, r, p)]
+    return min(edges, key=lambda e: np.linalg.norm(a - e))
+
+
+def test_vectorized_closest_points():
+    # random point/triangle pairs, includes plenty of obtuse triangles
+    rand = np.random.default_rng(7)
+    tris = rand.random((500, 3, 3)) * 4.0
+    a = rand.random((500, 3)) * 6.0 - 1.0
+
+    c = find_closest_points(a, tris)
+    for i in range(len(a)):
+        expected = reference_closest_point(a[i], tris[i, 0], tris[i, 1], tris[i, 2])
+        assert_close(c[i], expected, "FAIL")
+
+    # one shared query point against many triangles
+    c = find_closest_points(a[0], tris)
+    for i in range(len(tris)):
+        expected = reference_closest_point(a[0], tris[i, 0], tris[i, 1], tris[i, 2])
+        assert_close(c[i], expected, "FAIL")
+
+    print("Vectorized tests PASS")
+
+
+def reference_closest_point_degenerate(a, p, q, r):
+    # a triangle with collinear or repeated vertices is the union of its edges,
+    # a zero length edge is just its end point
+    edges = [project_on_segment(a, v0, v1) if np.any(v0 != v1) else v0 for v0, v1 in [(p, q), (q, r), (r, p)]]
+    return min(edges, key=lambda e: np.linalg.norm(a - e))
+
+
+def test_degenerate_closest_points():
+    # repeated vertices, collinear vertices and a single point, mixed with proper
+    # triangles so the kernel has to split the batch
+    rand = np.random.default_rng(8)
+    tris = rand.random((400, 3, 3)) * 4.0
+    tris[0::4, 1] = tris[0::4, 0] # p = q
+    tris[1::4, 2] = tris[1::4, 1] # q = r
+    tris[2::8, 2] = 0.3 * tris[2::8, 0] + 0.7 * tris[2::8, 1] # r on pq
+    tris[6::8] = tris[6::8, :1] # all three the same
+    a = rand.random((400, 3)) * 6.0 - 1.0
+
+    c = find_closest_points(a, tris)
+    assert np.all(np.isfinite(c))
+    for i in range(len(a)):
+        if i % 4 == 3:
+            expected = reference_closest_point(a[i], tris[i, 0], tris[i, 1], tris[i, 2])
+        else:
+            expected = reference_closest_point_degenerate(a[i], tris[i, 0], tris[i, 1], tris[i, 2])
+        assert_close(c[i], expected, "FAIL")
+
+    print("Degenerate tests PASS")
+
+
 if __name__ == "__main__":
     run_tests()
+    test_vectorized_closest_points()
+    test_degenerate_closest_points()
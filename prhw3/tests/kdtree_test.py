@@ -1,9 +1,11 @@
 import sys
 import os
+import tempfile
 import numpy as np
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from utils.kdtree import KDTreeTriangles
+from utils.kdtree import KDTreeTriangles, load_or_build_index
+from utils.icp import find_closest_points, linear_search_closest_points_on_mesh
 
 
 def test_triangle_kdtree():
@@ -43,5 +45,80 @@ def test_triangle_kdtree():
 
     print("kdtree tests passed")
 
+def test_kdtree_matches_linear_search():
+    # random triangle soup, every query should agree with brute force
+    rand = np.random.default_rng(3)
+    vertices = rand.random((60, 3)) * 10.0
+    triangles = np.array([rand.choice(len(vertices), 3, replace=False) for _ in range(40)])
+    queries = rand.random((25, 3)) * 14.0 - 2.0
+
+    for leaf_size in [1, 4, 16]:
+        tree = KDTreeTriangles(vertices, triangles, leaf_size=leaf_size)
+        leaves = tree.left < 0
+        assert tree.count[leaves].max() <= leaf_size
+        assert tree.count[leaves].sum() == len(triangles)
+
+        for p in queries:
+            _, dist, _ = tree.closest_point(p)
+            _, expected, _ = linear_search_closest_points_on_mesh(p, vertices, triangles)
+            assert np.isclose(dist, expected), f"Expected {expected}, got {dist}"
+
+        # batched queries must agree with the one-at-a-time search
+        closest, dists, tri_idxs = tree.closest_points(queries, batch_size=7)
+        for k, p in enumerate(queries):
+            expected_point, expected_dist, _ = tree.closest_point(p)
+            assert np.allclose(closest[k], expected_point), f"Expected {expected_point}, got {closest[k]}"
+            assert np.isclose(dists[k], expected_dist), f"Expected {expected_dist}, got {dists[k]}"
+            q = find_closest_points(p, vertices[triangles[tri_idxs[k:k + 1]]])
+            assert np.isclose(np.linalg.norm(p - q[0]), dists[k])
+
+    print("kdtree linear search tests passed")
+
+def test_kdtree_save_load():
+    # a reloaded tree must answer queries exactly like the one that was saved
+    rand = np.random.default_rng(5)
+    vertices = rand.random((50, 3)) * 10.0
+    triangles = np.array([rand.choice(len(vertices), 3, replace=False) for _ in range(30)])
+    queries = rand.random((20, 3)) * 12.0 - 1.0
+    tree = KDTreeTriangles(vertices, triangles, leaf_size=4)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "tree.npz")
+        tree.save(path, mesh_hash="abc")
+        loaded = KDTreeTriangles.load(path, mesh_hash="abc")
+        for a, b in zip(tree.closest_points(queries), loaded.closest_points(queries)):
+            assert np.array_equal(a, b)
+
+        # index built for another mesh is refused
+        try:
+            KDTreeTriangles.load(path, mesh_hash="def")
+            assert False, "Expected a ValueError for a mismatched mesh hash"
+        except ValueError:
+            pass
+
+        # the cache helper builds once and reloads afterwards
+        mesh_path = os.path.join(tmp, "mesh.sur")
+        with open(mesh_path, "w") as f:
+            f.write("mesh")
+        first = load_or_build_index(mesh_path, vertices, triangles, tmp, leaf_size=4)
+        second = load_or_build_index(mesh_path, vertices, triangles, tmp, leaf_size=4)
+        assert np.array_equal(first.bbox, second.bbox)
+        assert len([f for f in os.listdir(tmp) if f.startswith("mesh-")]) == 1
+
+        # a half written file (run killed while saving) is rebuilt, not fatal
+        cached = os.path.join(tmp, [f for f in os.listdir(tmp) if f.startswith("mesh-")][0])
+        with open(cached, "rb") as f:
+            head = f.read(200)
+        with open(cached, "wb") as f:
+            f.write(head)
+        third = load_or_build_index(mesh_path, vertices, triangles, tmp, leaf_size=4)
+        assert np.array_equal(first.bbox, third.bbox)
+        assert np.array_equal(KDTreeTriangles.load(cached).bbox, first.bbox)
+        assert [f for f in os.listdir(tmp) if f.startswith("mesh-")] == [os.path.basename(cached)]
+
+    print("kdtree save/load tests passed")
+
 if __name__ == "__main__":
     test_triangle_kdtree()
+    test_kdtree_matches_linear_search()
+    test_kdtree_save_load()
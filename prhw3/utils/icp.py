@@ -39,23 +39,157 @@ def find_closest_point(a, p, q, r):
     return project_on_segment(c, q, r)
 
 
-# For reference only
-def linear_search_closest_points_on_mesh(p, vertices, triangles):
-    min_dist = np.inf
-    q_closest = None
-    tri_index = -1
+# Column layout of the packed rows returned by triangle_geometry. Keeping all
+# of a triangle's terms in one row means a query gathers them with one index
+GEOM_COLUMNS = {"p": slice(0, 3), "qp": slice(3, 6), "rp": slice(6, 9),
+                "normal": slice(9, 12), "edge_len2": slice(12, 15),
+                "d00": 15, "d01": 16, "d11": 17, "inv_det": 18}
+GEOM_WIDTH = 19
+
+def triangle_geometry(tris):
+
+    # Everything the closest point kernel needs that only depends on the
+    # triangle, tris is (M,3,3) with rows p, q, r. Returns an (M, GEOM_WIDTH)
+    # array, meant to be computed once per mesh and indexed per query instead
+    # of being rebuilt on every call
+    tris = np.asarray(tris, dtype=float)
+    p, q, r = tris[:, 0], tris[:, 1], tris[:, 2]
+
+    # Edge vectors
+    qp = q - p
+    rp = r - p
+
+    # Normal-equation terms of the barycentric solve (slide 11)
+    d00 = np.sum(qp * qp, axis=1)
+    d01 = np.sum(qp * rp, axis=1)
+    d11 = np.sum(rp * rp, axis=1)
+    det = d00 * d11 - d01 * d01
+    inv_det = np.divide(1.0, det, out=np.zeros_like(det), where=det != 0) # 0 for degenerate triangles
+
+    normal = np.cross(qp, rp)
+    norm = np.linalg.norm(normal, axis=1, keepdims=True)
+    normal = np.divide(normal, norm, out=np.zeros_like(normal), where=norm != 0)
+
+    # Squared edge lengths of pq, pr and qr
+    edge_len2 = np.column_stack((d00, d11, d00 - 2 * d01 + d11))
+
+    geom = np.empty((len(tris), GEOM_WIDTH))
+    for key, value in (("p", p), ("qp", qp), ("rp", rp), ("normal", normal), ("edge_len2", edge_len2),
+                       ("d00", d00), ("d01", d01), ("d11", d11), ("inv_det", inv_det)):
+        geom[:, GEOM_COLUMNS[key]] = value
+    return geom
+
+def closest_points_from_geometry(a, geom):
+
+    # Vectorized closed-form closest point, a is (M,3) (or a single (3,) point
+    # shared by every triangle) and geom holds the triangle_geometry rows of
+    # the M triangles. Instead of solving the least-squares problem, the
+    # Voronoi region of the triangle that a falls in is found from a handful
+    # of dot products and a is projected onto the matching vertex, edge or face
+    cols = GEOM_COLUMNS
+    p, qp, rp = geom[:, cols["p"]], geom[:, cols["qp"]], geom[:, cols["rp"]]
+    d00, d01, d11 = geom[:, cols["d00"]], geom[:, cols["d01"]], geom[:, cols["d11"]]
+    edge_len2, inv_det = geom[:, cols["edge_len2"]], geom[:, cols["inv_det"]]
+    a = np.broadcast_to(np.asarray(a, dtype=float), p.shape)
+    ap = a - p
+
+    # Only two dot products depend on the query, the four others follow
+    # from the precomputed ones (e.g. qp . (a - q) = qp . (a - p) - qp . qp)
+    d1 = np.sum(qp * ap, axis=1)
+    d2 = np.sum(rp * ap, axis=1)
+    d3 = d1 - d00
+    d4 = d2 - d01
+    d5 = d1 - d01
+    d6 = d2 - d11
+
+    # Signed areas that decide the edge regions, the sum is |qp x rp|^2
+    va = d3 * d6 - d5 * d4
+    vb = d5 * d2 - d1 * d6
+    vc = d1 * d4 - d3 * d2
+
+    closest = np.empty_like(ap)
+    # Rows whose region is not decided yet. Degenerate triangles (collinear or
+    # repeated vertices, inv_det = 0) have no regions, they are done at the end
+    flat = inv_det == 0
+    left = ~flat
 
-    # Simple linear search over all triangles
-    for i, tri in enumerate(triangles): 
-        q = find_closest_point(p, vertices[tri[0]], vertices[tri[1]], vertices[tri[2]])
-        dist = np.linalg.norm(p - q)
-        if dist < min_dist:
-            min_dist = dist
-            q_closest = q
-            tri_index = i
+    # Vertex p region
+    m = left & (d1 <= 0) & (d2 <= 0)
+    closest[m] = p[m]
+    left &= ~m
 
-    return q_closest, min_dist, tri_index
+    # Vertex q region
+    m = left & (d3 >= 0) & (d4 <= d3)
+    closest[m] = p[m] + qp[m]
+    left &= ~m
 
+    # Edge pq region
+    m = left & (vc <= 0) & (d1 >= 0) & (d3 <= 0)
+    t = d1[m] / edge_len2[m, 0]
+    closest[m] = p[m] + t[:, None] * qp[m]
+    left &= ~m
+
+    # Vertex r region
+    m = left & (d6 >= 0) & (d5 <= d6)
+    closest[m] = p[m] + rp[m]
+    left &= ~m
+
+    # Edge pr region
+    m = left & (vb <= 0) & (d2 >= 0) & (d6 <= 0)
+    t = d2[m] / edge_len2[m, 1]
+    closest[m] = p[m] + t[:, None] * rp[m]
+    left &= ~m
+
+    # Edge qr region
+    m = left & (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0)
+    t = (d4[m] - d3[m]) / edge_len2[m, 2]
+    closest[m] = p[m] + qp[m] + t[:, None] * (rp[m] - qp[m])
+    left &= ~m
+
+    # Interior, barycentric coords come straight from the signed areas
+    lam = vb[left] * inv_det[left]
+    mu = vc[left] * inv_det[left]
+    closest[left] = p[left] + lam[:, None] * qp[left] + mu[:, None] * rp[left]
+
+    # A degenerate triangle is the union of its edges, take the nearest of them
+    if np.any(flat):
+        a_f, p_f, qp_f, rp_f = a[flat], p[flat], qp[flat], rp[flat]
+        best = None
+        for start, edge in ((p_f, qp_f), (p_f, rp_f), (p_f + qp_f, rp_f - qp_f)):
+            c = closest_points_on_segments(a_f, start, edge)
+            dist2 = np.sum((c - a_f) ** 2, axis=1)
+            if best is None:
+                best, best_dist2 = c, dist2
+            else:
+                nearer = dist2 < best_dist2
+                best[nearer], best_dist2[nearer] = c[nearer], dist2[nearer]
+        closest[flat] = best
+    return closest
+
+def closest_points_on_segments(a, start, edge):
+
+    # Vectorized project_on_segment onto the segments start + t * edge, t in [0, 1],
+    # zero length segments are single points
+    len2 = np.sum(edge * edge, axis=1)
+    t = np.divide(np.sum((a - start) * edge, axis=1), len2, out=np.zeros_like(len2), where=len2 > 0)
+    return start + np.clip(t, 0.0, 1.0)[:, None] * edge
+
+def find_closest_points(a, tris):
+
+    # Vectorized find_closest_point, a is (M,3) (or a single (3,) point
+    # shared by every triangle) and tris is (M,3,3) with rows p, q, r
+    return closest_points_from_geometry(a, triangle_geometry(tris))
+
+
+def linear_search_closest_points_on_mesh(p, vertices, triangles):
+    # Simple linear search over all triangles, tested together
+    q = find_closest_points(p, vertices[triangles])
+    dists = np.linalg.norm(q - p, axis=1)
+    tri_index = np.argmin(dists)
+
+    return q[tri_index], dists[tri_index], tri_index
+
+# For reference only
 def ktree_search_closest_points_on_mesh(p, vertices, triangles, tree, centroids, k=10):
     # Query k nearest triangle centroids to point p
     dists, idxs = tree.query(p, k=k)  # can return single or array of indices
@@ -63,20 +197,12 @@ def ktree_search_closest_points_on_mesh(p, vertices, triangles, tree, centroids,
         idxs = [idxs]
 
     # Search only these triangles
-    min_dist = np.inf
-    q_closest = None
-    tri_index = -1
-
-    for i in idxs:
-        tri = triangles[i]
-        q = find_closest_point(p, vertices[tri[0]], vertices[tri[1]], vertices[tri[2]])
-        dist = np.linalg.norm(p - q)
-        if dist < min_dist:
-            min_dist = dist
-            q_closest = q
-            tri_index = i
-
-    return q_closest, min_dist, tri_index
+    idxs = np.asarray(idxs)
+    q = find_closest_points(p, vertices[triangles[idxs]])
+    dists = np.linalg.norm(q - p, axis=1)
+    best = np.argmin(dists)
+
+    return q[best], dists[best], idxs[best]
     
 
 def test_closest_point_on_triangle():
@@ -1,6 +1,15 @@
+import hashlib
+import os
+import zipfile
 import numpy as np
 from utils import icp as icp
 
+# bumped whenever the saved array layout changes, older index files are rebuilt
+INDEX_VERSION = 1
+# every array needed to answer queries without rebuilding the tree
+INDEX_ARRAYS = ("vertices", "triangles", "tri_bbox_min", "tri_bbox_max", "centroids", "tri_geom",
+                "left", "right", "axis", "split", "start", "count", "bbox", "tri_order")
+
 def point_bbox_distance(p, bbox_min, bbox_max):
     # helper function to find distance from query point to a given bounding box
     # if distance to bounding box is negative, the point is inside bounding box
@@ -8,92 +17,275 @@ def point_bbox_distance(p, bbox_min, bbox_max):
     d = np.maximum(0.0, np.maximum(bbox_min - p, p - bbox_max))
     return np.linalg.norm(d)
 
-class KDTreeNode:
-    def __init__(self, tri_idx, point=None, left=None, right=None, axis=0, bbox_min=None, bbox_max=None):
-        self.tri_idx = tri_idx # index of the triangle stored at this node
-        self.point = point # centroid of the triangle
-        self.left = left # node that is on the left of the current node
-        self.right = right # node that is on the right side of the current node
-        self.axis = axis # the axis in which the current node's children are split by
-        # we can define a triangle's bounding box with the two opposing corners of the triangle
-        self.bbox_min = bbox_min
-        self.bbox_max = bbox_max
-
 class KDTreeTriangles:
-    def __init__(self, vertices, triangles):
+    def __init__(self, vertices, triangles, leaf_size=16):
         # vertices and their indices will initially correspond
         self.vertices = vertices # [N_vertices,3] (x,y,z) coordinates of each vertex in the triangle mesh
         self.triangles = triangles # [N_triangles,3] indices of each vertex grouped by triangle
+        self.leaf_size = leaf_size # max number of triangles stored in a leaf
+        tri_verts = vertices[triangles]
         # find bounding boxes for each triangle
-        self.tri_bbox_min = np.min(vertices[triangles], axis=1) # component-wise min. vertex of each triangle
-        self.tri_bbox_max = np.max(vertices[triangles], axis=1) # component-wise max vertex of each triangle
-        self.centroids = np.mean(vertices[triangles], axis=1) # array of centroids for each triangle
-        self.root = self.build_kdtree(np.arange(len(triangles)))
-
-    def build_kdtree(self, tri_indices, depth=0):
-        if len(tri_indices) == 0:
-            return None
+        self.tri_bbox_min = np.min(tri_verts, axis=1) # component-wise min. vertex of each triangle
+        self.tri_bbox_max = np.max(tri_verts, axis=1) # component-wise max vertex of each triangle
+        self.centroids = np.mean(tri_verts, axis=1) # array of centroids for each triangle
+        # edge vectors, dot products, normals and edge lengths of every triangle,
+        # computed once here so queries only gather them
+        self.tri_geom = icp.triangle_geometry(tri_verts)
+
+        # the tree is stored as a struct of arrays instead of a graph of node objects,
+        # every node is just an index into these arrays. a binary tree with at most
+        # one leaf per triangle never needs more than 2n - 1 nodes, the arrays get
+        # trimmed down to the real node count once the tree is built
+        max_nodes = max(1, 2 * len(triangles) - 1)
+        self.left = np.full(max_nodes, -1, dtype=np.int64) # index of the left child, -1 for leaves
+        self.right = np.full(max_nodes, -1, dtype=np.int64) # index of the right child, -1 for leaves
+        self.axis = np.zeros(max_nodes, dtype=np.int8) # the axis in which the node's children are split by
+        self.split = np.zeros(max_nodes) # median centroid coordinate along the node's axis
+        self.start = np.zeros(max_nodes, dtype=np.int64) # leaves own tri_order[start:start + count]
+        self.count = np.zeros(max_nodes, dtype=np.int64)
+        self.bbox = np.zeros((max_nodes, 2, 3)) # [:,0] is the bbox min corner, [:,1] is the bbox max corner
+        # triangle indices reordered so that every leaf's triangles are contiguous
+        self.tri_order = np.arange(len(triangles))
+        self.n_nodes = 0
+        self.root = self.build_kdtree(0, len(triangles))
+        self._trim_nodes()
+
+    def _trim_nodes(self):
+        n = self.n_nodes
+        self.left, self.right = self.left[:n], self.right[:n]
+        self.axis, self.split = self.axis[:n], self.split[:n]
+        self.start, self.count = self.start[:n], self.count[:n]
+        self.bbox = self.bbox[:n]
+
+    def to_arrays(self):
+        # the built tree as a dict of plain arrays
+        return {name: getattr(self, name) for name in INDEX_ARRAYS}
+
+    @classmethod
+    def from_arrays(cls, arrays, leaf_size, root=0):
+        # rebuilds a tree object around arrays produced by to_arrays, no tree building is done
+        tree = cls.__new__(cls)
+        for name in INDEX_ARRAYS:
+            setattr(tree, name, arrays[name])
+        tree.leaf_size = int(leaf_size)
+        tree.root = int(root)
+        tree.n_nodes = len(tree.left)
+        return tree
+
+    def save(self, path, mesh_hash=""):
+        # writes the tree to an uncompressed .npz (path or open file), mesh_hash identifies the
+        # mesh it was built from
+        np.savez(path, version=INDEX_VERSION, kind=type(self).__name__, mesh_hash=mesh_hash,
+                 leaf_size=self.leaf_size, root=self.root, **self.to_arrays())
+
+    @classmethod
+    def load(cls, path, mesh_hash=None):
+        # reads a tree written by save. raises ValueError if the file was written by a
+        # different index version or class, or for a different mesh than mesh_hash
+        with np.load(path, allow_pickle=False) as data:
+            if int(data["version"]) != INDEX_VERSION:
+                raise ValueError(f"{path} has index version {int(data['version'])}, expected {INDEX_VERSION}")
+            if str(data["kind"]) != cls.__name__:
+                raise ValueError(f"{path} holds a {data['kind']}, expected {cls.__name__}")
+            if mesh_hash is not None and str(data["mesh_hash"]) != mesh_hash:
+                raise ValueError(f"{path} was built for a different mesh")
+            arrays = {name: data[name] for name in INDEX_ARRAYS}
+            return cls.from_arrays(arrays, data["leaf_size"], data["root"])
+
+    def build_kdtree(self, lo, hi, depth=0):
+        # builds the subtree over the triangles tri_order[lo:hi] and returns its root node
+        if hi <= lo:
+            return -1
         axis = depth % 3
+        tri_indices = self.tri_order[lo:hi]
 
-        # find the indices that would sort the triangles by the 
-        # location of their centroids along the given axis
-        sorted_idx = np.argsort(self.centroids[tri_indices, axis])
-        tri_indices = tri_indices[sorted_idx] # tri_indices is now in sorted order
-         # find the median triangle along the given axis and its centroid
-        median_idx = len(tri_indices) // 2
-        median_tri = tri_indices[median_idx]
-        centroid = self.centroids[median_tri]
+        # claim the next free slot in the node arrays
+        node = self.n_nodes
+        self.n_nodes += 1
+        self.axis[node] = axis
+        self.start[node] = lo
+        self.count[node] = hi - lo
 
-        # find the bounding box for this node (will cover itself and all of its children)
+        # find the bounding box for this node (will cover all of its children)
         # Note: the root node's bounding box will encompass the entire mesh.
-        bbox_min = np.min(self.tri_bbox_min[tri_indices], axis=0)
-        bbox_max = np.max(self.tri_bbox_max[tri_indices], axis=0)
+        self.bbox[node, 0] = np.min(self.tri_bbox_min[tri_indices], axis=0)
+        self.bbox[node, 1] = np.max(self.tri_bbox_max[tri_indices], axis=0)
 
-        # make the leaf
-        if len(tri_indices) == 1:
-            return KDTreeNode(list(tri_indices), centroid, None, None, axis, bbox_min, bbox_max)
+        # make the leaf, its triangles get tested together at query time
+        if hi - lo <= self.leaf_size:
+            return node
+
+        # find the indices that would sort the triangles by the
+        # location of their centroids along the given axis
+        sorted_idx = np.argsort(self.centroids[tri_indices, axis])
+        self.tri_order[lo:hi] = tri_indices[sorted_idx] # tri_order[lo:hi] is now in sorted order
+        # find the median triangle along the given axis
+        mid = lo + (hi - lo) // 2
+        self.split[node] = self.centroids[self.tri_order[mid], axis]
 
         # recursively build the tree by splitting the triangles along the median
         # choose axis to split along by round robin. found experimentally to
         # work well enough for the given data, likely because the points on
         # the meshes are evenly distributed w.r.t each axis
-        left = self.build_kdtree(tri_indices[:median_idx], depth + 1)
-        right = self.build_kdtree(tri_indices[median_idx + 1:], depth + 1)
-        # the current node should store the median triangle
-        return KDTreeNode([median_tri], centroid, left, right, axis, bbox_min, bbox_max)
-    
+        self.left[node] = self.build_kdtree(lo, mid, depth + 1)
+        self.right[node] = self.build_kdtree(mid, hi, depth + 1)
+        return node
+
+    def triangle_geometry(self, tris):
+        # precomputed kernel terms for the given triangle indices
+        return self.tri_geom[tris]
+
     def closest_point(self, p):
-        best = None
+        best_dist = np.inf
+        best_point = None
+        best_tri = -1
         stack = [self.root] # DFS
 
         while stack:
             node = stack.pop()
-            if node is None:
-                continue
 
             # skip if node's bounding box is farther than current best
-            # not applicable on the first pass
-            if best is not None:
-                box_dist = point_bbox_distance(p, node.bbox_min, node.bbox_max)
-                if box_dist >= best[0]:
-                    continue
-
-            # check distance to triangle stored in this node
-            v0, v1, v2 = self.vertices[self.triangles[node.tri_idx[0]]]
-            q = icp.find_closest_point(p, v0, v1, v2)
-            dist = np.linalg.norm(p - q)
-            if best is None or dist < best[0]:
-                best = (dist, q, [node.tri_idx[0]])
+            box_dist = point_bbox_distance(p, self.bbox[node, 0], self.bbox[node, 1])
+            if box_dist >= best_dist:
+                continue
+
+            # leaf: test all of its triangles at once
+            if self.left[node] < 0:
+                tris = self.tri_order[self.start[node]:self.start[node] + self.count[node]]
+                qs = icp.closest_points_from_geometry(p, self.triangle_geometry(tris))
+                dists = np.linalg.norm(qs - p, axis=1)
+                i = np.argmin(dists)
+                if dists[i] < best_dist:
+                    best_dist, best_point, best_tri = dists[i], qs[i], tris[i]
+                continue
 
             # decide which subtree to visit first, want to visit nearest one first
-            axis = node.axis
-            diff = p[axis] - node.point[axis] # want to find which half (left or right) is closer to the query point
-            near, far = (node.left, node.right) if diff < 0 else (node.right, node.left)
+            diff = p[self.axis[node]] - self.split[node] # want to find which half (left or right) is closer to the query point
+            if diff < 0:
+                near, far = self.left[node], self.right[node]
+            else:
+                near, far = self.right[node], self.left[node]
 
             # push the closer node last so we hit it first (DFS)
             stack.append(far)
             stack.append(near)
 
-        dist, closest_point, tri_idx = best
-        return closest_point, dist, tri_idx[0]
+        return best_point, best_dist, best_tri
+
+    def closest_points(self, points, batch_size=2048):
+        # batched version of closest_point. points is (N,3), returns the (N,3) closest
+        # points, (N,) distances and (N,) triangle indices. queries are handled
+        # batch_size at a time to keep the size of the traversal frontier bounded
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        n = len(points)
+        closest = np.zeros((n, 3))
+        best_tri = np.full(n, -1, dtype=np.int64)
+        for lo in range(0, n, batch_size):
+            hi = min(n, lo + batch_size)
+            closest[lo:hi], best_tri[lo:hi] = self._closest_points_batch(points[lo:hi])
+        dists = np.linalg.norm(closest - points, axis=1)
+        return closest, dists, best_tri
+
+    def _closest_points_batch(self, points):
+        n = len(points)
+        best_d2 = np.full(n, np.inf) # squared distances are enough to compare candidates
+        closest = np.zeros((n, 3))
+        best_tri = np.full(n, -1, dtype=np.int64)
+        queries = np.arange(n)
+
+        # seed every query with the leaf it would land in by following the splits,
+        # this gives a tight bound before the real search starts
+        seed = np.full(n, self.root, dtype=np.int64)
+        inner = self.left[seed] >= 0
+        while inner.any():
+            node = seed[inner]
+            go_left = points[inner, self.axis[node]] < self.split[node]
+            seed[inner] = np.where(go_left, self.left[node], self.right[node])
+            inner = self.left[seed] >= 0
+        self._test_leaves(points, queries, seed, best_d2, closest, best_tri)
+
+        # frontier traversal: every (query, node) pair still worth visiting
+        # is processed together one tree level at a time
+        nodes = np.full(n, self.root, dtype=np.int64)
+        while len(queries):
+            # skip pairs whose bounding box is farther than the query's current best
+            lo_gap = self.bbox[nodes, 0] - points[queries]
+            hi_gap = points[queries] - self.bbox[nodes, 1]
+            gap = np.maximum(0.0, np.maximum(lo_gap, hi_gap))
+            keep = np.sum(gap * gap, axis=1) < best_d2[queries]
+            queries, nodes = queries[keep], nodes[keep]
+
+            # test leaves (the seed leaf was already tested)
+            leaf = self.left[nodes] < 0
+            fresh = leaf & (nodes != seed[queries])
+            self._test_leaves(points, queries[fresh], nodes[fresh], best_d2, closest, best_tri)
+
+            # expand the interior nodes into both children
+            queries, nodes = queries[~leaf], nodes[~leaf]
+            queries = np.concatenate([queries, queries])
+            nodes = np.concatenate([self.left[nodes], self.right[nodes]])
+
+        return closest, best_tri
+
+    def _test_leaves(self, points, queries, leaves, best_d2, closest, best_tri):
+        # tests every triangle of leaves[i] against points[queries[i]] in one
+        # vectorized call and keeps the nearest result per query
+        if len(queries) == 0:
+            return
+        counts = self.count[leaves]
+        pair = np.repeat(np.arange(len(queries)), counts)
+        offset = np.arange(len(pair)) - np.repeat(np.cumsum(counts) - counts, counts)
+        tris = self.tri_order[self.start[leaves][pair] + offset]
+        q_idx = queries[pair]
+
+        c = icp.closest_points_from_geometry(points[q_idx], self.triangle_geometry(tris))
+        d2 = np.sum((c - points[q_idx]) ** 2, axis=1)
+
+        # nearest candidate per query: sort by query then distance, keep the first of each run
+        order = np.lexsort((d2, q_idx))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = q_idx[order[1:]] != q_idx[order[:-1]]
+        sel = order[first]
+        sel = sel[d2[sel] < best_d2[q_idx[sel]]]
+        upd = q_idx[sel]
+        best_d2[upd] = d2[sel]
+        closest[upd] = c[sel]
+        best_tri[upd] = tris[sel]
+
+
+def mesh_file_hash(path):
+    # content hash of a mesh file, used to key saved indexes
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def load_or_build_index(mesh_path, vertices, triangles, cache_dir, index_cls=KDTreeTriangles, **kwargs):
+    # loads the index for mesh_path from cache_dir if it was saved before for the same
+    # file contents and settings, otherwise builds it and saves it for the next run
+    mesh_hash = mesh_file_hash(mesh_path)
+    parts = [os.path.splitext(os.path.basename(mesh_path))[0], index_cls.__name__]
+    parts += [f"{key}{value}" for key, value in sorted(kwargs.items())]
+    name = "-".join(parts + [mesh_hash[:16]]) + ".npz"
+    path = os.path.join(cache_dir, name)
+
+    if os.path.exists(path):
+        try:
+            return index_cls.load(path, mesh_hash)
+        except (ValueError, KeyError, EOFError, OSError, zipfile.BadZipFile):
+            pass # stale file from another version or a broken one, rebuild it below
 
+    tree = index_cls(vertices, triangles, **kwargs)
+    os.makedirs(cache_dir, exist_ok=True)
+    # written next to the final name and moved over it, a run killed while saving
+    # leaves a stray temporary file instead of a broken index
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            tree.save(f, mesh_hash)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return tree
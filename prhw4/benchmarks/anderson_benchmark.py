@@ -0,0 +1,47 @@
+import sys
+import os
+import time
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+from utils.icp import IcpRegistrar
+from utils.kdtree import KDTreeTriangles
+from benchmarks.pa4_data import DATA_SETS, load_pa4_mesh, load_pa4_samples
+from benchmarks.warm_start_benchmark import perturbed_cloud
+
+# Plain vs Anderson accelerated point to point ICP on the PA4 mesh, for a few
+# history depths: iterations until convergence (searches, including the ones
+# whose accelerated F_reg was rejected), rejections, wall time and how far the
+# final F_reg is from the plain one. PA4 datasets A-K plus a larger noisy cloud
+
+
+def benchmark_anderson(depths, n_points):
+    vertices, triangles = load_pa4_mesh()
+    tree = KDTreeTriangles(vertices, triangles)
+    clouds = {letter: load_pa4_samples(letter) for letter in DATA_SETS + ['K']}
+    clouds["samples"] = perturbed_cloud(vertices, triangles, n_points)
+
+    print(f"{'data':>8} {'points':>7} {'depth':>6} {'iters':>6} {'rejected':>9} {'time [s]':>9} {'speedup':>8} {'|dF|':>9}")
+    for name, d in clouds.items():
+        plain = None
+        for depth in [0] + depths:
+            start = time.perf_counter()
+            registrar = IcpRegistrar(d, tree, reuse_correspondences=True, anderson=depth)
+            F_reg, history = registrar.run()
+            elapsed = time.perf_counter() - start
+            if plain is None:
+                plain = (F_reg, elapsed)
+            rejected = sum(entry.get("rejected", False) for entry in history)
+            iters = f"{len(history) - 1}" + ("" if registrar.converged else "*")
+            print(f"{name:>8} {len(d):>7d} {depth:>6d} {iters:>6} {rejected:>9d} {elapsed:>9.3f} "
+                  f"{plain[1] / elapsed:>8.2f} {np.linalg.norm(F_reg - plain[0]):>9.2e}")
+    print("* did not converge within max_iters")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Anderson accelerated ICP on PA4")
+    parser.add_argument("--depths", type=int, nargs="+", default=[2, 5, 8])
+    parser.add_argument("--points", type=int, default=2_000)
+    args = parser.parse_args()
+    benchmark_anderson(args.depths, args.points)
@@ -0,0 +1,34 @@
+import sys
+import os
+import time
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from utils.kdtree import KDTreeTriangles
+from benchmarks.synthetic_meshes import ellipsoid_mesh
+
+# Build time of KDTreeTriangles as the mesh grows, from course-sized meshes
+# up to large segmentations
+SIZES = [1_000, 10_000, 100_000, 1_000_000, 5_000_000]
+
+
+def benchmark_build(sizes, leaf_size, repeats):
+    print(f"{'triangles':>10} {'nodes':>9} {'build [s]':>10} {'us/triangle':>12}")
+    for n in sizes:
+        vertices, triangles = ellipsoid_mesh(n)
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.perf_counter()
+            tree = KDTreeTriangles(vertices, triangles, leaf_size=leaf_size)
+            best = min(best, time.perf_counter() - start)
+        print(f"{len(triangles):>10d} {tree.n_nodes:>9d} {best:>10.3f} {1e6 * best / len(triangles):>12.2f}")
+        del tree
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="KDTreeTriangles build time benchmark")
+    parser.add_argument("--max-triangles", type=int, default=SIZES[-1])
+    parser.add_argument("--leaf-size", type=int, default=16)
+    parser.add_argument("--repeats", type=int, default=1)
+    args = parser.parse_args()
+    benchmark_build([n for n in SIZES if n <= args.max_triangles], args.leaf_size, args.repeats)
@@ -0,0 +1,53 @@
+import sys
+import os
+import time
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+from utils.kdtree import KDTreeTriangles, BVHTriangles
+from benchmarks.synthetic_meshes import bone_mesh, surface_samples
+
+# Median-split KD-tree vs binned SAH BVH on skewed, elongated bone meshes.
+# Reports build time, batched query time and one-at-a-time query time
+SIZES = [3_000, 30_000, 300_000]
+
+
+def time_index(index_cls, vertices, triangles, points, n_single):
+    start = time.perf_counter()
+    tree = index_cls(vertices, triangles)
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _, dists, _ = tree.closest_points(points)
+    batched = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for p in points[:n_single]:
+        tree.closest_point(p)
+    single = time.perf_counter() - start
+    return build, batched, single, dists
+
+
+def benchmark_bvh(sizes, n_points, n_single):
+    print(f"{'triangles':>10} {'index':>16} {'build [s]':>10} {'batched [s]':>12} {'single [ms/q]':>14}")
+    for n in sizes:
+        vertices, triangles = bone_mesh(n)
+        points = surface_samples(vertices, triangles, n_points)
+        results = {}
+        for index_cls in [KDTreeTriangles, BVHTriangles]:
+            build, batched, single, dists = time_index(index_cls, vertices, triangles, points, n_single)
+            results[index_cls.__name__] = dists
+            print(f"{len(triangles):>10d} {index_cls.__name__:>16} {build:>10.3f} {batched:>12.3f} "
+                  f"{1e3 * single / n_single:>14.3f}")
+        # both indexes are exact, so they must agree
+        assert np.allclose(results['KDTreeTriangles'], results['BVHTriangles'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="KD-tree vs SAH BVH benchmark on bone-like meshes")
+    parser.add_argument("--max-triangles", type=int, default=SIZES[-1])
+    parser.add_argument("--points", type=int, default=20_000)
+    parser.add_argument("--single", type=int, default=500)
+    args = parser.parse_args()
+    benchmark_bvh([n for n in SIZES if n <= args.max_triangles], args.points, args.single)
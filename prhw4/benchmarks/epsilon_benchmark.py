@@ -0,0 +1,85 @@
+import sys
+import os
+import time
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+from utils import icp as icp
+from utils import pcr as pcr
+from utils.kdtree import KDTreeTriangles
+from benchmarks.pa4_data import DATA_SETS, load_pa4_mesh, load_pa4_samples
+from benchmarks.synthetic_meshes import surface_samples
+
+# (1+eps) approximate closest points on the PA4 mesh. First the speed and error of
+# single searches for every epsilon, on the untransformed d_k of all PA4 datasets
+# (what the first ICP iteration searches) and on noisy surface samples. Then whole
+# ICP runs with icp.EpsilonSchedule against exact searches
+EPSILONS = [0.0, 0.05, 0.1, 0.25, 0.5, 1.0]
+
+
+def time_queries(tree, points, epsilon, repeats):
+    best = np.inf
+    for _ in range(repeats):
+        stats = {}
+        start = time.perf_counter()
+        _, dists, _ = tree.closest_points(points, stats=stats, epsilon=epsilon)
+        best = min(best, time.perf_counter() - start)
+    return best, dists, stats
+
+
+def run_icp(tree, d, schedule=None, max_iters=100, tol_F=1e-6):
+    # main.py's loop, switching to exact searches before it may stop
+    F_reg = np.eye(4)
+    tri_idxs = None
+    for it in range(max_iters):
+        s = d @ F_reg[:3, :3].T + F_reg[:3, 3]
+        epsilon = schedule(it) if schedule is not None else 0.0
+        closest, errors, tri_idxs = tree.closest_points(s, hints=tri_idxs, epsilon=epsilon)
+        F_reg_new = pcr.point_cloud_registration(d, closest)
+        if np.linalg.norm(F_reg_new - F_reg) < tol_F or np.mean(errors) < 1e-5:
+            if epsilon > 0:
+                schedule.finish()
+                F_reg = F_reg_new
+                continue
+            return it + 1, F_reg_new
+        F_reg = F_reg_new
+    return max_iters, F_reg
+
+
+def benchmark_epsilon(n_points, repeats):
+    vertices, triangles = load_pa4_mesh()
+    tree = KDTreeTriangles(vertices, triangles)
+    samples = {letter: load_pa4_samples(letter) for letter in DATA_SETS}
+    clouds = {"PA4 d_k": np.concatenate(list(samples.values())),
+              "samples": surface_samples(vertices, triangles, n_points)}
+
+    print(f"{'queries':>8} {'eps':>5} {'time [s]':>9} {'speedup':>8} {'nodes':>9} {'inexact':>8} "
+          f"{'mean err':>9} {'max err':>9}")
+    for name, points in clouds.items():
+        exact_time, exact, _ = time_queries(tree, points, 0.0, repeats)
+        for epsilon in EPSILONS:
+            elapsed, dists, stats = time_queries(tree, points, epsilon, repeats)
+            rel = dists / np.maximum(exact, 1e-12) - 1.0 # relative distance error, at most epsilon
+            assert np.all(rel <= epsilon + 1e-9)
+            print(f"{name:>8} {epsilon:>5.2f} {elapsed:>9.4f} {exact_time / elapsed:>8.2f} {stats['nodes_visited']:>9d} "
+                  f"{np.mean(rel > 1e-12):>8.1%} {np.mean(rel):>9.2e} {np.max(rel):>9.2e}")
+
+    print(f"\n{'data':>5} {'exact iters':>12} {'exact [s]':>10} {'sched iters':>12} {'sched [s]':>10} {'|dF|':>9}")
+    for letter, d in samples.items():
+        start = time.perf_counter()
+        exact_iters, F_exact = run_icp(tree, d)
+        exact_time = time.perf_counter() - start
+        start = time.perf_counter()
+        iters, F_reg = run_icp(tree, d, icp.EpsilonSchedule())
+        elapsed = time.perf_counter() - start
+        print(f"{letter:>5} {exact_iters:>12d} {exact_time:>10.3f} {iters:>12d} {elapsed:>10.3f} "
+              f"{np.linalg.norm(F_reg - F_exact):>9.2e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Approximate closest point speed and error per epsilon")
+    parser.add_argument("--points", type=int, default=20_000)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    benchmark_epsilon(args.points, args.repeats)
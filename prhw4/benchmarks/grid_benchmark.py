@@ -0,0 +1,67 @@
+import sys
+import os
+import glob
+import time
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+from utils import parse
+from utils.kdtree import KDTreeTriangles, BVHTriangles, GridTriangles
+from benchmarks.synthetic_meshes import surface_samples
+
+# Uniform grid vs the trees on the course meshes. Queries are the s_k of the
+# provided PA3/PA4 debug outputs plus a dense cloud of noisy surface samples
+root = os.path.join(os.path.dirname(__file__), '..', '..')
+MESHES = {
+    "Problem3Mesh": (os.path.join(root, "prhw3", "data", "Problem3Mesh.sur"),
+                     os.path.join(root, "prhw3", "data", "PA3-*-Debug-Output.txt")),
+    "Problem4MeshFile": (os.path.join(root, "prhw4", "data", "Problem4MeshFile.sur"),
+                         os.path.join(root, "prhw4", "data", "PA4-*-Debug-Output.txt")),
+}
+
+
+def load_mesh(path):
+    vertices_ct, vertices_inds = parse.parse_mesh(path)
+    return np.array(vertices_ct, dtype=float), np.array(vertices_inds, dtype=int)[:, :3]
+
+
+def benchmark_grid(n_points, n_single, repeats):
+    print(f"{'mesh':>17} {'queries':>8} {'index':>16} {'build [s]':>10} {'batched [s]':>12} {'single [ms/q]':>14}")
+    for name, (mesh_path, output_glob) in MESHES.items():
+        vertices, triangles = load_mesh(mesh_path)
+        readings = np.concatenate([parse.parse_output(path)[0] for path in sorted(glob.glob(output_glob))])
+        clouds = {"readings": readings, "samples": surface_samples(vertices, triangles, n_points)}
+
+        for cloud, points in clouds.items():
+            results = {}
+            for index_cls in [KDTreeTriangles, BVHTriangles, GridTriangles]:
+                start = time.perf_counter()
+                index = index_cls(vertices, triangles)
+                build = time.perf_counter() - start
+
+                batched = float('inf')
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    _, dists, _ = index.closest_points(points)
+                    batched = min(batched, time.perf_counter() - start)
+                results[index_cls.__name__] = dists
+
+                start = time.perf_counter()
+                for p in points[:n_single]:
+                    index.closest_point(p)
+                single = (time.perf_counter() - start) / min(n_single, len(points))
+
+                print(f"{name:>17} {cloud:>8} {index_cls.__name__:>16} {build:>10.3f} {batched:>12.3f} {1e3 * single:>14.3f}")
+            # all three indexes are exact, so they must agree
+            assert np.allclose(results['KDTreeTriangles'], results['GridTriangles'])
+            assert np.allclose(results['KDTreeTriangles'], results['BVHTriangles'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Uniform grid vs KD-tree/BVH on the PA3/PA4 meshes")
+    parser.add_argument("--points", type=int, default=20_000)
+    parser.add_argument("--single", type=int, default=300)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    benchmark_grid(args.points, args.single, args.repeats)
@@ -0,0 +1,44 @@
+import sys
+import os
+import time
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+from utils.kdtree import KDTreeTriangles
+from benchmarks.pa4_data import load_pa4_mesh
+from benchmarks.synthetic_meshes import bone_mesh, surface_samples
+
+# Batched closest point queries in input (random) order vs Morton order, on the PA4
+# mesh and a synthetic bone mesh, for several batch sizes. Morton sorting makes each
+# batch a compact patch of space, so it visits fewer distinct nodes
+
+
+def benchmark_morton(n_points, batch_sizes, repeats):
+    meshes = {"Problem4MeshFile": load_pa4_mesh(), "bone": bone_mesh(100_000)}
+    print(f"{'mesh':>17} {'points':>8} {'batch':>6} {'random [s]':>11} {'morton [s]':>11} {'speedup':>8}")
+    for name, (vertices, triangles) in meshes.items():
+        tree = KDTreeTriangles(vertices, triangles)
+        points = surface_samples(vertices, triangles, n_points) # samples come out in random order
+        for batch_size in batch_sizes:
+            times = {}
+            results = {}
+            for morton in [False, True]:
+                best = np.inf
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    results[morton] = tree.closest_points(points, batch_size=batch_size, morton=morton)
+                    best = min(best, time.perf_counter() - start)
+                times[morton] = best
+            # the order of the search does not change the answers
+            assert np.allclose(results[False][1], results[True][1])
+            print(f"{name:>17} {n_points:>8d} {batch_size:>6d} {times[False]:>11.3f} {times[True]:>11.3f} "
+                  f"{times[False] / times[True]:>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Morton ordered vs random order batched queries")
+    parser.add_argument("--points", type=int, default=100_000)
+    parser.add_argument("--repeats", type=int, default=1)
+    args = parser.parse_args()
+    benchmark_morton(args.points, [256, 2048], args.repeats)
@@ -0,0 +1,34 @@
+import sys
+import os
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+from utils import parse as parser
+from utils import pcr as pcr
+
+# PA4 inputs for the ICP benchmarks: the mesh and the d_k of every dataset,
+# computed the same way main.py does
+data_dir = os.path.join(os.path.dirname(__file__), '..', 'data')
+DATA_SETS = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'J']
+
+
+def load_pa4_mesh():
+    vertices_ct, vertices_inds = parser.parse_mesh(os.path.join(data_dir, "Problem4MeshFile.sur"))
+    return np.array(vertices_ct, dtype=float), np.array(vertices_inds, dtype=int)[:, :3]
+
+
+def load_pa4_samples(letter):
+    # d_k = F_B,k^-1 F_A,k A_tip for every sample frame of the dataset
+    markers_A, tip_A, n_A = parser.parse_rigid_bodies(os.path.join(data_dir, "Problem4-BodyA.txt"))
+    markers_B, _, n_B = parser.parse_rigid_bodies(os.path.join(data_dir, "Problem4-BodyB.txt"))
+    prefix = 'Debug' if letter <= 'F' else 'Unknown'
+    readings_A, readings_B, num_samples = parser.parse_readings(
+        os.path.join(data_dir, f"PA4-{letter}-{prefix}-SampleReadingsTest.txt"), n_A, n_B)
+    readings_A, readings_B = np.array(readings_A), np.array(readings_B)
+    tip = np.append(tip_A, 1.0)
+    d = []
+    for k in range(num_samples):
+        F_A = pcr.point_cloud_registration(np.array(markers_A), readings_A[k * n_A:(k + 1) * n_A])
+        F_B = pcr.point_cloud_registration(np.array(markers_B), readings_B[k * n_B:(k + 1) * n_B])
+        d.append((np.linalg.inv(F_B) @ F_A @ tip)[:3])
+    return np.array(d)
@@ -0,0 +1,46 @@
+import sys
+import os
+import time
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+from utils.kdtree import KDTreeTriangles, ParallelClosestPoints
+from benchmarks.pa4_data import load_pa4_mesh
+from benchmarks.synthetic_meshes import surface_samples
+
+# One large batch of closest point queries on the PA4 mesh, answered by the tree in
+# this process vs ParallelClosestPoints with 1..N workers attached to the shared tree
+# arrays. The pool start (workers attach, no tree copies) is timed separately.
+# Speedup is bounded by the number of cores of the machine (os.cpu_count())
+
+
+def benchmark_parallel(n_points, max_workers, noise):
+    vertices, triangles = load_pa4_mesh()
+    tree = KDTreeTriangles(vertices, triangles)
+    rand = np.random.default_rng(0)
+    points = surface_samples(vertices, triangles, n_points) + rand.normal(0.0, noise, (n_points, 3))
+
+    start = time.perf_counter()
+    expected = tree.closest_points(points)
+    serial = time.perf_counter() - start
+    print(f"{n_points} queries, {os.cpu_count()} cores, serial: {serial:.3f} s")
+    print(f"{'workers':>8} {'pool start [s]':>15} {'query [s]':>10} {'speedup':>8}")
+    for n_workers in range(1, max_workers + 1):
+        start = time.perf_counter()
+        with ParallelClosestPoints(tree, n_workers) as parallel:
+            started = time.perf_counter() - start
+            start = time.perf_counter()
+            result = parallel.closest_points(points)
+            elapsed = time.perf_counter() - start
+        assert all(np.array_equal(a, b) for a, b in zip(result, expected))
+        print(f"{n_workers:>8d} {started:>15.3f} {elapsed:>10.3f} {serial / elapsed:>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shared memory parallel closest point queries on the PA4 mesh")
+    parser.add_argument("--points", type=int, default=200_000)
+    parser.add_argument("--workers", type=int, default=max(2, os.cpu_count() or 1))
+    parser.add_argument("--noise", type=float, default=1.0)
+    args = parser.parse_args()
+    benchmark_parallel(args.points, args.workers, args.noise)
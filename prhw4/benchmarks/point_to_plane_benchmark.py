@@ -0,0 +1,51 @@
+import sys
+import os
+import time
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+from utils.icp import IcpRegistrar
+from utils.kdtree import KDTreeTriangles
+from benchmarks.pa4_data import DATA_SETS, load_pa4_mesh, load_pa4_samples
+from benchmarks.warm_start_benchmark import perturbed_cloud
+
+# Point to point vs point to plane ICP on the PA4 mesh: iterations until
+# convergence, wall time of the whole registration, final mean error and how far
+# apart the two F_reg end up. Runs the PA4 datasets A-K (K has readings but is
+# not part of main.py) plus a larger cloud of noisy surface samples moved by a
+# small rigid motion. Searches reuse correspondences like main.py does
+
+
+def benchmark_point_to_plane(n_points, repeats):
+    vertices, triangles = load_pa4_mesh()
+    tree = KDTreeTriangles(vertices, triangles)
+    clouds = {letter: load_pa4_samples(letter) for letter in DATA_SETS + ['K']}
+    clouds["samples"] = perturbed_cloud(vertices, triangles, n_points)
+
+    print(f"{'data':>8} {'points':>7} {'method':>15} {'iters':>6} {'time [s]':>9} {'speedup':>8} "
+          f"{'mean error':>11} {'|dF|':>9}")
+    for name, d in clouds.items():
+        results = {}
+        for method in IcpRegistrar.METHODS:
+            best = np.inf
+            for _ in range(repeats):
+                start = time.perf_counter()
+                registrar = IcpRegistrar(d, tree, reuse_correspondences=True, method=method)
+                F_reg, history = registrar.run()
+                best = min(best, time.perf_counter() - start)
+            results[method] = (F_reg, best)
+            speedup = results["point_to_point"][1] / best
+            delta = np.linalg.norm(F_reg - results["point_to_point"][0])
+            iters = f"{len(history) - 1}" + ("" if registrar.converged else "*")
+            print(f"{name:>8} {len(d):>7d} {method:>15} {iters:>6} {best:>9.3f} {speedup:>8.2f} "
+                  f"{np.mean(registrar.errors):>11.6f} {delta:>9.2e}")
+    print("* did not converge within max_iters")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Point to point vs point to plane ICP on PA4")
+    parser.add_argument("--points", type=int, default=2_000)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    benchmark_point_to_plane(args.points, args.repeats)
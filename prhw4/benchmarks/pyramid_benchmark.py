@@ -0,0 +1,68 @@
+import sys
+import os
+import time
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+from utils.icp import IcpRegistrar, MultiResolutionRegistrar
+from utils.kdtree import KDTreeTriangles, MeshPyramid
+from benchmarks.pa4_data import DATA_SETS, load_pa4_mesh, load_pa4_samples
+from benchmarks.synthetic_meshes import bone_mesh
+from benchmarks.warm_start_benchmark import perturbed_cloud
+
+# ICP on the full mesh vs coarse to fine ICP over a MeshPyramid, with plain point
+# to point, Anderson accelerated and point to plane updates. Prints every level
+# (triangles, iterations, time, mean error at its final F_reg), the total time
+# and how far the final F_reg is from the full mesh one. The PA4 mesh (3k
+# triangles) plus a synthetic bone with a cloud started further away
+
+
+def run_case(name, tree, pyramid, d, methods):
+    for label, options in methods.items():
+        start = time.perf_counter()
+        registrar = IcpRegistrar(d, tree, reuse_correspondences=True, **options)
+        F_full, history = registrar.run()
+        full_time = time.perf_counter() - start
+        iters = f"{len(history) - 1}" + ("" if registrar.converged else "*")
+        print(f"{name:>8} {label:>8} {'full':>6} {len(tree.triangles):>9d} {iters:>6} {full_time:>9.3f} "
+              f"{np.mean(registrar.errors):>10.5f}")
+
+        start = time.perf_counter()
+        registrar = MultiResolutionRegistrar(d, pyramid, reuse_correspondences=True, **options)
+        F_reg, _ = registrar.run()
+        total = time.perf_counter() - start
+        for level in registrar.levels:
+            iters = f"{level['iterations']}" + ("" if level["level"] > 0 or registrar.converged else "*")
+            print(f"{'':>8} {'':>8} {level['level']:>6d} {level['triangles']:>9d} {iters:>6} {level['time']:>9.3f} "
+                  f"{level['mean_error']:>10.5f}")
+        print(f"{'':>8} {'':>8} {'total':>6} {'':>9} {'':>6} {total:>9.3f} {'':>10} "
+              f"speedup {full_time / total:.2f}, |dF| {np.linalg.norm(F_reg - F_full):.2e}")
+
+
+def benchmark_pyramid(n_levels, bone_triangles, n_points):
+    methods = {"p2p": {}, "anderson": {"anderson": 5}, "p2plane": {"method": "point_to_plane"}}
+    print(f"{'data':>8} {'method':>8} {'level':>6} {'triangles':>9} {'iters':>6} {'time [s]':>9} {'mean err':>10}")
+
+    vertices, triangles = load_pa4_mesh()
+    tree = KDTreeTriangles(vertices, triangles)
+    pyramid = MeshPyramid(tree, n_levels=n_levels)
+    for letter in DATA_SETS + ['K']:
+        run_case(letter, tree, pyramid, load_pa4_samples(letter), methods)
+
+    vertices, triangles = bone_mesh(bone_triangles)
+    tree = KDTreeTriangles(vertices, triangles)
+    start = time.perf_counter()
+    pyramid = MeshPyramid(tree, n_levels=n_levels + 1)
+    print(f"bone pyramid built in {time.perf_counter() - start:.3f} s")
+    run_case("bone", tree, pyramid, perturbed_cloud(vertices, triangles, n_points, angle=0.1, shift=5.0), methods)
+    print("* did not converge within max_iters")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Coarse to fine ICP over a mesh pyramid")
+    parser.add_argument("--levels", type=int, default=3)
+    parser.add_argument("--bone-triangles", type=int, default=40_000)
+    parser.add_argument("--points", type=int, default=2_000)
+    args = parser.parse_args()
+    benchmark_pyramid(args.levels, args.bone_triangles, args.points)
@@ -0,0 +1,61 @@
+import sys
+import os
+import time
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+from utils import parse
+from utils.kdtree import KDTreeTriangles
+from benchmarks.synthetic_meshes import surface_samples
+
+# Refit vs rebuild of KDTreeTriangles on the PA5 deformable bone (mean shape plus 6
+# modes). For each size of the random mode weights: the time to refit or rebuild,
+# how much the tree cost grew, and the query time on the refit tree vs a fresh one
+pa5_dir = os.path.join(os.path.dirname(__file__), '..', '..', 'prhw5', 'data')
+SCALES = [1.0, 10.0, 50.0, 100.0, 200.0]
+
+
+def benchmark_refit(n_shapes, n_points):
+    modes = parse.parse_modes(os.path.join(pa5_dir, "Problem5Modes.txt"))
+    _, vertices_inds = parse.parse_mesh(os.path.join(pa5_dir, "Problem5MeshFile.sur"))
+    triangles = np.array(vertices_inds, dtype=int)[:, :3]
+    rand = np.random.default_rng(0)
+
+    print(f"{'weights':>8} {'max disp':>9} {'refit [ms]':>11} {'build [ms]':>11} {'cost ratio':>11} "
+          f"{'rebuilds':>9} {'query refit [s]':>16} {'query fresh [s]':>16}")
+    for scale in SCALES:
+        tree = KDTreeTriangles(modes[0], triangles)
+        refit_time = build_time = query_refit = query_fresh = 0.0
+        cost_ratio, rebuilds, max_disp = [], 0, 0.0
+        for _ in range(n_shapes):
+            weights = rand.normal(0.0, scale, len(modes) - 1)
+            vertices = modes[0] + np.tensordot(weights, modes[1:], axes=1)
+            max_disp = max(max_disp, np.max(np.linalg.norm(vertices - modes[0], axis=1)))
+            points = surface_samples(vertices, triangles, n_points, seed=len(cost_ratio))
+
+            start = time.perf_counter()
+            rebuilds += tree.refit(vertices)
+            refit_time += time.perf_counter() - start
+            cost_ratio.append(tree.tree_cost() / tree.build_cost)
+            start = time.perf_counter()
+            fresh = KDTreeTriangles(vertices, triangles)
+            build_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            _, dists, _ = tree.closest_points(points)
+            query_refit += time.perf_counter() - start
+            start = time.perf_counter()
+            _, expected, _ = fresh.closest_points(points)
+            query_fresh += time.perf_counter() - start
+            assert np.allclose(dists, expected)
+        print(f"{scale:>8.0f} {max_disp:>9.2f} {1e3 * refit_time / n_shapes:>11.2f} {1e3 * build_time / n_shapes:>11.2f} "
+              f"{np.max(cost_ratio):>11.3f} {rebuilds:>9d} {query_refit:>16.3f} {query_fresh:>16.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="KD-tree refit vs rebuild on the PA5 deformable mesh")
+    parser.add_argument("--shapes", type=int, default=20)
+    parser.add_argument("--points", type=int, default=2_000)
+    args = parser.parse_args()
+    benchmark_refit(args.shapes, args.points)
@@ -0,0 +1,80 @@
+import sys
+import os
+import time
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+from utils import parse
+from utils.icp import IcpRegistrar, RobustWeights
+from utils.kdtree import KDTreeTriangles
+from benchmarks.pa4_data import DATA_SETS, data_dir, load_pa4_mesh, load_pa4_samples
+from benchmarks.synthetic_meshes import surface_samples
+
+# Plain vs robust ICP (RobustWeights of every kind) on the PA4 mesh, with any of
+# the ICP updates (--method, --anderson): iterations, samples still counted at
+# the end, wall time and the registration error. For the Debug datasets the
+# error is the mean distance of s_k to the s_k of the given output, for the
+# synthetic clouds (noisy surface samples moved by a known F_true, a fraction of
+# them thrown off the surface) it is |F_reg - F_true|
+
+
+def outlier_cloud(vertices, triangles, n_points, outliers, seed=0):
+    # returns d and the F_true registering d onto the mesh, outliers of the samples
+    # are moved 5-15 off the surface in random directions
+    rand = np.random.default_rng(seed)
+    surface = surface_samples(vertices, triangles, n_points, noise=0.25, seed=seed)
+    bad = rand.choice(n_points, int(outliers * n_points), replace=False)
+    directions = rand.normal(size=(len(bad), 3))
+    directions /= np.linalg.norm(directions, axis=1)[:, None]
+    surface[bad] += directions * rand.uniform(5.0, 15.0, len(bad))[:, None]
+    angle = 0.05
+    F_true = np.eye(4)
+    F_true[:3, :3] = [[np.cos(angle), -np.sin(angle), 0.0], [np.sin(angle), np.cos(angle), 0.0], [0.0, 0.0, 1.0]]
+    F_true[:3, 3] = [1.0, -0.5, 0.5]
+    return (surface - F_true[:3, 3]) @ F_true[:3, :3], F_true
+
+
+def benchmark_robust(n_points, outlier_fractions, method, anderson):
+    vertices, triangles = load_pa4_mesh()
+    tree = KDTreeTriangles(vertices, triangles)
+    cases = {}
+    for letter in DATA_SETS + ['K']:
+        reference = None
+        if letter <= 'F':
+            reference, _ = parse.parse_output(os.path.join(data_dir, f"PA4-{letter}-Debug-Output.txt"))
+        cases[letter] = (load_pa4_samples(letter), reference, None)
+    for fraction in outlier_fractions:
+        d, F_true = outlier_cloud(vertices, triangles, n_points, fraction)
+        cases[f"out{fraction:.0%}"] = (d, None, F_true)
+
+    weightings = {"plain": None, "trim": RobustWeights("trim", trim=0.8), "thresh": RobustWeights("threshold"),
+                  "huber": RobustWeights("huber"), "tukey": RobustWeights("tukey")}
+    print(f"{'data':>8} {'points':>7} {'weights':>7} {'iters':>6} {'inliers':>8} {'time [s]':>9} {'error':>10}")
+    for name, (d, reference, F_true) in cases.items():
+        for label, robust in weightings.items():
+            start = time.perf_counter()
+            registrar = IcpRegistrar(d, tree, reuse_correspondences=True, method=method, anderson=anderson,
+                                     robust=robust)
+            F_reg, history = registrar.run()
+            elapsed = time.perf_counter() - start
+            iters = f"{len(history) - 1}" + ("" if registrar.converged else "*")
+            inliers = len(d) if robust is None else history[-1]["inliers"]
+            if F_true is not None:
+                error = f"{np.linalg.norm(F_reg - F_true):>10.2e}"
+            elif reference is not None:
+                error = f"{np.mean(np.linalg.norm(registrar.s - reference, axis=1)):>10.2e}"
+            else:
+                error = f"{'':>10}"
+            print(f"{name:>8} {len(d):>7d} {label:>7} {iters:>6} {inliers:>8d} {elapsed:>9.3f} {error}")
+    print("* did not converge within max_iters")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Robust (weighted) ICP on PA4")
+    parser.add_argument("--points", type=int, default=2_000)
+    parser.add_argument("--outliers", type=float, nargs="+", default=[0.0, 0.05, 0.2])
+    parser.add_argument("--method", default="point_to_point", choices=IcpRegistrar.METHODS)
+    parser.add_argument("--anderson", type=int, default=0)
+    args = parser.parse_args()
+    benchmark_robust(args.points, args.outliers, args.method, args.anderson)
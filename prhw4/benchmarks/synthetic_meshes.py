@@ -0,0 +1,52 @@
+import numpy as np
+
+# Synthetic closed-ish surfaces for the benchmarks, sized by triangle count so
+# the index code can be timed well beyond the ~3k triangles of the course mesh
+
+def grid_triangles(nu, nv):
+    # two triangles per quad of an nu x nv vertex grid that wraps around in v
+    i, j = np.meshgrid(np.arange(nu - 1), np.arange(nv), indexing='ij')
+    a = i * nv + j
+    b = i * nv + (j + 1) % nv
+    c = a + nv
+    d = b + nv
+    first = np.stack([a, b, c], axis=-1).reshape(-1, 3)
+    second = np.stack([b, d, c], axis=-1).reshape(-1, 3)
+    return np.concatenate([first, second])
+
+def ellipsoid_mesh(n_triangles, radii=(40.0, 30.0, 60.0)):
+    # latitude/longitude grid on an ellipsoid with about n_triangles triangles,
+    # the poles are left open to avoid degenerate triangles
+    nv = max(3, int(np.sqrt(n_triangles)))
+    nu = max(2, n_triangles // (2 * nv) + 1)
+    theta = np.linspace(0.05, np.pi - 0.05, nu)
+    phi = np.linspace(0.0, 2 * np.pi, nv, endpoint=False)
+    theta, phi = np.meshgrid(theta, phi, indexing='ij')
+    vertices = np.stack([radii[0] * np.sin(theta) * np.cos(phi),
+                         radii[1] * np.sin(theta) * np.sin(phi),
+                         radii[2] * np.cos(theta)], axis=-1).reshape(-1, 3)
+    return vertices, grid_triangles(nu, nv)
+
+def bone_mesh(n_triangles, length=250.0, radius=12.0, skew=3.0):
+    # long-bone like tube along z: a slightly bent shaft with two wide ends. the
+    # grid rows are bunched towards the z = 0 end (rows at t**skew), so the
+    # triangles are both elongated overall and very unevenly distributed
+    nv = max(3, int(np.sqrt(n_triangles / 8)))
+    nu = max(2, n_triangles // (2 * nv) + 1)
+    t = np.linspace(0.0, 1.0, nu) ** skew
+    phi = np.linspace(0.0, 2 * np.pi, nv, endpoint=False)
+    t, phi = np.meshgrid(t, phi, indexing='ij')
+    z = length * t
+    r = radius * (1.0 + 1.2 * np.exp(-(t / 0.08) ** 2) + 0.8 * np.exp(-((t - 1.0) / 0.08) ** 2))
+    bend = 0.15 * length * t ** 2
+    vertices = np.stack([r * np.cos(phi) + bend, r * np.sin(phi), z], axis=-1).reshape(-1, 3)
+    return vertices, grid_triangles(nu, nv)
+
+def surface_samples(vertices, triangles, n_points, noise=1.0, seed=0):
+    # random points on the mesh pushed off the surface by gaussian noise,
+    # roughly what the pointer tip readings look like
+    rand = np.random.default_rng(seed)
+    tris = vertices[triangles[rand.integers(0, len(triangles), n_points)]]
+    w = rand.dirichlet([1.0, 1.0, 1.0], n_points)
+    points = np.einsum('ij,ijk->ik', w, tris)
+    return points + rand.normal(0.0, noise, (n_points, 3))
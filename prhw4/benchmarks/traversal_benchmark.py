@@ -0,0 +1,42 @@
+import sys
+import os
+import time
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+from utils.kdtree import KDTreeTriangles
+from benchmarks.pa4_data import load_pa4_mesh
+from benchmarks.synthetic_meshes import bone_mesh, surface_samples
+
+# One-at-a-time KDTreeTriangles.closest_point traversal speed, reported as tree
+# nodes visited per second (and queries per second) on the PA4 mesh and on a
+# larger synthetic bone mesh
+
+
+def benchmark_traversal(n_points, leaf_sizes, repeats):
+    meshes = {"Problem4MeshFile": load_pa4_mesh(), "bone": bone_mesh(100_000)}
+    print(f"{'mesh':>17} {'leaf':>5} {'nodes/query':>12} {'Mnodes/s':>9} {'queries/s':>10}")
+    for name, (vertices, triangles) in meshes.items():
+        points = surface_samples(vertices, triangles, n_points)
+        for leaf_size in leaf_sizes:
+            tree = KDTreeTriangles(vertices, triangles, leaf_size=leaf_size)
+            stats = {}
+            for p in points:
+                tree.closest_point(p, stats=stats)
+            best = np.inf
+            for _ in range(repeats):
+                start = time.perf_counter()
+                for p in points:
+                    tree.closest_point(p)
+                best = min(best, time.perf_counter() - start)
+            print(f"{name:>17} {leaf_size:>5d} {stats['nodes_visited'] / n_points:>12.1f} "
+                  f"{stats['nodes_visited'] / best / 1e6:>9.3f} {n_points / best:>10.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Single query KD-tree traversal speed")
+    parser.add_argument("--points", type=int, default=2_000)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    benchmark_traversal(args.points, [1, 4, 16], args.repeats)
@@ -0,0 +1,64 @@
+import sys
+import os
+import time
+import argparse
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+from utils import pcr as pcr
+from utils.kdtree import KDTreeTriangles
+from benchmarks.pa4_data import DATA_SETS, load_pa4_mesh, load_pa4_samples
+from benchmarks.synthetic_meshes import surface_samples
+
+# ICP on the PA4 mesh with cold closest point searches vs searches warm started
+# from the previous iteration's triangles. Besides the PA4 samples a larger
+# cloud of noisy surface samples moved by a small rigid motion is registered
+
+
+def run_icp(tree, d, warm, max_iters=100, tol_F=1e-6):
+    # same loop as main.py, returns the iteration count and the search counters
+    stats = {}
+    F_reg = np.eye(4)
+    tri_idxs = None
+    for it in range(max_iters):
+        s = d @ F_reg[:3, :3].T + F_reg[:3, 3]
+        closest, errors, tri_idxs = tree.closest_points(s, hints=tri_idxs if warm else None, stats=stats)
+        F_reg_new = pcr.point_cloud_registration(d, closest)
+        if np.linalg.norm(F_reg_new - F_reg) < tol_F or np.mean(errors) < 1e-5:
+            break
+        F_reg = F_reg_new
+    return it + 1, F_reg_new, stats
+
+
+def perturbed_cloud(vertices, triangles, n_points, angle=0.03, shift=1.0):
+    # surface samples moved by a rotation about z and a translation
+    c, s = np.cos(angle), np.sin(angle)
+    R = np.array([[c, -s, 0.0], [s, c, 0.0], [0.0, 0.0, 1.0]])
+    return surface_samples(vertices, triangles, n_points, noise=0.25) @ R.T + shift
+
+
+def benchmark_warm_start(n_points):
+    vertices, triangles = load_pa4_mesh()
+    tree = KDTreeTriangles(vertices, triangles)
+    clouds = {letter: load_pa4_samples(letter) for letter in DATA_SETS}
+    clouds["samples"] = perturbed_cloud(vertices, triangles, n_points)
+
+    print(f"{'data':>8} {'points':>7} {'iters':>6} {'mode':>5} {'nodes':>10} {'tri tests':>10} {'time [s]':>9}")
+    for name, d in clouds.items():
+        results = {}
+        for mode in ["cold", "warm"]:
+            start = time.perf_counter()
+            iters, F_reg, stats = run_icp(tree, d, mode == "warm")
+            elapsed = time.perf_counter() - start
+            results[mode] = F_reg
+            print(f"{name:>8} {len(d):>7d} {iters:>6d} {mode:>5} {stats['nodes_visited']:>10d} "
+                  f"{stats['triangle_tests']:>10d} {elapsed:>9.3f}")
+        # hints never change the answer
+        assert np.allclose(results["cold"], results["warm"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Warm started closest point searches in ICP")
+    parser.add_argument("--points", type=int, default=5_000)
+    args = parser.parse_args()
+    benchmark_warm_start(args.points)
@@ -5,7 +5,8 @@ from utils import plot as plotter
 from utils import pcr as pcr 
 from utils import icp as icp
 from utils import write_out as writer
-from utils.kdtree import KDTreeTriangles as kdtree
+from utils.kdtree import KDTreeTriangles as kdtree, DistanceFieldTriangles, MeshWalkTriangles, MeshPyramid, \
+    QueryStats, load_or_build_index
 
 import time
 # Iterative ICP HW4
@@ -20,10 +21,47 @@ body_B_markers_bB, body_B_tip_bB, num_trackers_bB = parser.parse_rigid_bodies("d
 vertices_ct, vertices_inds = parser.parse_mesh("data/Problem4MeshFile.sur")
 
 vertices_inds = np.array(vertices_inds)
-triangles = np.array(vertices_inds[:, :3], dtype=int) # Only i1,i2,i3 needed
+triangles = np.array(vertices_inds[:, :3], dtype=int) # i1,i2,i3
+neighbors = np.array(vertices_inds[:, 3:6], dtype=int) # n1,n2,n3, -1 if not given
 vertices  = np.array(vertices_ct, dtype=float)
 
 start = time.perf_counter()
+# the mesh is the same for every dataset, so its index is built once and saved
+# under ./cache keyed by the mesh file contents, later runs just load it
+mesh_tree = load_or_build_index("data/Problem4MeshFile.sur", vertices, triangles, "./cache", index_cls=kdtree)
+# optionally precompute a distance field around the mesh, closest point queries near
+# the surface become a voxel lookup plus a few triangle tests
+use_distance_field = False
+if use_distance_field:
+    mesh_tree = DistanceFieldTriangles(mesh_tree)
+# or walk the mesh from each sample's triangle of the last iteration to a local
+# optimum, falling back to the tree when the walk does not settle
+use_mesh_walk = False
+if use_mesh_walk:
+    mesh_tree = MeshWalkTriangles(mesh_tree, neighbors)
+# reuse correspondences between ICP iterations: samples that provably kept their
+# nearest triangle are not searched again (tree only, same results as a full search)
+reuse_correspondences = not (use_distance_field or use_mesh_walk)
+# search approximately (icp.EpsilonSchedule) in the early iterations and tighten to
+# exact closest points for convergence (tree only)
+use_epsilon_schedule = False
+# update F_reg from the planes of the matched triangles instead of the closest points
+# (point to plane ICP), needs a handful of iterations instead of dozens
+use_point_to_plane = False
+# or extrapolate the point to point updates of F_reg (Anderson acceleration), cuts
+# the iterations 3-5x and converges to the same F_reg (not with use_point_to_plane)
+use_anderson_acceleration = False
+# weigh the samples in every F_reg update by their current errors (icp.RobustWeights,
+# huber), bad pointer readings then barely pull F_reg
+use_robust_weights = False
+# register on decimated copies of the mesh first (coarse to fine) and finish on the
+# full mesh, pays off for big meshes with use_anderson_acceleration or
+# use_point_to_plane, the 3k triangle mesh here is small enough to not need it (tree only)
+use_mesh_pyramid = False
+pyramid = MeshPyramid(mesh_tree) if use_mesh_pyramid and isinstance(mesh_tree, kdtree) else None
+# count the work of every closest point search (nodes visited and pruned, triangle
+# tests, stack depth) and print a summary per dataset, off it costs nothing
+report_query_stats = False
 for letter in data_sets:
     print(f"----------Processing dataset {letter}----------")
 
@@ -36,8 +74,6 @@ for letter in data_sets:
     body_A_markers_tr = np.array(body_A_markers_tr)
     body_B_markers_tr = np.array(body_B_markers_tr)
 
-    mesh_tree = kdtree(vertices, triangles)
-
     # Compute F_A,k and F_B,k for each sample frame using PCR
     F_A = []
     F_B = []
@@ -49,77 +85,47 @@ for letter in data_sets:
     F_A = np.array(F_A)  
     F_B = np.array(F_B)  
 
-    # Compute d,k for each sample frame
-    # A_tip in body B frame
-    d = []  
-    for k in range(num_samples):
-        H_body_A_tip_bA = np.append(body_A_tip_bA, 1.0) # Make HTM
-        H_d_k = np.linalg.inv(F_B[k]) @ F_A[k] @ H_body_A_tip_bA # F_B^-1 * F_A * A_tip
-        d_k = H_d_k[:3]  # Extract translation part
-        d.append(d_k)
-    d = np.array(d)
-
-    # Apply registration F_reg 
-    F_reg = np.eye(4)
-    max_iters = 100
-    tol_F = 1e-6
-
-    for iter in range(max_iters):
-
-        # Compute s_k = F_reg * d_k
-        H_d = np.hstack([d, np.ones((num_samples, 1))])   
-        H_s = (F_reg @ H_d.T).T                           
-        s = H_s[:, :3]
-
-        # Find closest points on mesh
-        closest_points = []
-        errors = []
-        tri_idxs = []
-        for sk in s:
-            c_k, e_k, idx = mesh_tree.closest_point(sk)
-            closest_points.append(c_k)
-            errors.append(e_k)
-            tri_idxs.append(idx)
-        closest_points = np.asarray(closest_points)
-        errors = np.asarray(errors)
-
-        # Registration map d to closest points
-        F_reg_new = pcr.point_cloud_registration(d, closest_points)
-
-        # Convergence check. Ether small change in F_reg or small mean error terminates loop
-        if np.linalg.norm(F_reg_new - F_reg) < tol_F or np.mean(errors) < 1e-5: # Played around with bounds we can look more later
-            if np.mean(errors) > 1e-1:
-                print(f"FAIL: High mean error {np.mean(errors):.6f} at convergence.")
-            F_reg = F_reg_new
-            print(f"Converged at iteration {iter+1}, mean error = {np.mean(errors):.6f}")
-            break
-
-        print(f"Iteration {iter+1}: mean error = {np.mean(errors):.6f}")
-        F_reg = F_reg_new
-        if iter == max_iters - 1:
-            print("WARNING: Reached maximum iterations without convergence.")
-
-    # Final closest points and errors with converged F_reg
-    # TODO maybe we can prevent a copy here?
-    s = []
-    for k in range(num_samples):
-        H_d = np.append(d[k], 1.0)
-        s.append((F_reg @ H_d)[:3])
-    s = np.asarray(s)
-
-    # final closest points for output
-    closest_points = []
-    errors = []
-    for sk in s:
-        ck, e, _ = mesh_tree.closest_point(sk)
-        closest_points.append(ck)
-        errors.append(e)
-    errors = np.asarray(errors)
-    closest_points = np.asarray(closest_points)
+    # Compute d,k for each sample frame, all frames at once
+    # A_tip in body B frame, d_k = F_B,k^-1 * F_A,k * A_tip
+    H_body_A_tip_bA = np.append(body_A_tip_bA, 1.0) # Make HTM
+    d = (np.linalg.inv(F_B) @ F_A @ H_body_A_tip_bA)[:, :3] # Extract translation part
+
+    # Iterate s_k = F_reg * d_k -> closest points -> F_reg until F_reg settles
+    schedule = icp.EpsilonSchedule() if use_epsilon_schedule and isinstance(mesh_tree, kdtree) else None
+    query_stats = QueryStats(per_query=True) if report_query_stats else None
+    options = dict(max_iters=100, tol_F=1e-6, reuse_correspondences=reuse_correspondences,
+                   epsilon_schedule=schedule, stats=query_stats,
+                   method="point_to_plane" if use_point_to_plane else "point_to_point",
+                   anderson=5 if use_anderson_acceleration else 0,
+                   robust=icp.RobustWeights("huber") if use_robust_weights else None)
+    if pyramid is not None:
+        registrar = icp.MultiResolutionRegistrar(d, pyramid, **options)
+    else:
+        registrar = icp.IcpRegistrar(d, mesh_tree, **options)
+    F_reg, history = registrar.run()
+
+    # the last entry is the search at the final F_reg, which is the output
+    for entry in history[:-2] if registrar.converged else history[:-1]:
+        print(f"Iteration {entry['iteration'] + 1}: mean error = {entry['mean_error']:.6f}")
+    if registrar.converged:
+        mean_err = history[-2]["mean_error"]
+        if mean_err > 1e-1:
+            print(f"FAIL: High mean error {mean_err:.6f} at convergence.")
+        print(f"Converged at iteration {len(history) - 1}, mean error = {mean_err:.6f}")
+    else:
+        print("WARNING: Reached maximum iterations without convergence.")
+    if query_stats is not None:
+        print(f"Closest point searches for dataset {letter}:")
+        print(query_stats.report())
+
+    if pyramid is not None:
+        for level in registrar.levels:
+            print(f"Level {level['level']} ({level['triangles']} triangles): {level['iterations']} iterations, "
+                  f"{level['time']:.3f} s, mean error = {level['mean_error']:.6f}")
 
     # Write out 
     output_path = f"./out/PA4-{letter}-{prefix}-Output.txt"
-    writer.write_p4_output(s, closest_points, errors, output_path)
+    writer.write_p4_output(registrar.s, registrar.closest, registrar.errors, output_path)
 end = time.perf_counter() # Timer for comparison to linear search
 print(f"Execution time: {end - start:.6f} seconds")
     
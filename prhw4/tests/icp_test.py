@@ -0,0 +1,112 @@
+import sys
+import os
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils.kdtree import KDTreeTriangles, MeshPyramid
+from utils.icp import EpsilonSchedule, IcpRegistrar, MultiResolutionRegistrar, RobustWeights
+from meshes import height_field_mesh, bumpy_surface, mesh_samples, rigid_samples
+
+
+def test_icp_registrar():
+    # samples of a bumpy surface moved by a small rigid motion are registered back
+    # onto it, the kept correspondences are those of the final F_reg, and reusing
+    # correspondences, starting approximate, point to plane or accelerated updates
+    # end in the same place
+    vertices, triangles = bumpy_surface()
+    tree = KDTreeTriangles(vertices, triangles, leaf_size=4)
+    d, F_true = rigid_samples(mesh_samples(np.random.default_rng(21), vertices, triangles, 200))
+
+    results = []
+    for options in [{}, {"reuse_correspondences": True}, {"epsilon_schedule": EpsilonSchedule()},
+                    {"method": "point_to_plane"}, {"anderson": 5}]:
+        registrar = IcpRegistrar(d, tree, **options)
+        F_reg, history = registrar.run()
+        assert registrar.converged and len(history) <= 101
+        assert np.allclose(F_reg, F_true, atol=1e-4) and np.max(registrar.errors) < 1e-4
+        assert np.allclose(registrar.s, d @ F_reg[:3, :3].T + F_reg[:3, 3])
+        closest, dists, tri_idxs = tree.closest_points(registrar.s)
+        assert np.array_equal(registrar.closest, closest) and np.array_equal(registrar.errors, dists)
+        assert history[-1]["mean_error"] == np.mean(dists) and "delta_F" not in history[-1]
+        results.append((F_reg, len(history)))
+    assert np.array_equal(results[0][0], results[1][0])
+    # sliding along the surface or extrapolating the updates converges in far fewer iterations
+    assert results[3][1] < results[0][1] / 2 and results[4][1] < results[0][1] / 2
+    try:
+        IcpRegistrar(d, tree, method="point_to_plane", anderson=5)
+        assert False, "Anderson acceleration of point to plane should be refused"
+    except ValueError:
+        pass
+
+    print("icp registrar tests passed")
+
+
+def test_multi_resolution_registrar():
+    # coarse to fine ICP over a mesh pyramid ends where ICP on the full mesh does
+    vertices, triangles = height_field_mesh(33, 2.0, fx=0.8, fy=0.6, extent=15.0)
+    tree = KDTreeTriangles(vertices, triangles, leaf_size=4)
+    pyramid = MeshPyramid(tree, n_levels=3)
+    sizes = [len(level.triangles) for level in pyramid.levels]
+    d, F_true = rigid_samples(mesh_samples(np.random.default_rng(24), vertices, triangles, 200))
+
+    for options in [{}, {"anderson": 5}, {"method": "point_to_plane"}]:
+        registrar = MultiResolutionRegistrar(d, pyramid, reuse_correspondences=True, **options)
+        F_reg, history = registrar.run()
+        assert registrar.converged and np.allclose(F_reg, F_true, atol=1e-4)
+        assert [level["level"] for level in registrar.levels] == [2, 1, 0]
+        assert [level["triangles"] for level in registrar.levels] == sizes[::-1]
+        assert sum(level["iterations"] + 1 for level in registrar.levels) == len(history)
+        assert history[-1]["level"] == 0
+        closest, dists, _ = tree.closest_points(registrar.s)
+        assert np.array_equal(registrar.closest, closest) and np.array_equal(registrar.errors, dists)
+
+    print("multi resolution registrar tests passed")
+
+
+def test_robust_weights():
+    # each kind of robust weights cuts or shrinks the large errors
+    errors = np.concatenate([np.linspace(0.1, 1.0, 90), np.full(10, 50.0)])
+    for kind in RobustWeights.KINDS:
+        weights = RobustWeights(kind)(errors)
+        assert weights.shape == errors.shape and np.all((weights >= 0) & (weights <= 1))
+        assert np.all(weights[:45] > 0.9) and np.all(weights[90:] < 0.1)
+    assert np.count_nonzero(RobustWeights("trim", trim=0.8)(errors)) == 80
+    assert np.all(RobustWeights("tukey")(np.zeros(10)) == 1.0)
+    try:
+        RobustWeights("cauchy")
+        assert False, "unknown robust weights should be refused"
+    except ValueError:
+        pass
+
+    print("robust weights tests passed")
+
+
+def test_robust_icp():
+    # robust ICP lands on F_true although some samples are far off the surface
+    vertices, triangles = bumpy_surface()
+    tree = KDTreeTriangles(vertices, triangles, leaf_size=4)
+    rand = np.random.default_rng(25)
+    surface = mesh_samples(rand, vertices, triangles, 200)
+    surface[:20, 2] += rand.uniform(3.0, 6.0, 20) # readings far above the surface
+    d, F_true = rigid_samples(surface)
+
+    F_plain, _ = IcpRegistrar(d, tree).run()
+    plain_error = np.linalg.norm(F_plain - F_true)
+    for kind in RobustWeights.KINDS:
+        for options in [{}, {"anderson": 5}, {"method": "point_to_plane"}]:
+            registrar = IcpRegistrar(d, tree, robust=RobustWeights(kind, trim=0.8), **options)
+            F_reg, history = registrar.run()
+            assert registrar.converged, (kind, options)
+            assert np.linalg.norm(F_reg - F_true) < plain_error / 10, (kind, options)
+            assert registrar.weights.shape == (200,) and history[-1]["inliers"] == np.count_nonzero(registrar.weights)
+            if kind in ("trim", "threshold", "tukey"):
+                assert np.all(registrar.weights[:20] == 0.0)
+
+    print("robust icp tests passed")
+
+
+if __name__ == "__main__":
+    test_icp_registrar()
+    test_multi_resolution_registrar()
+    test_robust_weights()
+    test_robust_icp()
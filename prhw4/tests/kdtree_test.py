@@ -1,9 +1,16 @@
 import sys
 import os
+import tempfile
+import itertools
 import numpy as np
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from utils.kdtree import KDTreeTriangles
+from utils.kdtree import KDTreeTriangles, BVHTriangles, GridTriangles, DistanceFieldTriangles, MeshWalkTriangles, \
+    load_or_build_index, triangle_adjacency, morton_order, ParallelClosestPoints, \
+    QueryStats, decimate_mesh, MeshPyramid
+from utils.icp import find_closest_points, linear_search_closest_points_on_mesh, CorrespondenceCache, \
+    EpsilonSchedule
+from meshes import triangle_soup, height_field_mesh
 
 
 def test_triangle_kdtree():
@@ -43,5 +50,418 @@ def test_triangle_kdtree():
 
     print("kdtree tests passed")
 
+def test_kdtree_matches_linear_search():
+    # random triangle soup, every query should agree with brute force
+    rand = np.random.default_rng(3)
+    vertices, triangles = triangle_soup(rand, 60, 40)
+    queries = rand.random((25, 3)) * 14.0 - 2.0
+
+    for index_cls, leaf_size in itertools.product([KDTreeTriangles, BVHTriangles], [1, 4, 16]):
+        tree = index_cls(vertices, triangles, leaf_size=leaf_size)
+        leaves = tree.left < 0
+        assert tree.count[leaves].max() <= leaf_size
+        assert tree.count[leaves].sum() == len(triangles)
+        # every node's box covers its triangles, the root covers the mesh
+        tri_verts = vertices[triangles]
+        for node in range(tree.n_nodes):
+            node_verts = tri_verts[tree.tri_order[tree.start[node]:tree.start[node] + tree.count[node]]]
+            assert np.allclose(tree.bbox[node, 0], node_verts.min(axis=(0, 1)))
+            assert np.allclose(tree.bbox[node, 1], node_verts.max(axis=(0, 1)))
+
+        for p in queries:
+            _, dist, _ = tree.closest_point(p)
+            _, expected, _ = linear_search_closest_points_on_mesh(p, vertices, triangles)
+            assert np.isclose(dist, expected), f"Expected {expected}, got {dist}"
+
+        # batched queries must agree with the one-at-a-time search
+        closest, dists, tri_idxs = tree.closest_points(queries, batch_size=7)
+        for k, p in enumerate(queries):
+            expected_point, expected_dist, _ = tree.closest_point(p)
+            assert np.allclose(closest[k], expected_point), f"Expected {expected_point}, got {closest[k]}"
+            assert np.isclose(dists[k], expected_dist), f"Expected {expected_dist}, got {dists[k]}"
+            q = find_closest_points(p, vertices[triangles[tri_idxs[k:k + 1]]])
+            assert np.isclose(np.linalg.norm(p - q[0]), dists[k])
+
+    # uniform grid, automatic cell size and a fine grid that needs many shells
+    for cell_size in [None, 0.5]:
+        grid = GridTriangles(vertices, triangles, cell_size=cell_size)
+        closest, dists, tri_idxs = grid.closest_points(queries)
+        for k, p in enumerate(queries):
+            _, expected, _ = linear_search_closest_points_on_mesh(p, vertices, triangles)
+            assert np.isclose(dists[k], expected), f"Expected {expected}, got {dists[k]}"
+            assert np.isclose(np.linalg.norm(closest[k] - p), expected)
+        _, dist, _ = grid.closest_point(queries[0])
+        assert np.isclose(dist, dists[0])
+        # queries far outside of the grid only search the part of a shell that overlaps it
+        for p in [np.array([1e6, 5.0, 5.0]), np.array([-1e3, 2e3, -3e3])]:
+            _, expected, _ = linear_search_closest_points_on_mesh(p, vertices, triangles)
+            assert np.isclose(grid.closest_point(p)[1], expected)
+
+    # distance field, queries both inside and outside of its band
+    field = DistanceFieldTriangles(KDTreeTriangles(vertices, triangles), voxel_size=0.7, band=1.5)
+    closest, dists, _ = field.closest_points(queries)
+    for k, p in enumerate(queries):
+        _, expected, _ = linear_search_closest_points_on_mesh(p, vertices, triangles)
+        assert np.isclose(dists[k], expected), f"Expected {expected}, got {dists[k]}"
+    assert len(field.keys) > 0
+
+    print("kdtree linear search tests passed")
+
+def test_kdtree_save_load():
+    # a reloaded tree must answer queries exactly like the one that was saved
+    rand = np.random.default_rng(5)
+    vertices, triangles = triangle_soup(rand, 50, 30)
+    queries = rand.random((20, 3)) * 12.0 - 1.0
+    tree = KDTreeTriangles(vertices, triangles, leaf_size=4)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "tree.npz")
+        tree.save(path, mesh_hash="abc")
+        loaded = KDTreeTriangles.load(path, mesh_hash="abc")
+        for a, b in zip(tree.closest_points(queries), loaded.closest_points(queries)):
+            assert np.array_equal(a, b)
+
+        # index built for another mesh is refused
+        try:
+            KDTreeTriangles.load(path, mesh_hash="def")
+            assert False, "Expected a ValueError for a mismatched mesh hash"
+        except ValueError:
+            pass
+
+        # the cache helper builds once and reloads afterwards
+        mesh_path = os.path.join(tmp, "mesh.sur")
+        with open(mesh_path, "w") as f:
+            f.write("mesh")
+        first = load_or_build_index(mesh_path, vertices, triangles, tmp, leaf_size=4)
+        second = load_or_build_index(mesh_path, vertices, triangles, tmp, leaf_size=4)
+        assert np.array_equal(first.bbox, second.bbox)
+        assert len([f for f in os.listdir(tmp) if f.startswith("mesh-")]) == 1
+
+        # a half written file (run killed while saving) is rebuilt, not fatal
+        cached = os.path.join(tmp, [f for f in os.listdir(tmp) if f.startswith("mesh-")][0])
+        with open(cached, "rb") as f:
+            head = f.read(200)
+        with open(cached, "wb") as f:
+            f.write(head)
+        third = load_or_build_index(mesh_path, vertices, triangles, tmp, leaf_size=4)
+        assert np.array_equal(first.bbox, third.bbox)
+        assert np.array_equal(KDTreeTriangles.load(cached).bbox, first.bbox)
+        assert [f for f in os.listdir(tmp) if f.startswith("mesh-")] == [os.path.basename(cached)]
+
+    print("kdtree save/load tests passed")
+
+def test_warm_start_hints():
+    # any hint must give the same answer as a cold search, a good hint prunes more
+    rand = np.random.default_rng(11)
+    vertices, triangles = triangle_soup(rand, 80, 60)
+    queries = rand.random((40, 3)) * 12.0 - 1.0
+    tree = KDTreeTriangles(vertices, triangles, leaf_size=2)
+
+    cold_stats, warm_stats = {}, {}
+    closest, dists, tri_idxs = tree.closest_points(queries, stats=cold_stats)
+    for hints in [tri_idxs, rand.integers(0, len(triangles), len(queries))]:
+        hinted, hinted_dists, _ = tree.closest_points(queries, hints=hints, batch_size=7)
+        assert np.allclose(hinted, closest) and np.allclose(hinted_dists, dists)
+    tree.closest_points(queries, hints=tri_idxs, stats=warm_stats)
+    assert warm_stats["nodes_visited"] < cold_stats["nodes_visited"]
+    assert warm_stats["triangle_tests"] < cold_stats["triangle_tests"]
+
+    single_stats = {}
+    for k, p in enumerate(queries):
+        q, dist, _ = tree.closest_point(p, hint=tri_idxs[(k + 1) % len(queries)], stats=single_stats)
+        assert np.allclose(q, closest[k]) and np.isclose(dist, dists[k])
+    assert single_stats["triangle_tests"] >= len(queries)
+
+    grid = GridTriangles(vertices, triangles)
+    assert np.allclose(grid.closest_points(queries, hints=tri_idxs)[1], dists)
+    # every index takes the hint on single queries too, positionally or by name
+    field = DistanceFieldTriangles(tree, voxel_size=1.0, band=2.0)
+    for index in [tree, grid, field, MeshWalkTriangles(tree)]:
+        for k in [0, 5]:
+            hint = tri_idxs[(k + 1) % len(queries)]
+            assert np.isclose(index.closest_point(queries[k], hint)[1], dists[k])
+            assert np.isclose(index.closest_point(queries[k], hint=hint, stats={})[1], dists[k])
+
+    print("kdtree warm start tests passed")
+
+def test_correspondence_reuse():
+    # margins match a brute force runner up, and reusing correspondences while the
+    # samples drift gives exactly what searching every sample again gives
+    rand = np.random.default_rng(12)
+    vertices, triangles = triangle_soup(rand, 80, 60)
+    queries = rand.random((40, 3)) * 12.0 - 1.0
+    tree = KDTreeTriangles(vertices, triangles, leaf_size=4)
+
+    closest, dists, tri_idxs, margins = tree.closest_points_with_margin(queries, batch_size=7)
+    for k, p in enumerate(queries):
+        d = np.sort(np.linalg.norm(find_closest_points(p, vertices[triangles]) - p, axis=1))
+        assert np.isclose(dists[k], d[0]) and np.isclose(margins[k], d[1] - d[0])
+    hinted = tree.closest_points_with_margin(queries, hints=rand.integers(0, len(triangles), len(queries)))
+    assert np.allclose(hinted[3], margins)
+
+    cache = CorrespondenceCache(tree)
+    stats = {}
+    points = queries.copy()
+    for _ in range(30):
+        points = points + rand.normal(0.0, 0.02, points.shape)
+        reused = cache.closest_points(points, stats)
+        full = tree.closest_points_with_margin(points)
+        for a, b in zip(reused, full[:3]):
+            assert np.array_equal(a, b)
+    assert stats["reused"] > stats["searched"]
+
+    print("kdtree correspondence reuse tests passed")
+
+def test_mesh_walk():
+    # two triangles sharing the edge 1-2
+    adjacency = triangle_adjacency(np.array([[0, 1, 2], [2, 1, 3]]))
+    assert np.array_equal(adjacency, [[-1, 1, -1], [0, -1, -1]])
+    # neighbor columns from the mesh file win when they are filled in
+    given = np.array([[1, -1, -1], [0, -1, -1]])
+    assert np.array_equal(triangle_adjacency(np.array([[0, 1, 2], [2, 1, 3]]), given), given)
+
+    # gently curved height field (a walk only finds local optima, so no deep folds),
+    # queries drift above it and are tracked frame to frame
+    n = 12
+    vertices, triangles = height_field_mesh(n, 0.3)
+    tree = KDTreeTriangles(vertices, triangles, leaf_size=4)
+    walk = MeshWalkTriangles(tree)
+    assert np.all(np.sum(triangle_adjacency(triangles) >= 0, axis=1) >= 1)
+
+    rand = np.random.default_rng(13)
+    points = np.column_stack([rand.random((30, 2)) * (n - 1), rand.random(30) * 0.5 + 0.3])
+    stats = {}
+    _, _, tri_idxs = walk.closest_points(points, stats=stats)
+    assert stats["fallbacks"] == len(points)
+    for _ in range(10):
+        points = points + rand.normal(0.0, 0.05, points.shape)
+        closest, dists, tri_idxs = walk.closest_points(points, hints=tri_idxs, stats=stats)
+        expected, expected_dists, _ = tree.closest_points(points)
+        assert np.allclose(closest, expected) and np.allclose(dists, expected_dists)
+
+    print("kdtree mesh walk tests passed")
+
+def test_k_closest_and_radius():
+    # k nearest and radius queries agree with sorting every triangle's distance
+    rand = np.random.default_rng(14)
+    vertices, triangles = triangle_soup(rand, 80, 60)
+    queries = rand.random((25, 3)) * 12.0 - 1.0
+    radii = rand.random(25) * 3.0
+    for tree in [KDTreeTriangles(vertices, triangles, leaf_size=4), BVHTriangles(vertices, triangles, leaf_size=1)]:
+        closest, dists, tris = tree.k_closest_batch(queries, 5, batch_size=7)
+        q, hit_closest, hit_dists, hit_tris = tree.within_radius_batch(queries, radii, batch_size=7)
+        for j, p in enumerate(queries):
+            all_closest = find_closest_points(p, vertices[triangles])
+            all_dists = np.linalg.norm(all_closest - p, axis=1)
+            order = np.argsort(all_dists)
+            assert np.allclose(dists[j], all_dists[order[:5]])
+            assert np.allclose(closest[j], all_closest[tris[j]])
+            inside = np.flatnonzero(all_dists <= radii[j])
+            assert np.array_equal(np.sort(hit_tris[q == j]), inside)
+            assert np.all(np.diff(hit_dists[q == j]) >= 0)
+            assert np.allclose(hit_closest[q == j], all_closest[hit_tris[q == j]])
+
+        single_closest, single_dists, single_tris = tree.k_closest(queries[0], 100)
+        assert len(single_tris) == len(triangles) and np.all(np.diff(single_dists) >= 0)
+        assert np.array_equal(tree.within_radius(queries[0], radii[0])[2], hit_tris[q == 0])
+        for k in [0, -1]:
+            try:
+                tree.k_closest(queries[0], k)
+                assert False, "k < 1 should be refused"
+            except ValueError:
+                pass
+
+    print("kdtree k closest and radius tests passed")
+
+def test_epsilon_bound():
+    # approximate searches stay within a factor 1 + epsilon of the exact distance
+    rand = np.random.default_rng(16)
+    vertices, triangles = triangle_soup(rand, 80, 60)
+    queries = rand.random((40, 3)) * 30.0 - 10.0
+    tree = KDTreeTriangles(vertices, triangles, leaf_size=2)
+    _, exact, _ = tree.closest_points(queries)
+    for epsilon in [0.1, 0.5, 2.0]:
+        _, dists, _ = tree.closest_points(queries, epsilon=epsilon)
+        assert np.all(dists >= exact - 1e-12) and np.all(dists <= (1 + epsilon) * exact + 1e-12)
+        for p, d in zip(queries, exact):
+            _, dist, _ = tree.closest_point(p, epsilon=epsilon)
+            assert d - 1e-12 <= dist <= (1 + epsilon) * d + 1e-12
+
+    schedule = EpsilonSchedule(eps0=0.5, decay=0.5, min_eps=0.1)
+    assert [schedule(i) for i in range(4)] == [0.5, 0.25, 0.125, 0.0]
+    schedule.finish()
+    assert schedule(0) == 0.0
+
+    print("kdtree epsilon tests passed")
+
+def test_morton_order():
+    # Morton ordered searches return the same results in the caller's order
+    rand = np.random.default_rng(17)
+    vertices, triangles = triangle_soup(rand, 80, 60)
+    queries = rand.random((50, 3)) * 12.0 - 1.0
+    tree = KDTreeTriangles(vertices, triangles, leaf_size=4)
+    order = morton_order(queries)
+    assert np.array_equal(np.sort(order), np.arange(len(queries)))
+    assert np.array_equal(morton_order(np.array([[1, 1, 1], [0, 0, 0], [1, 0, 0], [0, 1, 0]])), [1, 2, 3, 0])
+
+    hints = rand.integers(0, len(triangles), len(queries))
+    for a, b in zip(tree.closest_points(queries, hints, batch_size=8),
+                    tree.closest_points(queries, hints, batch_size=8, morton=True)):
+        assert np.allclose(a, b)
+    margins = tree.closest_points_with_margin(queries)[3]
+    assert np.allclose(tree.closest_points_with_margin(queries, batch_size=8, morton=True)[3], margins)
+
+    print("kdtree morton order tests passed")
+
+def test_refit():
+    # a refit tree answers like a tree built on the moved vertices, scaling the mesh
+    # keeps the tree and scrambling it triggers a rebuild
+    n = 12
+    vertices, triangles = height_field_mesh(n, 0.3)
+    rand = np.random.default_rng(18)
+    queries = rand.random((30, 3)) * 12.0 - 1.0
+
+    for tree in [KDTreeTriangles(vertices, triangles, leaf_size=4), BVHTriangles(vertices, triangles, leaf_size=2)]:
+        for moved, rebuilt in [(vertices + rand.normal(0.0, 0.05, vertices.shape), False),
+                               (vertices * 3.0 + 1.0, False),
+                               (rand.permutation(vertices), True)]:
+            assert tree.refit(moved) == rebuilt
+            _, dists, _ = tree.closest_points(queries)
+            _, expected, _ = KDTreeTriangles(moved, triangles).closest_points(queries)
+            assert np.allclose(dists, expected)
+            for p, dist in zip(queries[:5], expected):
+                assert np.isclose(tree.closest_point(p)[1], dist)
+            lo, hi = tree.bbox[tree.root]
+            assert np.allclose(lo, moved.min(axis=0)) and np.allclose(hi, moved.max(axis=0))
+        assert np.isclose(tree.build_cost, tree.tree_cost())
+
+    # a loaded BVH rebuilds with the n_bins it was saved with
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bvh.npz")
+        BVHTriangles(vertices, triangles, leaf_size=2, n_bins=8).save(path)
+        loaded = BVHTriangles.load(path)
+        moved = rand.permutation(vertices)
+        assert loaded.n_bins == 8 and loaded.refit(moved)
+        _, expected, _ = KDTreeTriangles(moved, triangles).closest_points(queries)
+        assert np.allclose(loaded.closest_points(queries)[1], expected)
+
+    print("kdtree refit tests passed")
+
+def test_degenerate_triangles():
+    # triangles with repeated or collinear vertices are searched exactly like the
+    # others, single and batched queries agree with brute force
+    rand = np.random.default_rng(4)
+    vertices, triangles = triangle_soup(rand, 40, 30)
+    vertices[39] = 0.5 * (vertices[0] + vertices[1]) # collinear with 0 and 1
+    triangles = np.concatenate([triangles, [[0, 1, 1], [2, 2, 2], [0, 39, 1], [3, 3, 4]]])
+    queries = np.concatenate([rand.random((40, 3)) * 12.0 - 1.0, vertices[[0, 1, 2, 3, 39]] + 0.1])
+
+    for index_cls, leaf_size in itertools.product([KDTreeTriangles, BVHTriangles], [1, 4, 16]):
+        tree = index_cls(vertices, triangles, leaf_size=leaf_size)
+        closest, dists, _ = tree.closest_points(queries)
+        for k, p in enumerate(queries):
+            expected_point, expected, _ = linear_search_closest_points_on_mesh(p, vertices, triangles)
+            assert np.isfinite(expected)
+            point, dist, tri = tree.closest_point(p)
+            assert tri >= 0 and np.isclose(dist, expected), f"Expected {expected}, got {dist}"
+            assert np.isclose(dists[k], expected) and np.isclose(np.linalg.norm(closest[k] - p), expected)
+
+    # a mesh of nothing but degenerate triangles
+    tree = KDTreeTriangles(np.array([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0]]), np.array([[0, 1, 1], [1, 0, 0]]))
+    point, dist, tri = tree.closest_point(np.array([0.5, 1.0, 0.0]))
+    assert tri >= 0 and np.isclose(dist, 1.0) and np.allclose(point, [0.5, 0.0, 0.0])
+
+    print("kdtree degenerate triangle tests passed")
+
+def test_parallel_closest_points():
+    # workers attached to the shared tree arrays answer slices of a batch exactly like
+    # the tree itself, also when the slices don't divide the batch evenly
+    rand = np.random.default_rng(19)
+    vertices = rand.random((40, 3)) * 10.0
+    triangles = rand.integers(0, 40, (60, 3))
+    queries = rand.random((101, 3)) * 12.0 - 1.0
+
+    for tree in [KDTreeTriangles(vertices, triangles, leaf_size=4), BVHTriangles(vertices, triangles, leaf_size=2)]:
+        expected = tree.closest_points(queries)
+        with ParallelClosestPoints(tree, n_workers=2) as parallel:
+            for chunk_size in [None, 7]:
+                result = parallel.closest_points(queries, batch_size=16, chunk_size=chunk_size)
+                for a, b in zip(result, expected):
+                    assert np.array_equal(a, b)
+            assert len(parallel.closest_points(np.zeros((0, 3)))[1]) == 0
+
+    print("kdtree parallel query tests passed")
+
+def test_query_stats():
+    # counting doesn't change the answers, the per query counters add up to the
+    # totals and don't depend on which other queries share the batch
+    rand = np.random.default_rng(20)
+    vertices = rand.random((60, 3)) * 10.0
+    triangles = rand.integers(0, 60, (90, 3))
+    queries = rand.random((50, 3)) * 12.0 - 1.0
+    tree = KDTreeTriangles(vertices, triangles, leaf_size=4)
+    depth = len(tree._node_levels())
+
+    expected = tree.closest_points(queries)
+    stats, ordered = QueryStats(per_query=True), QueryStats(per_query=True)
+    result = tree.closest_points(queries, batch_size=16, stats=stats)
+    tree.closest_points(queries, stats=ordered, morton=True)
+    for a, b in zip(result, expected):
+        assert np.array_equal(a, b)
+    counts = stats.query_counts()
+    for name in ["nodes_visited", "nodes_pruned", "triangle_tests"]:
+        assert np.sum(counts[name]) == stats[name]
+        assert np.array_equal(counts[name], ordered.query_counts()[name])
+    assert stats["queries"] == len(queries) and stats["max_stack_depth"] == np.max(counts["max_stack_depth"]) <= depth
+    assert np.all(counts["nodes_pruned"] < counts["nodes_visited"]) and np.all(counts["triangle_tests"] > 0)
+
+    single, totals = QueryStats(per_query=True), {}
+    for p, dist in zip(queries, expected[1]):
+        assert np.isclose(tree.closest_point(p, stats=single)[1], dist)
+        tree.closest_point(p, stats=totals)
+    # counting and plain single queries run the same loop, same answers bit for bit
+    for k, p in enumerate(queries):
+        for hint, epsilon in [(-1, 0.0), (expected[2][(k + 3) % len(queries)], 0.0), (-1, 0.5)]:
+            plain = tree.closest_point(p, hint=hint, epsilon=epsilon)
+            counted = tree.closest_point(p, hint=hint, epsilon=epsilon, stats={})
+            assert np.array_equal(plain[0], counted[0]) and plain[1:] == counted[1:]
+    counts = single.query_counts()
+    assert len(counts["nodes_visited"]) == len(queries)
+    assert all(totals[name] == single[name] for name in single)
+    assert np.all(counts["nodes_pruned"] < counts["nodes_visited"]) and single["max_stack_depth"] <= depth + 1
+    assert "nodes visited" in single.report()
+
+    print("kdtree query stats tests passed")
+
+def test_mesh_pyramid():
+    # decimated levels get smaller and stay on the surface
+    vertices, triangles = height_field_mesh(33, 2.0, fx=0.8, fy=0.6, extent=15.0)
+    tree = KDTreeTriangles(vertices, triangles, leaf_size=4)
+
+    coarse_vertices, coarse_triangles = decimate_mesh(vertices, triangles, 1.0)
+    assert len(coarse_triangles) < len(triangles) and coarse_triangles.max() == len(coarse_vertices) - 1
+    assert np.all(coarse_triangles[:, 0] != coarse_triangles[:, 1])
+    pyramid = MeshPyramid(tree, n_levels=3)
+    assert len(pyramid) == 3 and pyramid.levels[0] is tree
+    sizes = [len(level.triangles) for level in pyramid.levels]
+    assert sizes[0] > sizes[1] > sizes[2]
+    _, dists, _ = tree.closest_points(pyramid.levels[2].vertices)
+    assert np.max(dists) < 0.5
+
+    print("mesh pyramid tests passed")
+
 if __name__ == "__main__":
     test_triangle_kdtree()
+    test_kdtree_matches_linear_search()
+    test_kdtree_save_load()
+    test_warm_start_hints()
+    test_correspondence_reuse()
+    test_mesh_walk()
+    test_k_closest_and_radius()
+    test_epsilon_bound()
+    test_morton_order()
+    test_refit()
+    test_degenerate_triangles()
+    test_parallel_closest_points()
+    test_query_stats()
+    test_mesh_pyramid()
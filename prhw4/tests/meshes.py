@@ -0,0 +1,45 @@
+import numpy as np
+
+# Small meshes and sample clouds shared by the test files
+
+
+def triangle_soup(rand, n_vertices, n_triangles, scale=10.0):
+    # random vertices in a scale sized cube and triangles over 3 distinct ones of them
+    vertices = rand.random((n_vertices, 3)) * scale
+    triangles = np.array([rand.choice(n_vertices, 3, replace=False) for _ in range(n_triangles)])
+    return vertices, triangles
+
+
+def height_field_mesh(n, amplitude, fx=1.0, fy=1.0, extent=None):
+    # n x n grid over [0, extent]^2 (extent defaults to n - 1, unit spacing) split
+    # into two triangles per cell, z = amplitude * sin(fx * x) * cos(fy * y)
+    extent = n - 1 if extent is None else extent
+    x, y = np.meshgrid(np.linspace(0.0, extent, n), np.linspace(0.0, extent, n))
+    x, y = x.ravel(), y.ravel()
+    vertices = np.stack([x, y, amplitude * np.sin(fx * x) * np.cos(fy * y)], axis=1)
+    ids = np.arange(n * n).reshape(n, n)
+    a, b, c, d = ids[:-1, :-1].ravel(), ids[:-1, 1:].ravel(), ids[1:, :-1].ravel(), ids[1:, 1:].ravel()
+    triangles = np.concatenate([np.stack([a, b, d], axis=1), np.stack([a, d, c], axis=1)])
+    return vertices, triangles
+
+
+def bumpy_surface():
+    # the height field the ICP tests register onto, bumpy enough that samples
+    # can't slide along it
+    return height_field_mesh(16, 2.0, fx=0.8, fy=0.6)
+
+
+def mesh_samples(rand, vertices, triangles, n_points):
+    # uniformly weighted random points on random triangles of the mesh
+    tris = rand.integers(0, len(triangles), n_points)
+    w = rand.dirichlet(np.ones(3), n_points)
+    return np.einsum('ij,ijk->ik', w, vertices[triangles[tris]])
+
+
+def rigid_samples(points, angle=0.03, translation=(0.2, -0.1, 0.05)):
+    # F_true, a rotation by angle about z followed by translation, and
+    # d = F_true^-1 * points, so F_true registers d back onto the points
+    F_true = np.eye(4)
+    F_true[:3, :3] = [[np.cos(angle), -np.sin(angle), 0.0], [np.sin(angle), np.cos(angle), 0.0], [0.0, 0.0, 1.0]]
+    F_true[:3, 3] = translation
+    return (points - F_true[:3, 3]) @ F_true[:3, :3], F_true
@@ -0,0 +1,41 @@
+import sys
+import os
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from utils import pcr
+
+
+def test_weighted_registration():
+    # weighted solves match the plain ones for equal weights and ignore zero weighted
+    # points, point to plane without weights is the same as with all ones
+    rand = np.random.default_rng(25)
+    a = rand.random((50, 3)) * 10.0
+    F_true = pcr.se3_exp(np.array([0.1, -0.2, 0.05, 1.0, 2.0, -0.5]))
+    b = a @ F_true[:3, :3].T + F_true[:3, 3]
+    assert np.allclose(pcr.weighted_point_cloud_registration(a, b, np.full(50, 0.3)), pcr.point_cloud_registration(a, b))
+    b_bad = b.copy()
+    b_bad[:5] += 20.0
+    weights = np.ones(50)
+    weights[:5] = 0.0
+    assert np.allclose(pcr.weighted_point_cloud_registration(a, b_bad, weights), F_true)
+
+    normals = rand.normal(size=(50, 3))
+    normals /= np.linalg.norm(normals, axis=1)[:, None]
+    assert np.allclose(pcr.point_to_plane_registration(a, b, normals, np.ones(50)),
+                       pcr.point_to_plane_registration(a, b, normals))
+
+    print("weighted registration tests passed")
+
+
+def test_se3_round_trip():
+    # twists survive exp and log, also at angles small enough for the series
+    for xi in [np.zeros(6), np.array([1e-6, -2e-6, 3e-6, 1.0, 2.0, 3.0]), np.array([0.3, -1.2, 2.0, -4.0, 0.5, 7.0])]:
+        assert np.allclose(pcr.se3_log(pcr.se3_exp(xi)), xi, atol=1e-12)
+
+    print("se3 tests passed")
+
+
+if __name__ == "__main__":
+    test_weighted_registration()
+    test_se3_round_trip()
@@ -1,4 +1,6 @@
+import time
 import numpy as np
+from utils import pcr as pcr
 
 def project_on_segment(c, p, q):
 
@@ -39,45 +41,472 @@ def find_closest_point(a, p, q, r):
     return project_on_segment(c, q, r)
 
 
-def linear_search_closest_points_on_mesh(p, vertices, triangles):
-    min_dist = np.inf
-    q_closest = None
-    tri_index = -1
+# Column layout of the packed rows returned by triangle_geometry. Keeping all
+# of a triangle's terms in one row means a query gathers them with one index
+GEOM_COLUMNS = {"p": slice(0, 3), "qp": slice(3, 6), "rp": slice(6, 9),
+                "normal": slice(9, 12), "edge_len2": slice(12, 15),
+                "d00": 15, "d01": 16, "d11": 17, "inv_det": 18}
+GEOM_WIDTH = 19
+
+def triangle_geometry(tris):
+
+    # Everything the closest point kernel needs that only depends on the
+    # triangle, tris is (M,3,3) with rows p, q, r. Returns an (M, GEOM_WIDTH)
+    # array, meant to be computed once per mesh and indexed per query instead
+    # of being rebuilt on every call
+    tris = np.asarray(tris, dtype=float)
+    p, q, r = tris[:, 0], tris[:, 1], tris[:, 2]
+
+    # Edge vectors
+    qp = q - p
+    rp = r - p
+
+    # Normal-equation terms of the barycentric solve (slide 11)
+    d00 = np.sum(qp * qp, axis=1)
+    d01 = np.sum(qp * rp, axis=1)
+    d11 = np.sum(rp * rp, axis=1)
+    det = d00 * d11 - d01 * d01
+    inv_det = np.divide(1.0, det, out=np.zeros_like(det), where=det != 0) # 0 for degenerate triangles
+
+    normal = np.cross(qp, rp)
+    norm = np.linalg.norm(normal, axis=1, keepdims=True)
+    normal = np.divide(normal, norm, out=np.zeros_like(normal), where=norm != 0)
+
+    # Squared edge lengths of pq, pr and qr
+    edge_len2 = np.column_stack((d00, d11, d00 - 2 * d01 + d11))
+
+    geom = np.empty((len(tris), GEOM_WIDTH))
+    for key, value in (("p", p), ("qp", qp), ("rp", rp), ("normal", normal), ("edge_len2", edge_len2),
+                       ("d00", d00), ("d01", d01), ("d11", d11), ("inv_det", inv_det)):
+        geom[:, GEOM_COLUMNS[key]] = value
+    return geom
+
+def closest_points_from_geometry(a, geom):
+
+    # Vectorized closed-form closest point, a is (M,3) (or a single (3,) point
+    # shared by every triangle) and geom holds the triangle_geometry rows of
+    # the M triangles. Instead of solving the least-squares problem, the
+    # Voronoi region of the triangle that a falls in is found from a handful
+    # of dot products and a is projected onto the matching vertex, edge or face
+    cols = GEOM_COLUMNS
+    p, qp, rp = geom[:, cols["p"]], geom[:, cols["qp"]], geom[:, cols["rp"]]
+    d00, d01, d11 = geom[:, cols["d00"]], geom[:, cols["d01"]], geom[:, cols["d11"]]
+    edge_len2, inv_det = geom[:, cols["edge_len2"]], geom[:, cols["inv_det"]]
+    a = np.broadcast_to(np.asarray(a, dtype=float), p.shape)
+    ap = a - p
+
+    # Only two dot products depend on the query, the four others follow
+    # from the precomputed ones (e.g. qp . (a - q) = qp . (a - p) - qp . qp)
+    d1 = np.sum(qp * ap, axis=1)
+    d2 = np.sum(rp * ap, axis=1)
+    d3 = d1 - d00
+    d4 = d2 - d01
+    d5 = d1 - d01
+    d6 = d2 - d11
+
+    # Signed areas that decide the edge regions, the sum is |qp x rp|^2
+    va = d3 * d6 - d5 * d4
+    vb = d5 * d2 - d1 * d6
+    vc = d1 * d4 - d3 * d2
 
-    # Simple linear search over all triangles
-    for i, tri in enumerate(triangles): 
-        q = find_closest_point(p, vertices[tri[0]], vertices[tri[1]], vertices[tri[2]])
-        dist = np.linalg.norm(p - q)
-        if dist < min_dist:
-            min_dist = dist
-            q_closest = q
-            tri_index = i
+    closest = np.empty_like(ap)
+    # Rows whose region is not decided yet. Degenerate triangles (collinear or
+    # repeated vertices, inv_det = 0) have no regions, they are done at the end
+    flat = inv_det == 0
+    left = ~flat
 
-    return q_closest, min_dist, tri_index
+    # Vertex p region
+    m = left & (d1 <= 0) & (d2 <= 0)
+    closest[m] = p[m]
+    left &= ~m
+
+    # Vertex q region
+    m = left & (d3 >= 0) & (d4 <= d3)
+    closest[m] = p[m] + qp[m]
+    left &= ~m
+
+    # Edge pq region
+    m = left & (vc <= 0) & (d1 >= 0) & (d3 <= 0)
+    t = d1[m] / edge_len2[m, 0]
+    closest[m] = p[m] + t[:, None] * qp[m]
+    left &= ~m
+
+    # Vertex r region
+    m = left & (d6 >= 0) & (d5 <= d6)
+    closest[m] = p[m] + rp[m]
+    left &= ~m
+
+    # Edge pr region
+    m = left & (vb <= 0) & (d2 >= 0) & (d6 <= 0)
+    t = d2[m] / edge_len2[m, 1]
+    closest[m] = p[m] + t[:, None] * rp[m]
+    left &= ~m
+
+    # Edge qr region
+    m = left & (va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0)
+    t = (d4[m] - d3[m]) / edge_len2[m, 2]
+    closest[m] = p[m] + qp[m] + t[:, None] * (rp[m] - qp[m])
+    left &= ~m
+
+    # Interior, barycentric coords come straight from the signed areas
+    lam = vb[left] * inv_det[left]
+    mu = vc[left] * inv_det[left]
+    closest[left] = p[left] + lam[:, None] * qp[left] + mu[:, None] * rp[left]
+
+    # A degenerate triangle is the union of its edges, take the nearest of them
+    if np.any(flat):
+        a_f, p_f, qp_f, rp_f = a[flat], p[flat], qp[flat], rp[flat]
+        best = None
+        for start, edge in ((p_f, qp_f), (p_f, rp_f), (p_f + qp_f, rp_f - qp_f)):
+            c = closest_points_on_segments(a_f, start, edge)
+            dist2 = np.sum((c - a_f) ** 2, axis=1)
+            if best is None:
+                best, best_dist2 = c, dist2
+            else:
+                nearer = dist2 < best_dist2
+                best[nearer], best_dist2[nearer] = c[nearer], dist2[nearer]
+        closest[flat] = best
+    return closest
+
+def closest_points_on_segments(a, start, edge):
+
+    # Vectorized project_on_segment onto the segments start + t * edge, t in [0, 1],
+    # zero length segments are single points
+    len2 = np.sum(edge * edge, axis=1)
+    t = np.divide(np.sum((a - start) * edge, axis=1), len2, out=np.zeros_like(len2), where=len2 > 0)
+    return start + np.clip(t, 0.0, 1.0)[:, None] * edge
+
+def find_closest_points(a, tris):
+
+    # Vectorized find_closest_point, a is (M,3) (or a single (3,) point
+    # shared by every triangle) and tris is (M,3,3) with rows p, q, r
+    return closest_points_from_geometry(a, triangle_geometry(tris))
+
+
+def linear_search_closest_points_on_mesh(p, vertices, triangles):
+    # Simple linear search over all triangles, tested together
+    q = find_closest_points(p, vertices[triangles])
+    dists = np.linalg.norm(q - p, axis=1)
+    tri_index = np.argmin(dists)
+
+    return q[tri_index], dists[tri_index], tri_index
 
 def ktree_search_closest_points_on_mesh(p, vertices, triangles, tree, centroids, k=10):
-    # Query k nearest triangle centroids to point p
+    # Query k nearest triangle centroids to point p. Approximate, the nearest centroids
+    # need not belong to the nearest triangle (KDTreeTriangles.k_closest is exact)
     dists, idxs = tree.query(p, k=k)  # can return single or array of indices
     if np.isscalar(idxs):
         idxs = [idxs]
 
     # Search only these triangles
-    min_dist = np.inf
-    q_closest = None
-    tri_index = -1
-
-    for i in idxs:
-        tri = triangles[i]
-        q = find_closest_point(p, vertices[tri[0]], vertices[tri[1]], vertices[tri[2]])
-        dist = np.linalg.norm(p - q)
-        if dist < min_dist:
-            min_dist = dist
-            q_closest = q
-            tri_index = i
-
-    return q_closest, min_dist, tri_index
+    idxs = np.asarray(idxs)
+    q = find_closest_points(p, vertices[triangles[idxs]])
+    dists = np.linalg.norm(q - p, axis=1)
+    best = np.argmin(dists)
+
+    return q[best], dists[best], idxs[best]
     
 
+class CorrespondenceCache:
+    # Exact reuse of closest point searches between ICP iterations. Each sample keeps
+    # the point it was last searched from (its anchor), its nearest triangle and the
+    # margin to the runner up triangle. A sample that moved by delta from its anchor
+    # is at most d1 + delta from that triangle and at least d2 - delta from any other,
+    # so while 2 * delta < margin the nearest triangle cannot have changed and only
+    # the closest point on it is recomputed. The other samples are searched again.
+    # Results are identical to tree.closest_points_with_margin on every sample
+    def __init__(self, tree, slack=1e-9):
+        self.tree = tree
+        self.slack = slack # keeps rounding in the distances from deciding a near tie
+        self.anchors = None
+        self.tris = None
+        self.margins = None
+
+    def closest_points(self, points, stats=None):
+        # same returns as tree.closest_points. stats (a dict) collects how many
+        # samples were searched and how many reused, and the tree counts its
+        # searches into it too
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        n = len(points)
+        if self.anchors is None or len(self.anchors) != n:
+            self.anchors = points.copy()
+            self.tris = np.full(n, -1, dtype=np.int64)
+            self.margins = np.full(n, -np.inf)
+        shift = np.linalg.norm(points - self.anchors, axis=1)
+        stale = 2 * shift + self.slack >= self.margins
+
+        closest = np.zeros((n, 3))
+        if np.any(stale):
+            closest[stale], _, self.tris[stale], self.margins[stale] = \
+                self.tree.closest_points_with_margin(points[stale], stats=stats)
+            self.anchors[stale] = points[stale]
+        kept = ~stale
+        closest[kept] = closest_points_from_geometry(points[kept], self.tree.triangle_geometry(self.tris[kept]))
+        dists = np.linalg.norm(closest - points, axis=1)
+
+        if stats is not None:
+            stats["searched"] = stats.get("searched", 0) + int(np.sum(stale))
+            stats["reused"] = stats.get("reused", 0) + int(np.sum(kept))
+        return closest, dists, self.tris.copy()
+
+
+class EpsilonSchedule:
+    # Tolerance of the (1+eps) approximate closest point search for each ICP iteration,
+    # so the early coarse iterations search loosely and the last ones exactly. Starts
+    # at eps0 and shrinks by decay every iteration, dropping to exact (0) once below
+    # min_eps or once finish() is called. A driver that would stop on approximate
+    # correspondences calls finish() and iterates on, so it always converges on
+    # exact closest points
+    def __init__(self, eps0=0.5, decay=0.5, min_eps=1e-2):
+        self.eps0 = eps0
+        self.decay = decay
+        self.min_eps = min_eps
+        self.exact = False
+
+    def __call__(self, iteration):
+        eps = 0.0 if self.exact else self.eps0 * self.decay ** iteration
+        return eps if eps >= self.min_eps else 0.0
+
+    def finish(self):
+        self.exact = True
+
+
+class RobustWeights:
+    # Weights of the samples in the ICP update from their current closest point
+    # distances, all at once, so a few bad readings stop pulling F_reg. kind is
+    #   "trim": the fraction trim of the samples with the smallest errors count, the rest not
+    #   "threshold": samples within k * median error count, the rest not
+    #   "huber": 1 within k * median error, falling off as c / e beyond it
+    #   "tukey": (1 - (e / c)^2)^2 within c = k * median error, 0 beyond it
+    # The median makes the cut follow the errors down as ICP converges. k defaults
+    # per kind (DEFAULT_K). All weights are 1 once the median error is 0.
+    # IcpRegistrar keeps the weights fixed once F_reg changes by less than
+    # freeze_tol, samples flipping in and out of a cut would keep it from settling
+    KINDS = ("trim", "threshold", "huber", "tukey")
+    DEFAULT_K = {"threshold": 3.0, "huber": 2.0, "tukey": 6.0}
+
+    def __init__(self, kind="huber", k=None, trim=0.9, min_points=6, freeze_tol=1e-3):
+        if kind not in self.KINDS:
+            raise ValueError(f"Unknown robust weights {kind}, expected one of {self.KINDS}")
+        self.kind = kind
+        self.k = self.DEFAULT_K.get(kind) if k is None else k
+        self.trim = trim
+        self.min_points = min_points # never down to fewer samples than a solve needs
+        self.freeze_tol = freeze_tol
+
+    def __call__(self, errors):
+        errors = np.asarray(errors, dtype=float)
+        n = len(errors)
+        if self.kind == "trim":
+            keep = min(n, max(self.min_points, int(np.ceil(self.trim * n))))
+            weights = np.zeros(n)
+            weights[np.argpartition(errors, keep - 1)[:keep]] = 1.0
+            return weights
+        c = self.k * np.median(errors)
+        if c <= 0:
+            return np.ones(n)
+        if self.kind == "threshold":
+            weights = (errors <= c).astype(float)
+        elif self.kind == "huber":
+            weights = c / np.maximum(errors, c)
+        else:
+            weights = np.square(1.0 - np.square(np.minimum(errors / c, 1.0)))
+        if np.count_nonzero(weights) < self.min_points:
+            return np.ones(n)
+        return weights
+
+
+class IcpRegistrar:
+    # Iterative closest point registration of the points d to a mesh index (anything
+    # with the closest_points contract of KDTreeTriangles). run() batches each
+    # iteration over all samples: s = F_reg * d, their closest points on the mesh,
+    # then the updated F_reg, until F_reg barely changes or the mean error is tiny.
+    # The search at the final F_reg is kept as the result (s, closest, errors, tris
+    # and weights), nothing is searched again for the output
+    METHODS = ("point_to_point", "point_to_plane")
+
+    def __init__(self, d, mesh, max_iters=100, tol_F=1e-6, tol_error=1e-5,
+                 reuse_correspondences=False, epsilon_schedule=None, stats=None, method="point_to_point",
+                 anderson=0, robust=None):
+        if method not in self.METHODS:
+            raise ValueError(f"Unknown ICP method {method}, expected one of {self.METHODS}")
+        if anderson > 0 and method != "point_to_point":
+            raise ValueError("Anderson acceleration is only supported for point_to_point updates")
+        self.d = np.asarray(d, dtype=float).reshape(-1, 3)
+        self.mesh = mesh
+        self.max_iters = max_iters
+        self.tol_F = tol_F # stop once F_reg changes by less than this
+        self.tol_error = tol_error # or once the mean error is below this
+        # later searches only redo the samples whose triangle may have changed (tree only)
+        self.cache = CorrespondenceCache(mesh) if reuse_correspondences else None
+        self.schedule = epsilon_schedule # EpsilonSchedule, approximate early searches (tree only)
+        self.stats = stats # handed to every search
+        # "point_to_point" registers d onto the closest points, "point_to_plane" onto the
+        # planes of the matched triangles, the samples slide along the surface and it
+        # takes far fewer iterations near convergence
+        self.method = method
+        # > 0 extrapolates F_reg from that many past updates (Anderson acceleration in
+        # twist coordinates), an extrapolated F_reg that raises the error is thrown away
+        # for the plain update. Same fixed point, point_to_point only (it overshoots the
+        # already fast point_to_plane steps)
+        self.anderson = anderson
+        self._chart = None # Anderson twists are taken relative to this F, see _accelerate
+        # RobustWeights, weighs the samples in every update by their current errors so
+        # outlying readings barely move F_reg
+        self.robust = robust
+        self.converged = False
+        self.s = self.closest = self.errors = self.tris = self.weights = None
+
+    def run(self, F_init=None):
+        # Returns F_reg and the per iteration stats, one dict per closest point search
+        # with its mean and max error, epsilon, time, and delta_F (change of the
+        # plain update, the last search has none). With anderson, "accelerated"
+        # tells whether the next F_reg was extrapolated and "rejected" marks the
+        # searches whose accelerated F_reg was thrown away. With robust, "inliers"
+        # counts the samples with a nonzero weight
+        F_reg = np.eye(4) if F_init is None else np.asarray(F_init, dtype=float)
+        tris = None
+        history = []
+        self.converged = False
+        F_plain = None # plain update behind an accelerated F_reg, the fallback
+        last_error = np.inf
+        mixing = [] # Anderson history of (update, residual) twists
+        weights, frozen = None, False
+        for it in range(self.max_iters + 1):
+            start = time.perf_counter()
+            s = self.d @ F_reg[:3, :3].T + F_reg[:3, 3]
+            epsilon = self.schedule(it) if self.schedule is not None and it < self.max_iters else 0.0
+            closest, errors, tris = self._search(s, tris, epsilon)
+            entry = {"iteration": it, "mean_error": float(np.mean(errors)), "max_error": float(np.max(errors)),
+                     "epsilon": epsilon}
+            history.append(entry)
+            # judged by the (weighted) squared errors the last update minimized
+            error = float(np.mean(errors ** 2 if weights is None else weights * errors ** 2))
+            if F_plain is not None and error > last_error and it < self.max_iters:
+                # the extrapolation overshot: take the plain update and start mixing over
+                entry["rejected"] = True
+                F_reg, F_plain = F_plain, None
+                mixing.clear()
+                entry["time"] = time.perf_counter() - start
+                continue
+            if self.robust is not None:
+                if not frozen:
+                    weights = self.robust(errors)
+                    error = float(np.mean(weights * errors ** 2))
+                entry["inliers"] = int(np.count_nonzero(weights))
+            if self.converged or it == self.max_iters:
+                entry["time"] = time.perf_counter() - start
+                break
+
+            last_error = error
+            F_reg_new = self._update(F_reg, s, closest, tris, weights)
+            entry["delta_F"] = float(np.linalg.norm(F_reg_new - F_reg))
+            F_plain = None
+            if self.robust is not None and entry["delta_F"] < self.robust.freeze_tol:
+                frozen = True
+            if entry["delta_F"] < self.tol_F or entry["mean_error"] < self.tol_error:
+                if epsilon > 0:
+                    # approximate correspondences, only stop once they are exact
+                    self.schedule.finish()
+                else:
+                    self.converged = True
+            elif self.anderson > 0:
+                F_next = self._accelerate(F_reg, F_reg_new, mixing)
+                entry["accelerated"] = F_next is not F_reg_new
+                if entry["accelerated"]:
+                    F_plain, F_reg_new = F_reg_new, F_next
+            F_reg = F_reg_new
+            entry["time"] = time.perf_counter() - start
+
+        self.s, self.closest, self.errors, self.tris, self.weights = s, closest, errors, tris, weights
+        return F_reg, history
+
+    def _update(self, F_reg, s, closest, tris, weights=None):
+        if self.method == "point_to_plane":
+            normals = self.mesh.tri_geom[tris, GEOM_COLUMNS["normal"]]
+            return pcr.point_to_plane_registration(s, closest, normals, weights) @ F_reg
+        if weights is not None:
+            return pcr.weighted_point_cloud_registration(self.d, closest, weights)
+        return pcr.point_cloud_registration(self.d, closest)
+
+    def _accelerate(self, F_reg, F_reg_new, mixing):
+        # Anderson mixing (type II) of the last updates G_i = update(F_i) with their
+        # residuals f_i = G_i - F_i, all as twists in a chart around the first F of
+        # the history (so the logs stay far from rotations by pi). Picks the
+        # combination of the past updates whose residuals cancel the most
+        if not mixing:
+            self._chart = np.linalg.inv(F_reg)
+        x = pcr.se3_log(F_reg @ self._chart)
+        g = pcr.se3_log(F_reg_new @ self._chart)
+        mixing.append((g, g - x))
+        del mixing[:-(self.anderson + 1)]
+        if len(mixing) < 2:
+            return F_reg_new
+        G, R = (np.array(column) for column in zip(*mixing))
+        dG, dR = np.diff(G, axis=0).T, np.diff(R, axis=0).T
+        gamma, _, _, _ = np.linalg.lstsq(dR, R[-1], rcond=None)
+        return pcr.se3_exp(g - dG @ gamma) @ np.linalg.inv(self._chart)
+
+    def _search(self, s, tris, epsilon):
+        if epsilon > 0:
+            return self.mesh.closest_points(s, hints=tris, stats=self.stats, epsilon=epsilon)
+        if self.cache is not None:
+            return self.cache.closest_points(s, self.stats)
+        return self.mesh.closest_points(s, hints=tris, stats=self.stats)
+
+
+class MultiResolutionRegistrar:
+    # Coarse to fine ICP over a kdtree.MeshPyramid. An IcpRegistrar runs on every
+    # level, coarsest first, each one starting from the F_reg the level before
+    # ended with. The coarse levels only have to bring F_reg near, they stop once it
+    # changes by less than coarse_tol_F or after coarse_max_iters; the full mesh then
+    # converges with the usual tolerances, so the result is what an IcpRegistrar on
+    # the full mesh finds, after fewer of its (expensive) iterations. Pays off on big
+    # meshes and far starts, and only with a full mesh update that converges fast
+    # once near (anderson or point_to_plane), the slow tail of plain point to point
+    # ICP stays.
+    # options go to every level's IcpRegistrar, except epsilon_schedule which only
+    # the full mesh uses. Results (s, closest, errors, tris, converged) are the
+    # full mesh level's (and weights, with robust)
+    def __init__(self, d, pyramid, coarse_tol_F=1e-2, coarse_max_iters=20, **options):
+        self.d = d
+        self.pyramid = pyramid
+        self.coarse_tol_F = coarse_tol_F
+        self.coarse_max_iters = coarse_max_iters
+        self.options = options
+        self.levels = []
+        self.converged = False
+        self.s = self.closest = self.errors = self.tris = self.weights = None
+
+    def run(self, F_init=None):
+        # Returns F_reg and the searches of all levels (IcpRegistrar.run history with
+        # the level added to each entry, coarsest first). self.levels gets one dict
+        # per level: level, triangles, iterations, time and final mean_error
+        F_reg = F_init
+        history = []
+        self.levels = []
+        for level in reversed(range(len(self.pyramid.levels))):
+            options = dict(self.options)
+            if level > 0:
+                options["tol_F"] = max(options.get("tol_F", 1e-6), self.coarse_tol_F)
+                options["max_iters"] = min(options.get("max_iters", 100), self.coarse_max_iters)
+                options.pop("epsilon_schedule", None)
+            start = time.perf_counter()
+            registrar = IcpRegistrar(self.d, self.pyramid.levels[level], **options)
+            F_reg, level_history = registrar.run(F_reg)
+            for entry in level_history:
+                entry["level"] = level
+            history += level_history
+            self.levels.append({"level": level, "triangles": len(self.pyramid.levels[level].triangles),
+                                "iterations": len(level_history) - 1, "time": time.perf_counter() - start,
+                                "mean_error": float(np.mean(registrar.errors))})
+
+        self.converged = registrar.converged
+        self.s, self.closest, self.errors, self.tris = registrar.s, registrar.closest, registrar.errors, registrar.tris
+        self.weights = registrar.weights
+        return F_reg, history
+
+
 def test_closest_point_on_triangle():
     # Define simple triangle
     p = np.array([0., 0., 0.])
@@ -1,99 +1,1390 @@
+import hashlib
+import math
+import os
+import zipfile
+import multiprocessing
+from multiprocessing import shared_memory
 import numpy as np
 from utils import icp as icp
 
-def point_bbox_distance(p, bbox_min, bbox_max):
-    # helper function to find distance from query point to a given bounding box
-    # if distance to bounding box is negative, the point is inside bounding box
-    # so definitely want to go there, set distance to 0
-    d = np.maximum(0.0, np.maximum(bbox_min - p, p - bbox_max))
-    return np.linalg.norm(d)
-
-class KDTreeNode:
-    def __init__(self, tri_idx, point=None, left=None, right=None, axis=0, bbox_min=None, bbox_max=None):
-        self.tri_idx = tri_idx # index of the triangle stored at this node
-        self.point = point # centroid of the triangle
-        self.left = left # node that is on the left of the current node
-        self.right = right # node that is on the right side of the current node
-        self.axis = axis # the axis in which the current node's children are split by
-        # we can define a triangle's bounding box with the two opposing corners of the triangle
-        self.bbox_min = bbox_min
-        self.bbox_max = bbox_max
+# bumped whenever the saved array layout changes, older index files are rebuilt
+INDEX_VERSION = 1
+# every array needed to answer queries without rebuilding the tree
+INDEX_ARRAYS = ("vertices", "triangles", "tri_bbox_min", "tri_bbox_max", "centroids", "tri_geom",
+                "left", "right", "axis", "split", "start", "count", "bbox", "tri_order")
 
 class KDTreeTriangles:
-    def __init__(self, vertices, triangles):
+    # build settings besides leaf_size that save keeps, so a loaded tree rebuilds
+    # (refit) the same way the saved one would
+    BUILD_OPTIONS = ()
+
+    def __init__(self, vertices, triangles, leaf_size=16):
         # vertices and their indices will initially correspond
         self.vertices = vertices # [N_vertices,3] (x,y,z) coordinates of each vertex in the triangle mesh
         self.triangles = triangles # [N_triangles,3] indices of each vertex grouped by triangle
+        self.leaf_size = leaf_size # max number of triangles stored in a leaf
+        tri_verts = vertices[triangles]
         # find bounding boxes for each triangle
-        self.tri_bbox_min = np.min(vertices[triangles], axis=1) # component-wise min. vertex of each triangle
-        self.tri_bbox_max = np.max(vertices[triangles], axis=1) # component-wise max vertex of each triangle
-        self.centroids = np.mean(vertices[triangles], axis=1) # array of centroids for each triangle
-        self.root = self.build_kdtree(np.arange(len(triangles)))
-
-    def build_kdtree(self, tri_indices, depth=0):
-        if len(tri_indices) == 0:
-            return None
-        axis = depth % 3
-
-        # find the indices that would sort the triangles by the 
-        # location of their centroids along the given axis
-        sorted_idx = np.argsort(self.centroids[tri_indices, axis])
-        tri_indices = tri_indices[sorted_idx] # tri_indices is now in sorted order
-         # find the median triangle along the given axis and its centroid
-        median_idx = len(tri_indices) // 2
-        median_tri = tri_indices[median_idx]
-        centroid = self.centroids[median_tri]
-
-        # find the bounding box for this node (will cover itself and all of its children)
-        # Note: the root node's bounding box will encompass the entire mesh.
-        bbox_min = np.min(self.tri_bbox_min[tri_indices], axis=0)
-        bbox_max = np.max(self.tri_bbox_max[tri_indices], axis=0)
-
-        # make the leaf
-        if len(tri_indices) == 1:
-            return KDTreeNode(list(tri_indices), centroid, None, None, axis, bbox_min, bbox_max)
-
-        # recursively build the tree by splitting the triangles along the median
-        # choose axis to split along by round robin. found experimentally to
-        # work well enough for the given data, likely because the points on
-        # the meshes are evenly distributed w.r.t each axis
-        left = self.build_kdtree(tri_indices[:median_idx], depth + 1)
-        right = self.build_kdtree(tri_indices[median_idx + 1:], depth + 1)
-        # the current node should store the median triangle
-        return KDTreeNode([median_tri], centroid, left, right, axis, bbox_min, bbox_max)
-    
-    def closest_point(self, p):
-        best = None
-        stack = [self.root] # DFS
+        self.tri_bbox_min = np.min(tri_verts, axis=1) # component-wise min. vertex of each triangle
+        self.tri_bbox_max = np.max(tri_verts, axis=1) # component-wise max vertex of each triangle
+        self.centroids = np.mean(tri_verts, axis=1) # array of centroids for each triangle
+        # edge vectors, dot products, normals and edge lengths of every triangle,
+        # computed once here so queries only gather them
+        self.tri_geom = icp.triangle_geometry(tri_verts)
+
+        self._build()
+
+    def _build(self):
+        # the tree is stored as a struct of arrays instead of a graph of node objects,
+        # every node is just an index into these arrays. the arrays get trimmed down
+        # to the real node count once the tree is built
+        max_nodes = self._max_nodes(len(self.triangles))
+        self.left = np.full(max_nodes, -1, dtype=np.int64) # index of the left child, -1 for leaves
+        self.right = np.full(max_nodes, -1, dtype=np.int64) # index of the right child, -1 for leaves
+        self.axis = np.zeros(max_nodes, dtype=np.int8) # the axis in which the node's children are split by
+        self.split = np.zeros(max_nodes) # median centroid coordinate along the node's axis
+        self.start = np.zeros(max_nodes, dtype=np.int64) # leaves own tri_order[start:start + count]
+        self.count = np.zeros(max_nodes, dtype=np.int64)
+        self.bbox = np.zeros((max_nodes, 2, 3)) # [:,0] is the bbox min corner, [:,1] is the bbox max corner
+        # triangle indices reordered so that every leaf's triangles are contiguous
+        self.tri_order = np.arange(len(self.triangles))
+        self.n_nodes = 0
+        self.root = self.build_kdtree()
+        self._trim_nodes()
+        # cost of the tree right after the build, refit compares against it to tell
+        # when moved vertices have made the tree too loose
+        self.build_cost = self.tree_cost()
+
+    def _max_nodes(self, n_triangles):
+        # a median split never leaves fewer than (leaf_size + 1) // 2 triangles in
+        # a leaf, which bounds the number of leaves and so the number of nodes
+        max_leaves = max(1, n_triangles // max(1, (self.leaf_size + 1) // 2))
+        return 2 * max_leaves - 1
+
+    def _trim_nodes(self):
+        n = self.n_nodes
+        self.left, self.right = self.left[:n], self.right[:n]
+        self.axis, self.split = self.axis[:n], self.split[:n]
+        self.start, self.count = self.start[:n], self.count[:n]
+        self.bbox = self.bbox[:n]
+
+    def tree_cost(self):
+        # sum of the surface areas of all node boxes relative to the root box, the
+        # expected number of nodes a query has to visit (the SAH cost without the
+        # leaf term). relative, so moving or scaling the whole mesh leaves it alone
+        areas = bbox_surface_area(self.bbox[:, 0], self.bbox[:, 1])
+        return float(np.sum(areas) / max(areas[self.root], 1e-300))
+
+    def refit(self, new_vertices, max_cost_ratio=1.05):
+        # moves the tree onto new vertex positions of the same mesh (e.g. a new set of
+        # mode weights of a deformable model). the topology is kept and only the
+        # per triangle data and the node boxes are recomputed, leaves first and then
+        # one vectorized pass per level. once the tree cost has grown to more than
+        # max_cost_ratio times its value at build time the splits no longer fit the
+        # shape, and the tree is rebuilt instead. returns True if it rebuilt.
+        # indexes wrapping the tree (distance field, mesh walk) have to be made again
+        self.vertices = new_vertices
+        tri_verts = new_vertices[self.triangles]
+        self.tri_bbox_min = np.min(tri_verts, axis=1)
+        self.tri_bbox_max = np.max(tri_verts, axis=1)
+        self.centroids = np.mean(tri_verts, axis=1)
+        self.tri_geom = icp.triangle_geometry(tri_verts)
+        if getattr(self, "build_cost", None) is None:
+            self.build_cost = self.tree_cost() # loaded trees count as freshly built
+        self._fit_bboxes()
+        self._fit_splits()
+        if self.tree_cost() <= max_cost_ratio * self.build_cost:
+            return False
+        self._build()
+        return True
+
+    def _fit_splits(self):
+        # the split values only steer queries (the seed leaf and which child is
+        # searched first). after the vertices moved they are put between the
+        # children's triangle centroids again, like the median split at build time,
+        # swapping children that now lie the other way round along the axis
+        lo, hi = self._centroid_bounds()
+        inner = np.flatnonzero(self.left >= 0)
+        rows = np.arange(len(inner))
+        axis = self.axis[inner].astype(np.int64)
+        left, right = self.left[inner], self.right[inner]
+        swap = lo[left, axis] + hi[left, axis] > lo[right, axis] + hi[right, axis]
+        left, right = np.where(swap, right, left), np.where(swap, left, right)
+        self.left[inner], self.right[inner] = left, right
+        self.split[inner] = 0.5 * (hi[left, axis] + lo[right, axis])
+        self._buffers = None
+
+    def _centroid_bounds(self):
+        # per node min/max of its triangles' centroids, bottom up like _fit_bboxes
+        lo = np.zeros((len(self.left), 3))
+        hi = np.zeros((len(self.left), 3))
+        leaves = np.flatnonzero(self.left < 0)
+        leaves = leaves[np.argsort(self.start[leaves])]
+        ordered = self.centroids[self.tri_order]
+        lo[leaves] = np.minimum.reduceat(ordered, self.start[leaves], axis=0)
+        hi[leaves] = np.maximum.reduceat(ordered, self.start[leaves], axis=0)
+        for level in reversed(self._node_levels()):
+            inner = level[self.left[level] >= 0]
+            lo[inner] = np.minimum(lo[self.left[inner]], lo[self.right[inner]])
+            hi[inner] = np.maximum(hi[self.left[inner]], hi[self.right[inner]])
+        return lo, hi
+
+    def to_arrays(self):
+        # the built tree as a dict of plain arrays
+        return {name: getattr(self, name) for name in INDEX_ARRAYS}
+
+    @classmethod
+    def from_arrays(cls, arrays, leaf_size, root=0, **options):
+        # rebuilds a tree object around arrays produced by to_arrays, no tree building is
+        # done. options are the BUILD_OPTIONS, left out ones keep the class defaults
+        tree = cls.__new__(cls)
+        for name in INDEX_ARRAYS:
+            setattr(tree, name, arrays[name])
+        for name, value in options.items():
+            setattr(tree, name, value)
+        tree.leaf_size = int(leaf_size)
+        tree.root = int(root)
+        tree.n_nodes = len(tree.left)
+        return tree
+
+    def save(self, path, mesh_hash=""):
+        # writes the tree to an uncompressed .npz (path or open file), mesh_hash identifies the
+        # mesh it was built from
+        np.savez(path, version=INDEX_VERSION, kind=type(self).__name__, mesh_hash=mesh_hash,
+                 leaf_size=self.leaf_size, root=self.root, **self.to_arrays(),
+                 **{name: getattr(self, name) for name in self.BUILD_OPTIONS})
+
+    @classmethod
+    def load(cls, path, mesh_hash=None):
+        # reads a tree written by save. raises ValueError if the file was written by a
+        # different index version or class, or for a different mesh than mesh_hash
+        with np.load(path, allow_pickle=False) as data:
+            if int(data["version"]) != INDEX_VERSION:
+                raise ValueError(f"{path} has index version {int(data['version'])}, expected {INDEX_VERSION}")
+            if str(data["kind"]) != cls.__name__:
+                raise ValueError(f"{path} holds a {data['kind']}, expected {cls.__name__}")
+            if mesh_hash is not None and str(data["mesh_hash"]) != mesh_hash:
+                raise ValueError(f"{path} was built for a different mesh")
+            arrays = {name: data[name] for name in INDEX_ARRAYS}
+            options = {name: data[name].item() for name in cls.BUILD_OPTIONS if name in data}
+            return cls.from_arrays(arrays, data["leaf_size"], data["root"], **options)
+
+    def build_kdtree(self):
+        # builds the tree over all triangles and returns its root node. an explicit stack
+        # of (node, lo, hi, depth) entries replaces recursion, each entry covers the
+        # triangles tri_order[lo:hi] and has its node slot claimed by its parent
+        n = len(self.tri_order)
+        if n == 0:
+            return -1
+        self.n_nodes = 1
+        stack = [(0, 0, n, 0)]
 
         while stack:
-            node = stack.pop()
-            if node is None:
+            node, lo, hi, depth = stack.pop()
+            axis = depth % 3
+            self.axis[node] = axis
+            self.start[node] = lo
+            self.count[node] = hi - lo
+
+            # make the leaf, its triangles get tested together at query time
+            if hi - lo <= self.leaf_size:
                 continue
 
+            # move the median triangle (by centroid along the given axis) to the middle
+            # with everything smaller before it and everything larger after it. a
+            # partition is O(n) where a full sort would be O(n log n) at every level
+            tri_indices = self.tri_order[lo:hi]
+            mid = (hi - lo) // 2
+            part = np.argpartition(self.centroids[tri_indices, axis], mid)
+            self.tri_order[lo:hi] = tri_indices[part]
+            self.split[node] = self.centroids[self.tri_order[lo + mid], axis]
+
+            # split the triangles along the median
+            # choose axis to split along by round robin. found experimentally to
+            # work well enough for the given data, likely because the points on
+            # the meshes are evenly distributed w.r.t each axis
+            left, right = self.n_nodes, self.n_nodes + 1
+            self.n_nodes += 2
+            self.left[node] = left
+            self.right[node] = right
+            # push the right half first so the left half gets built first
+            stack.append((right, lo + mid, hi, depth + 1))
+            stack.append((left, lo, lo + mid, depth + 1))
+
+        self.root = 0
+        self._fit_bboxes()
+        return self.root
+
+    def _node_levels(self):
+        # node indices grouped by depth, root level first
+        levels = []
+        level = np.array([self.root], dtype=np.int64)
+        while len(level):
+            levels.append(level)
+            inner = level[self.left[level] >= 0]
+            level = np.concatenate([self.left[inner], self.right[inner]])
+        return levels
+
+    def _fit_bboxes(self):
+        # find the bounding box of every node (covers all of its children)
+        # Note: the root node's bounding box will encompass the entire mesh.
+        # leaves own contiguous runs of tri_order, so their boxes are one reduceat
+        leaves = np.flatnonzero(self.left[:self.n_nodes] < 0)
+        leaves = leaves[np.argsort(self.start[leaves])]
+        ordered_min = self.tri_bbox_min[self.tri_order]
+        ordered_max = self.tri_bbox_max[self.tri_order]
+        self.bbox[leaves, 0] = np.minimum.reduceat(ordered_min, self.start[leaves], axis=0)
+        self.bbox[leaves, 1] = np.maximum.reduceat(ordered_max, self.start[leaves], axis=0)
+
+        # then each level of interior nodes, deepest first, from their children's boxes
+        for level in reversed(self._node_levels()):
+            inner = level[self.left[level] >= 0]
+            self.bbox[inner, 0] = np.minimum(self.bbox[self.left[inner], 0], self.bbox[self.right[inner], 0])
+            self.bbox[inner, 1] = np.maximum(self.bbox[self.left[inner], 1], self.bbox[self.right[inner], 1])
+        self._buffers = None # the traversal buffers copy the boxes
+
+    def triangle_geometry(self, tris):
+        # precomputed kernel terms for the given triangle indices
+        return self.tri_geom[tris]
+
+    def closest_point(self, p, hint=-1, stats=None, epsilon=0.0):
+        # hint is a triangle that is probably (close to) the answer, e.g. the one found
+        # for this point in the last ICP iteration. it is tested before descending so
+        # most of the tree gets pruned right away. if stats is a dict (or a QueryStats)
+        # the search is counted into it, see QueryStats.
+        # epsilon > 0 gives an approximate answer: a node is skipped once its box is
+        # within a factor 1 + epsilon of the best distance, so the returned distance
+        # is at most (1 + epsilon) times the true one.
+        # everything is compared as squared distances and the node loop runs on plain
+        # python floats from _traversal_buffers, one sqrt is taken for the answer.
+        # the counters are only touched behind the counting flag, one branch per node
+        counting = stats is not None
+        left, right, axis, split, bbox_lo, bbox_hi, start, count, stack = self._traversal_buffers()
+        p = np.asarray(p, dtype=float)
+        pt = (float(p[0]), float(p[1]), float(p[2]))
+        px, py, pz = pt
+        scale = (1.0 + epsilon) ** 2
+        best_d2 = math.inf
+        best_point = None
+        best_tri = -1
+        nodes_visited = nodes_pruned = triangle_tests = 0
+        if hint >= 0:
+            best_point = icp.closest_points_from_geometry(p, self.triangle_geometry([hint]))[0]
+            best_d2 = float(np.dot(best_point - p, best_point - p))
+            best_tri = hint
+            triangle_tests = 1
+        stack[0] = self.root # DFS, the buffer is deep enough for any root to leaf path
+        top = max_depth = 1
+
+        while top:
+            top -= 1
+            node = stack[top]
+            if counting:
+                nodes_visited += 1
+
             # skip if node's bounding box is farther than current best
-            # not applicable on the first pass
-            if best is not None:
-                box_dist = point_bbox_distance(p, node.bbox_min, node.bbox_max)
-                if box_dist >= best[0]:
-                    continue
-
-            # check distance to triangle stored in this node
-            v0, v1, v2 = self.vertices[self.triangles[node.tri_idx[0]]]
-            q = icp.find_closest_point(p, v0, v1, v2)
-            dist = np.linalg.norm(p - q)
-            if best is None or dist < best[0]:
-                best = (dist, q, node.tri_idx)
-
-            # decide which subtree to visit first, want to visit nearest one first
-            axis = node.axis
-            diff = p[axis] - node.point[axis] # want to find which half (left or right) is closer to the query point
-            near, far = (node.left, node.right) if diff < 0 else (node.right, node.left)
+            x0, y0, z0 = bbox_lo[node]
+            x1, y1, z1 = bbox_hi[node]
+            box_d2 = 0.0
+            if px < x0: box_d2 += (x0 - px) * (x0 - px)
+            elif px > x1: box_d2 += (px - x1) * (px - x1)
+            if py < y0: box_d2 += (y0 - py) * (y0 - py)
+            elif py > y1: box_d2 += (py - y1) * (py - y1)
+            if pz < z0: box_d2 += (z0 - pz) * (z0 - pz)
+            elif pz > z1: box_d2 += (pz - z1) * (pz - z1)
+            if box_d2 * scale >= best_d2:
+                if counting:
+                    nodes_pruned += 1
+                continue
+
+            # leaf: test all of its triangles at once
+            if left[node] < 0:
+                tris = self.tri_order[start[node]:start[node] + count[node]]
+                qs = icp.closest_points_from_geometry(p, self.tri_geom[tris])
+                diff = qs - p
+                d2 = np.einsum('ij,ij->i', diff, diff)
+                i = np.argmin(d2)
+                if d2[i] < best_d2:
+                    best_d2, best_point, best_tri = float(d2[i]), qs[i], tris[i]
+                if counting:
+                    triangle_tests += len(tris)
+                continue
+
+            # visit the child on the query's side of the split first, want to visit nearest one first
+            if pt[axis[node]] < split[node]:
+                near, far = left[node], right[node]
+            else:
+                near, far = right[node], left[node]
 
             # push the closer node last so we hit it first (DFS)
-            stack.append(far)
-            stack.append(near)
+            stack[top] = far
+            stack[top + 1] = near
+            top += 2
+            if counting and top > max_depth:
+                max_depth = top
+
+        if counting:
+            counts = {"nodes_visited": nodes_visited, "nodes_pruned": nodes_pruned,
+                      "triangle_tests": triangle_tests, "max_stack_depth": max_depth}
+            record_stats(stats, dict(counts, queries=1), {name: np.array([value]) for name, value in counts.items()})
+        return best_point, math.sqrt(best_d2), best_tri
+
+    def _traversal_buffers(self):
+        # python list copies of the node arrays plus a preallocated DFS stack, made on
+        # first use and dropped whenever the boxes change. per node indexing of lists
+        # of floats costs a fraction of indexing numpy arrays and allocates nothing
+        if getattr(self, "_buffers", None) is None:
+            # every visit of an interior node pops one entry and pushes two, so the
+            # stack never holds more than depth + 1 nodes
+            depth = len(self._node_levels())
+            self._buffers = (self.left.tolist(), self.right.tolist(), self.axis.tolist(), self.split.tolist(),
+                             [tuple(b) for b in self.bbox[:, 0].tolist()], [tuple(b) for b in self.bbox[:, 1].tolist()],
+                             self.start.tolist(), self.count.tolist(), [0] * (depth + 1))
+        return self._buffers
+
+    def closest_points(self, points, hints=None, batch_size=2048, stats=None, epsilon=0.0, morton=False):
+        # batched version of closest_point. points is (N,3), returns the (N,3) closest
+        # points, (N,) distances and (N,) triangle indices. hints optionally gives a
+        # starting triangle per point (-1 for none), stats and epsilon work as in
+        # closest_point. queries are handled batch_size at a time to keep the size of
+        # the traversal frontier bounded. with morton=True the queries are searched in
+        # Morton order (results still come back in input order), so each batch is a
+        # compact patch of space whose queries visit mostly the same nodes
+        closest, dists, best_tri, _ = self._closest_points(points, hints, batch_size, stats, False, epsilon, morton)
+        return closest, dists, best_tri
+
+    def closest_points_with_margin(self, points, hints=None, batch_size=2048, stats=None, morton=False):
+        # closest_points plus the (N,) margins: distance to the second nearest triangle
+        # minus distance to the nearest one. a point that moves by less than half of
+        # its margin still has the same nearest triangle. the search has to get past
+        # the runner up too, so it prunes less than closest_points
+        return self._closest_points(points, hints, batch_size, stats, True, 0.0, morton)
+
+    def _closest_points(self, points, hints, batch_size, stats, with_margin, epsilon, morton=False, counts=None):
+        # counts are the per query counters to fill in, (N,) arrays by counter name.
+        # they are only kept for a QueryStats that asks for them (per_query=True)
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        n = len(points)
+        hints = np.full(n, -1, dtype=np.int64) if hints is None else np.asarray(hints, dtype=np.int64)
+        per_query = counts is None and getattr(stats, "per_query", None) is not None
+        if per_query:
+            counts = {name: np.zeros(n, dtype=np.int64) for name in QueryStats.COUNTERS}
+        if morton:
+            # search in Morton order, then scatter every result back to its query
+            order = morton_order(points)
+            ordered = None if counts is None else {name: np.zeros(n, dtype=np.int64) for name in counts}
+            results = self._closest_points(points[order], hints[order], batch_size, stats, with_margin, epsilon,
+                                           counts=ordered)
+            inverse = np.empty_like(order)
+            inverse[order] = np.arange(n)
+            for name in ordered or ():
+                counts[name][order] = ordered[name]
+            closest, dists, best_tri, margins = (None if result is None else result[inverse] for result in results)
+        else:
+            closest = np.zeros((n, 3))
+            best_tri = np.full(n, -1, dtype=np.int64)
+            second_d2 = np.full(n, np.inf) if with_margin else None
+            for lo in range(0, n, batch_size):
+                hi = min(n, lo + batch_size)
+                second = second_d2[lo:hi] if with_margin else None
+                part = None if counts is None else {name: c[lo:hi] for name, c in counts.items()}
+                closest[lo:hi], best_tri[lo:hi] = self._closest_points_batch(points[lo:hi], hints[lo:hi], stats,
+                                                                             second, epsilon, part)
+            dists = np.linalg.norm(closest - points, axis=1)
+            margins = np.sqrt(second_d2) - dists if with_margin else None
+        if per_query:
+            record_stats(stats, {}, counts)
+        return closest, dists, best_tri, margins
+
+    def _closest_points_batch(self, points, hints, stats, second_d2=None, epsilon=0.0, counts=None):
+        # second_d2 is filled in with the squared distance to the runner up triangle
+        # when given, nodes are then pruned against that instead of the best.
+        # the totals for stats are only gathered when stats is given (a few integer
+        # additions per level are kept unconditional, they cost nothing next to the
+        # array work), the per query counts (views into the caller's arrays) only
+        # when counts is given.
+        # there is no stack here, the whole frontier moves down one level at a time,
+        # so max_stack_depth is the number of levels the search reached (which is also
+        # as deep as the stack of closest_point can get for them)
+        n = len(points)
+        best_d2 = np.full(n, np.inf) # squared distances are enough to compare candidates
+        closest = np.zeros((n, 3))
+        best_tri = np.full(n, -1, dtype=np.int64)
+        nodes_visited = nodes_pruned = max_depth = 0
+        triangle_tests = 0
+
+        # queries with a hint start from the hinted triangle
+        hinted = np.flatnonzero(hints >= 0)
+        triangle_tests += test_triangles(points, hinted, hints[hinted], self.tri_geom, best_d2, closest, best_tri, second_d2)
+        if counts is not None:
+            counts["triangle_tests"][hinted] += 1
+        bound = best_d2 if second_d2 is None else second_d2
+        scale = (1.0 + epsilon) ** 2
+
+        # seed every other query with the leaf it would land in by following the
+        # splits, this gives a tight bound before the real search starts
+        seed = np.full(n, -1, dtype=np.int64)
+        queries = np.flatnonzero(hints < 0)
+        seed[queries] = self.root
+        inner = queries[self.left[seed[queries]] >= 0]
+        while len(inner):
+            node = seed[inner]
+            go_left = points[inner, self.axis[node]] < self.split[node]
+            seed[inner] = np.where(go_left, self.left[node], self.right[node])
+            nodes_visited += len(inner)
+            if counts is not None:
+                counts["nodes_visited"][inner] += 1
+            inner = inner[self.left[seed[inner]] >= 0]
+        triangle_tests += self._test_leaves(points, queries, seed[queries], best_d2, closest, best_tri, second_d2)
+        if counts is not None:
+            counts["triangle_tests"][queries] += self.count[seed[queries]]
+
+        # frontier traversal: every (query, node) pair still worth visiting
+        # is processed together one tree level at a time
+        queries = np.arange(n)
+        nodes = np.full(n, self.root, dtype=np.int64)
+        while len(queries):
+            nodes_visited += len(queries)
+            max_depth += 1
+            # skip pairs whose bounding box is farther than the query's current best
+            lo_gap = self.bbox[nodes, 0] - points[queries]
+            hi_gap = points[queries] - self.bbox[nodes, 1]
+            gap = np.maximum(0.0, np.maximum(lo_gap, hi_gap))
+            keep = np.sum(gap * gap, axis=1) * scale < bound[queries]
+            if counts is not None:
+                counts["nodes_visited"] += np.bincount(queries, minlength=n)
+                counts["nodes_pruned"] += np.bincount(queries[~keep], minlength=n)
+                counts["max_stack_depth"][queries] = np.maximum(counts["max_stack_depth"][queries], max_depth)
+            if stats is not None:
+                nodes_pruned += len(keep) - np.count_nonzero(keep)
+            queries, nodes = queries[keep], nodes[keep]
+
+            # test leaves (the seed leaf was already tested)
+            leaf = self.left[nodes] < 0
+            fresh = leaf & (nodes != seed[queries])
+            triangle_tests += self._test_leaves(points, queries[fresh], nodes[fresh], best_d2, closest, best_tri, second_d2)
+            if counts is not None:
+                counts["triangle_tests"] += np.bincount(queries[fresh], weights=self.count[nodes[fresh]],
+                                                        minlength=n).astype(np.int64)
+
+            # expand the interior nodes into both children
+            queries, nodes = queries[~leaf], nodes[~leaf]
+            queries = np.concatenate([queries, queries])
+            nodes = np.concatenate([self.left[nodes], self.right[nodes]])
+
+        if stats is not None:
+            record_stats(stats, {"queries": n, "nodes_visited": nodes_visited, "nodes_pruned": nodes_pruned,
+                                 "triangle_tests": triangle_tests, "max_stack_depth": max_depth})
+        return closest, best_tri
+
+    def k_closest(self, p, k):
+        # the k triangles nearest to p, as (k,3) closest points, (k,) distances and (k,)
+        # triangle indices sorted nearest first. k is capped at the number of triangles
+        closest, dists, tris = self.k_closest_batch(np.asarray(p, dtype=float)[None], k)
+        return closest[0], dists[0], tris[0]
+
+    def k_closest_batch(self, points, k, batch_size=2048):
+        # k_closest for every row of points, returns (N,k,3), (N,k) and (N,k) arrays
+        if k < 1:
+            raise ValueError(f"k must be at least 1, got {k}")
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        n, k = len(points), min(k, len(self.triangles))
+        closest = np.zeros((n, k, 3))
+        best_d2 = np.full((n, k), np.inf)
+        best_tri = np.full((n, k), -1, dtype=np.int64)
+        for lo in range(0, n, batch_size):
+            hi = min(n, lo + batch_size)
+            self._k_closest_batch(points[lo:hi], closest[lo:hi], best_d2[lo:hi], best_tri[lo:hi])
+        return closest, np.sqrt(best_d2), best_tri
+
+    def _k_closest_batch(self, points, closest, best_d2, best_tri):
+        # same traversal as _closest_points_batch, with each query's k-th best
+        # distance (the last column of best_d2) as the pruning bound
+        n = len(points)
+        seed = np.full(n, self.root, dtype=np.int64)
+        inner = np.flatnonzero(self.left[seed] >= 0)
+        while len(inner):
+            node = seed[inner]
+            go_left = points[inner, self.axis[node]] < self.split[node]
+            seed[inner] = np.where(go_left, self.left[node], self.right[node])
+            inner = inner[self.left[seed[inner]] >= 0]
+        self._test_leaves_k(points, np.arange(n), seed, closest, best_d2, best_tri)
+
+        queries = np.arange(n)
+        nodes = np.full(n, self.root, dtype=np.int64)
+        while len(queries):
+            gap = np.maximum(0.0, np.maximum(self.bbox[nodes, 0] - points[queries], points[queries] - self.bbox[nodes, 1]))
+            keep = np.sum(gap * gap, axis=1) < best_d2[queries, -1]
+            queries, nodes = queries[keep], nodes[keep]
+
+            leaf = self.left[nodes] < 0
+            fresh = leaf & (nodes != seed[queries])
+            self._test_leaves_k(points, queries[fresh], nodes[fresh], closest, best_d2, best_tri)
+
+            queries, nodes = queries[~leaf], nodes[~leaf]
+            queries = np.concatenate([queries, queries])
+            nodes = np.concatenate([self.left[nodes], self.right[nodes]])
+
+    def _test_leaves_k(self, points, queries, leaves, closest, best_d2, best_tri):
+        # merges the triangles of leaves[i] into the sorted k nearest of points[queries[i]]
+        if len(queries) == 0:
+            return
+        pair, tri_pos = expand_ranges(self.start[leaves], self.count[leaves])
+        q, t = queries[pair], self.tri_order[tri_pos]
+        c = icp.closest_points_from_geometry(points[q], self.tri_geom[t])
+        d2 = np.sum((c - points[q]) ** 2, axis=1)
+
+        # pool the current k entries of every touched query with its new candidates,
+        # sort each query's run by distance and keep the first k
+        touched = np.unique(q)
+        k = best_d2.shape[1]
+        q = np.concatenate([np.repeat(touched, k), q])
+        d2 = np.concatenate([best_d2[touched].ravel(), d2])
+        t = np.concatenate([best_tri[touched].ravel(), t])
+        c = np.concatenate([closest[touched].reshape(-1, 3), c])
+        order = np.lexsort((d2, q))
+        run_start = np.searchsorted(q[order], q[order])
+        rank = np.arange(len(order)) - run_start
+        sel = order[rank < k]
+        rank = rank[rank < k]
+        best_d2[q[sel], rank] = d2[sel]
+        best_tri[q[sel], rank] = t[sel]
+        closest[q[sel], rank] = c[sel]
+
+    def within_radius(self, p, r):
+        # every triangle within distance r of p, as (m,3) closest points, (m,) distances
+        # and (m,) triangle indices sorted nearest first
+        _, closest, dists, tris = self.within_radius_batch(np.asarray(p, dtype=float)[None], [r])
+        return closest, dists, tris
+
+    def within_radius_batch(self, points, radii, batch_size=2048):
+        # within_radius for every row of points (radii is one radius or one per point).
+        # the hits of all queries come back as flat (q, closest, dists, tris) arrays,
+        # sorted by query and then nearest first, q being the query of each hit
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        radii = np.broadcast_to(np.asarray(radii, dtype=float), (len(points),))
+        hits = []
+        for lo in range(0, len(points), batch_size):
+            q, c, d2, t = self._within_radius_batch(points[lo:lo + batch_size], radii[lo:lo + batch_size])
+            hits.append((q + lo, c, d2, t))
+        if not hits:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, 3)), np.zeros(0), np.zeros(0, dtype=np.int64)
+        q, closest, d2, t = (np.concatenate(parts) for parts in zip(*hits))
+        return q, closest, np.sqrt(d2), t
+
+    def _within_radius_batch(self, points, radii):
+        r2 = radii ** 2
+        queries = np.arange(len(points))
+        nodes = np.full(len(points), self.root, dtype=np.int64)
+        found_q, found_c, found_d2, found_t = [], [], [], []
+        while len(queries):
+            # drop nodes whose bounding box is out of reach
+            gap = np.maximum(0.0, np.maximum(self.bbox[nodes, 0] - points[queries], points[queries] - self.bbox[nodes, 1]))
+            keep = np.sum(gap * gap, axis=1) <= r2[queries]
+            queries, nodes = queries[keep], nodes[keep]
+
+            # test leaf triangles, keep the ones in reach
+            leaf = self.left[nodes] < 0
+            pair, pos = expand_ranges(self.start[nodes[leaf]], self.count[nodes[leaf]])
+            q, t = queries[leaf][pair], self.tri_order[pos]
+            c = icp.closest_points_from_geometry(points[q], self.tri_geom[t])
+            d2 = np.sum((c - points[q]) ** 2, axis=1)
+            hit = d2 <= r2[q]
+            found_q.append(q[hit])
+            found_c.append(c[hit])
+            found_d2.append(d2[hit])
+            found_t.append(t[hit])
+
+            queries, nodes = queries[~leaf], nodes[~leaf]
+            queries = np.concatenate([queries, queries])
+            nodes = np.concatenate([self.left[nodes], self.right[nodes]])
+
+        q, c, d2, t = np.concatenate(found_q), np.concatenate(found_c), np.concatenate(found_d2), np.concatenate(found_t)
+        order = np.lexsort((t, d2, q))
+        return q[order], c[order], d2[order], t[order]
+
+    def _test_leaves(self, points, queries, leaves, best_d2, closest, best_tri, second_d2=None):
+        # tests every triangle of leaves[i] against points[queries[i]] in one
+        # vectorized call, keeps the nearest result per query and returns the number of triangles tested
+        pair, tri_pos = expand_ranges(self.start[leaves], self.count[leaves])
+        return test_triangles(points, queries[pair], self.tri_order[tri_pos], self.tri_geom, best_d2, closest, best_tri, second_d2)
+
+
+class QueryStats(dict):
+    # opt-in work counters of the closest point searches: pass one as stats= to
+    # closest_point / closest_points (a plain dict gets the same totals). counts the
+    # queries, nodes_visited, nodes_pruned (visited but skipped for their box),
+    # triangle_tests and max_stack_depth, summed over every search it is passed to
+    # except max_stack_depth which keeps the deepest. indexes without a tree count
+    # what they have (triangle tests, fallbacks to the tree, reused samples).
+    # with per_query=True the counters of every single tree query are kept as well
+    COUNTERS = ("nodes_visited", "nodes_pruned", "triangle_tests", "max_stack_depth")
+
+    def __init__(self, per_query=False):
+        super().__init__()
+        self.per_query = {name: [] for name in self.COUNTERS} if per_query else None
+
+    def query_counts(self):
+        # (Q,) array per counter, one entry per query in the order they were searched
+        return {name: np.concatenate(values) if values else np.zeros(0, dtype=np.int64)
+                for name, values in self.per_query.items()}
+
+    def report(self):
+        # a few lines summing up the counted searches
+        queries = max(1, self.get("queries", 0))
+        visited = self.get("nodes_visited", 0)
+        lines = [f"queries {self.get('queries', 0)}, nodes visited {visited} ({visited / queries:.1f} per query), "
+                 f"pruned {self.get('nodes_pruned', 0)} ({100.0 * self.get('nodes_pruned', 0) / max(1, visited):.1f}%), "
+                 f"triangle tests {self.get('triangle_tests', 0)} ({self.get('triangle_tests', 0) / queries:.1f} per query), "
+                 f"max stack depth {self.get('max_stack_depth', 0)}"]
+        if self.per_query is not None and self.per_query["nodes_visited"]:
+            counts = self.query_counts()
+            lines.append("per query median / 95th percentile / max: " + ", ".join(
+                f"{name.replace('_', ' ')} {np.median(values):.0f} / {np.percentile(values, 95):.0f} / {np.max(values)}"
+                for name, values in counts.items()))
+        others = [f"{name} {value}" for name, value in self.items() if name not in self.COUNTERS + ("queries",)]
+        if others:
+            lines.append(", ".join(others))
+        return "\n".join(lines)
+
+def record_stats(stats, totals, per_query=None):
+    # adds the counters of a search to a stats dict, max_stack_depth keeps the
+    # maximum and everything else is summed. per_query ((N,) arrays by counter name)
+    # is kept when stats is a QueryStats with per_query=True
+    for name, value in totals.items():
+        if name == "max_stack_depth":
+            stats[name] = max(stats.get(name, 0), int(value))
+        else:
+            stats[name] = stats.get(name, 0) + int(value)
+    if per_query is not None and getattr(stats, "per_query", None) is not None:
+        for name, values in per_query.items():
+            stats.per_query[name].append(values)
+
+def morton_order(points, bits=21):
+    # permutation that sorts points along a Z-order (Morton) curve: coordinates are
+    # quantized to 2^bits steps over the points' bounding box and their bits are
+    # interleaved, so points close in space end up close in the order
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    if len(points) == 0:
+        return np.zeros(0, dtype=np.int64)
+    lo = points.min(axis=0)
+    extent = np.maximum(points.max(axis=0) - lo, 1e-300)
+    cells = ((points - lo) / extent * ((1 << bits) - 1)).astype(np.uint64)
+
+    # spread the low 21 bits of every coordinate to every third bit
+    x = cells & np.uint64(0x1FFFFF)
+    for shift, mask in [(32, 0x1F00000000FFFF), (16, 0x1F0000FF0000FF), (8, 0x100F00F00F00F00F),
+                        (4, 0x10C30C30C30C30C3), (2, 0x1249249249249249)]:
+        x = (x | (x << np.uint64(shift))) & np.uint64(mask)
+    codes = x[:, 0] | (x[:, 1] << np.uint64(1)) | (x[:, 2] << np.uint64(2))
+    return np.argsort(codes, kind='stable')
+
+def expand_ranges(starts, counts):
+    # flattens the index runs [starts[i], starts[i] + counts[i]) into one array,
+    # returns the run each element came from and the element itself
+    owner = np.repeat(np.arange(len(starts)), counts)
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    return owner, starts[owner] + np.arange(len(owner)) - first
+
+def test_triangles(points, q_idx, tris, tri_geom, best_d2, closest, best_tri, second_d2=None):
+    # tests triangle tris[i] against points[q_idx[i]] for every i in one vectorized
+    # kernel call, then keeps the nearest result per query where it beats best_d2.
+    # if second_d2 is given the runner up distance of every query is kept there too.
+    # returns the number of tests done
+    if len(q_idx) == 0:
+        return 0
+    c = icp.closest_points_from_geometry(points[q_idx], tri_geom[tris])
+    d2 = np.sum((c - points[q_idx]) ** 2, axis=1)
+
+    # nearest candidate per query: sort by query then distance, keep the first of each run
+    order = np.lexsort((d2, q_idx))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = q_idx[order[1:]] != q_idx[order[:-1]]
+
+    if second_d2 is not None:
+        # the current best triangle showing up again (e.g. a hint being found in
+        # its leaf) is not its own runner up
+        repeat = tris[order] == best_tri[q_idx[order]]
+        order = order[~repeat]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = q_idx[order[1:]] != q_idx[order[:-1]]
+        if len(order) == 0:
+            return len(q_idx)
+        # runner up among the candidates is the next entry of the same run
+        pos = np.flatnonzero(first)
+        has_next = np.append(~first[1:], False)[pos]
+        c2 = np.where(has_next, d2[order[np.minimum(pos + 1, len(order) - 1)]], np.inf)
+        q, c1 = q_idx[order[pos]], d2[order[pos]]
+        better = c1 < best_d2[q]
+        second_d2[q] = np.where(better, np.minimum(best_d2[q], c2), np.minimum(second_d2[q], c1))
+
+    sel = order[first]
+    sel = sel[d2[sel] < best_d2[q_idx[sel]]]
+    upd = q_idx[sel]
+    best_d2[upd] = d2[sel]
+    closest[upd] = c[sel]
+    best_tri[upd] = tris[sel]
+    return len(q_idx)
+
+def cells_in_boxes(lo, hi):
+    # every integer cell of the boxes lo[i]..hi[i] (inclusive), returns the box each
+    # cell came from and the (M,3) cells themselves
+    span = hi - lo + 1
+    owner, local = expand_ranges(np.zeros(len(span), dtype=np.int64), np.prod(span, axis=1))
+    span = span[owner]
+    offsets = np.stack([local % span[:, 0],
+                        (local // span[:, 0]) % span[:, 1],
+                        local // (span[:, 0] * span[:, 1])], axis=1)
+    return owner, lo[owner] + offsets
+
+def bbox_surface_area(bbox_min, bbox_max):
+    # surface area of each box, rows of bbox_min/bbox_max are opposing corners
+    d = bbox_max - bbox_min
+    return 2.0 * (d[..., 0] * d[..., 1] + d[..., 1] * d[..., 2] + d[..., 2] * d[..., 0])
+
+def triangle_adjacency(triangles, neighbors=None):
+    # (M,3) edge neighbors of every triangle, -1 where an edge has none. uses the
+    # neighbor columns of the .sur records when the file fills them in, otherwise
+    # pairs up the triangles that share an edge (edges on more than two triangles
+    # are left without a neighbor)
+    if neighbors is not None and np.any(np.asarray(neighbors) >= 0):
+        return np.asarray(neighbors, dtype=np.int64)
+    triangles = np.asarray(triangles, dtype=np.int64)
+    m = len(triangles)
+    a = triangles[:, [0, 1, 2]].ravel()
+    b = triangles[:, [1, 2, 0]].ravel()
+    keys = np.minimum(a, b) * (triangles.max() + 1) + np.maximum(a, b)
+    order = np.argsort(keys, kind='stable')
+    keys = keys[order]
+
+    # an edge shared by exactly two triangles is a run of length two in the sorted keys
+    starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+    lengths = np.diff(np.append(starts, len(keys)))
+    pair = starts[lengths == 2]
+    e0, e1 = order[pair], order[pair + 1]
+    adjacency = np.full(3 * m, -1, dtype=np.int64)
+    adjacency[e0] = e1 // 3
+    adjacency[e1] = e0 // 3
+    return adjacency.reshape(m, 3)
+
+def vertex_rings(triangles):
+    # the triangles sharing a vertex with each triangle (itself excluded), as CSR
+    # arrays: the ring of triangle i is ring_tris[ring_start[i]:ring_start[i + 1]]
+    triangles = np.asarray(triangles, dtype=np.int64)
+    m = len(triangles)
+    corner_tri = np.repeat(np.arange(m), 3)
+    corner_vertex = triangles.ravel()
+    order = np.argsort(corner_vertex, kind='stable')
+    vertex_start = np.searchsorted(corner_vertex[order], np.arange(triangles.max() + 2))
+
+    # every corner pulls in all the triangles on its vertex, then duplicates are dropped
+    counts = vertex_start[corner_vertex + 1] - vertex_start[corner_vertex]
+    owner, pos = expand_ranges(vertex_start[corner_vertex], counts)
+    pairs = np.unique(corner_tri[owner] * m + corner_tri[order[pos]])
+    tri, ring = pairs // m, pairs % m
+    keep = tri != ring
+    tri, ring = tri[keep], ring[keep]
+    return ring, np.searchsorted(tri, np.arange(m + 1))
+
+class BVHTriangles(KDTreeTriangles):
+    # bounding volume hierarchy over the same flat node arrays as KDTreeTriangles, so
+    # every query, save/load and the rest of the tree API work unchanged. only the
+    # build differs: instead of median splits with round robin axes, each node is
+    # split where the binned surface area heuristic (SAH) predicts the cheapest
+    # search, which adapts to skewed or elongated meshes where a median split
+    # puts most of the empty space in the wrong child
+    BUILD_OPTIONS = ("n_bins",)
+    n_bins = 16 # for index files saved without it
+
+    def __init__(self, vertices, triangles, leaf_size=16, n_bins=16):
+        self.n_bins = n_bins # candidate split planes per axis are the bin boundaries
+        super().__init__(vertices, triangles, leaf_size)
+
+    def _max_nodes(self, n_triangles):
+        # SAH splits can cut off single triangles, so only the 2n - 1 bound holds
+        return max(1, 2 * n_triangles - 1)
+
+    def build_kdtree(self):
+        # same explicit stack build as KDTreeTriangles with an SAH split per node
+        n = len(self.tri_order)
+        if n == 0:
+            return -1
+        self.n_nodes = 1
+        stack = [(0, 0, n)]
+
+        while stack:
+            node, lo, hi = stack.pop()
+            self.start[node] = lo
+            self.count[node] = hi - lo
+
+            # make the leaf, its triangles get tested together at query time
+            if hi - lo <= self.leaf_size:
+                continue
+
+            tri_indices = self.tri_order[lo:hi]
+            if hi - lo > 4 * self.leaf_size:
+                axis, plane, go_left = self._sah_split(tri_indices)
+            else:
+                # a few leaves away from the bottom the binning costs more than it saves,
+                # split at the median of the widest centroid axis instead
+                axis, plane, go_left = self._median_split(tri_indices)
+            self.axis[node] = axis
+            self.split[node] = plane
+            self.tri_order[lo:hi] = np.concatenate([tri_indices[go_left], tri_indices[~go_left]])
+            mid = lo + np.count_nonzero(go_left)
+
+            left, right = self.n_nodes, self.n_nodes + 1
+            self.n_nodes += 2
+            self.left[node] = left
+            self.right[node] = right
+            # push the right half first so the left half gets built first
+            stack.append((right, mid, hi))
+            stack.append((left, lo, mid))
+
+        self.root = 0
+        self._fit_bboxes()
+        return self.root
+
+    def _median_split(self, tri_indices):
+        centroids = self.centroids[tri_indices]
+        axis = np.argmax(np.ptp(centroids, axis=0))
+        mid = len(tri_indices) // 2
+        go_left = np.zeros(len(tri_indices), dtype=bool)
+        go_left[np.argpartition(centroids[:, axis], mid)[:mid]] = True
+        return axis, np.max(centroids[go_left, axis]), go_left
+
+    def _sah_split(self, tri_indices):
+        # returns the split axis, the split plane and a mask of the triangles that go left
+        centroids = self.centroids[tri_indices]
+        c_min = centroids.min(axis=0)
+        extent = centroids.max(axis=0) - c_min
+        n, n_bins = len(tri_indices), self.n_bins
+        if not np.any(extent > 0):
+            # all centroids coincide, any split is as good as another so halve the list
+            return 0, c_min[0], np.arange(n) < n // 2
+
+        # drop every centroid into one of n_bins equal slabs along each axis, all three
+        # axes at once. a flat axis puts everything in its first bin, so none of its
+        # splits leave a triangle on the right and they all get an infinite cost
+        scale = np.divide(n_bins, extent, out=np.zeros(3), where=extent > 0)
+        bins = np.minimum(((centroids - c_min) * scale).astype(np.int64), n_bins - 1)
+        keys = (bins + np.arange(3) * n_bins).ravel() # bin id per (triangle, axis)
+        counts = np.bincount(keys, minlength=3 * n_bins).reshape(3, n_bins)
+
+        # group the (triangle, axis) pairs by bin, then reduce each run of the same bin
+        order = np.argsort(keys, kind='stable')
+        runs = np.flatnonzero(np.diff(keys[order], prepend=-1))
+        present = keys[order[runs]]
+        tris = order // 3
+        bin_min = np.full((3 * n_bins, 3), np.inf)
+        bin_max = np.full((3 * n_bins, 3), -np.inf)
+        bin_min[present] = np.minimum.reduceat(self.tri_bbox_min[tri_indices[tris]], runs)
+        bin_max[present] = np.maximum.reduceat(self.tri_bbox_max[tri_indices[tris]], runs)
+        bin_min = bin_min.reshape(3, n_bins, 3)
+        bin_max = bin_max.reshape(3, n_bins, 3)
+
+        # boxes and counts of everything left of / right of each bin boundary
+        left_area = bbox_surface_area(np.minimum.accumulate(bin_min, axis=1),
+                                      np.maximum.accumulate(bin_max, axis=1))[:, :-1]
+        right_area = bbox_surface_area(np.minimum.accumulate(bin_min[:, ::-1], axis=1)[:, ::-1],
+                                       np.maximum.accumulate(bin_max[:, ::-1], axis=1)[:, ::-1])[:, 1:]
+        n_left = np.cumsum(counts, axis=1)[:, :-1]
+        n_right = n - n_left
+
+        # expected cost of a split ~ area weighted number of triangles on each side
+        with np.errstate(invalid='ignore'):
+            cost = np.where((n_left > 0) & (n_right > 0), left_area * n_left + right_area * n_right, np.inf)
+        axis, split_bin = np.unravel_index(np.argmin(cost), cost.shape)
+        plane = c_min[axis] + (split_bin + 1) * extent[axis] / n_bins
+        return axis, plane, bins[:, axis] <= split_bin
+
+class GridTriangles:
+    # uniform voxel grid of triangle buckets, an alternative to the trees for dense and
+    # fairly uniform query clouds. every triangle is listed in each cell its bounding
+    # box overlaps, and a query searches cubic shells of cells around its own cell,
+    # growing the shell until nothing outside of it can beat the best triangle found
+    def __init__(self, vertices, triangles, cell_size=None):
+        self.vertices = vertices # [N_vertices,3] (x,y,z) coordinates of each vertex in the triangle mesh
+        self.triangles = triangles # [N_triangles,3] indices of each vertex grouped by triangle
+        tri_verts = vertices[triangles]
+        self.tri_bbox_min = np.min(tri_verts, axis=1)
+        self.tri_bbox_max = np.max(tri_verts, axis=1)
+        self.tri_geom = icp.triangle_geometry(tri_verts)
+
+        self.origin = self.tri_bbox_min.min(axis=0)
+        extent = self.tri_bbox_max.max(axis=0) - self.origin
+        if cell_size is None:
+            # cells about as wide as an average triangle keep the buckets small while
+            # each triangle only lands in a handful of cells
+            cell_size = np.mean(np.max(self.tri_bbox_max - self.tri_bbox_min, axis=1))
+        # but never more than 64 cells per triangle, a few slivers or a tiny cell_size
+        # would otherwise blow up the number of mostly empty cells
+        min_cell_size = (np.prod(np.maximum(extent, 1e-9)) / (64 * max(1, len(triangles)))) ** (1 / 3)
+        self.cell_size = max(cell_size, min_cell_size)
+        self.dims = np.maximum(1, np.ceil(extent / self.cell_size).astype(np.int64))
+        self.n_cells = int(np.prod(self.dims))
+
+        # list every triangle in all cells its bounding box overlaps, stored CSR style:
+        # the triangles of cell i are cell_tris[cell_start[i]:cell_start[i + 1]]
+        owner, cells = cells_in_boxes(self._cell_of(self.tri_bbox_min, clip=True),
+                                      self._cell_of(self.tri_bbox_max, clip=True))
+        ids = self._cell_ids(cells)
+        order = np.argsort(ids, kind='stable')
+        self.cell_tris = owner[order]
+        self.cell_start = np.searchsorted(ids[order], np.arange(self.n_cells + 1))
+
+    def _cell_of(self, points, clip=False):
+        cells = np.floor((points - self.origin) / self.cell_size).astype(np.int64)
+        return np.clip(cells, 0, self.dims - 1) if clip else cells
+
+    def _cell_ids(self, cells):
+        # linear index of (ix, iy, iz) cells, x varies fastest
+        return cells[..., 0] + self.dims[0] * (cells[..., 1] + self.dims[1] * cells[..., 2])
+
+    def _shell_cells(self, cells, k):
+        # the grid cells at Chebyshev distance exactly k from each of cells, returns the
+        # cell each one belongs to and the (M,3) cells themselves. the shell is split
+        # into its six faces and each face clipped to the grid, so a cell far outside
+        # of the grid only lists the part of its shell that overlaps it
+        lo = np.repeat((cells - k)[:, None, :], 6, axis=1)
+        hi = np.repeat((cells + k)[:, None, :], 6, axis=1)
+        for axis in range(3):
+            hi[:, 2 * axis, axis] = lo[:, 2 * axis, axis]
+            lo[:, 2 * axis + 1, axis] = hi[:, 2 * axis + 1, axis]
+            # the faces of the later axes leave out the cells this axis' faces hold
+            lo[:, 2 * axis + 2:, axis] += 1
+            hi[:, 2 * axis + 2:, axis] -= 1
+        if k == 0:
+            lo, hi = lo[:, :1], hi[:, :1] # both x faces are the cell itself
+        lo, hi = np.maximum(lo, 0), np.minimum(hi, self.dims - 1)
+        q, face = np.nonzero(np.all(lo <= hi, axis=2))
+        owner, shell = cells_in_boxes(lo[q, face], hi[q, face])
+        return q[owner], shell
+
+    def triangle_geometry(self, tris):
+        # precomputed kernel terms for the given triangle indices
+        return self.tri_geom[tris]
+
+    def closest_point(self, p, hint=-1, stats=None):
+        closest, dists, tris = self.closest_points(np.asarray(p, dtype=float)[None], np.array([hint]), stats=stats)
+        return closest[0], dists[0], tris[0]
+
+    def closest_points(self, points, hints=None, batch_size=2048, stats=None):
+        # same contract as KDTreeTriangles.closest_points, stats counts the queries
+        # and triangle tests
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        n = len(points)
+        hints = np.full(n, -1, dtype=np.int64) if hints is None else np.asarray(hints, dtype=np.int64)
+        closest = np.zeros((n, 3))
+        best_tri = np.full(n, -1, dtype=np.int64)
+        triangle_tests = 0
+        for lo in range(0, n, batch_size):
+            hi = min(n, lo + batch_size)
+            closest[lo:hi], best_tri[lo:hi], tests = self._closest_points_batch(points[lo:hi], hints[lo:hi])
+            triangle_tests += tests
+        if stats is not None:
+            record_stats(stats, {"queries": n, "triangle_tests": triangle_tests})
+        dists = np.linalg.norm(closest - points, axis=1)
+        return closest, dists, best_tri
+
+    def _closest_points_batch(self, points, hints):
+        n = len(points)
+        best_d2 = np.full(n, np.inf)
+        closest = np.zeros((n, 3))
+        best_tri = np.full(n, -1, dtype=np.int64)
+        hinted = np.flatnonzero(hints >= 0)
+        triangle_tests = test_triangles(points, hinted, hints[hinted], self.tri_geom, best_d2, closest, best_tri)
+        cell = self._cell_of(points)
+
+        # queries outside the grid start at the first shell that reaches it, and once
+        # the shell is past the far side of the grid every triangle has been seen
+        shell = np.max(np.maximum(0, np.maximum(-cell, cell - (self.dims - 1))), axis=1)
+        last = np.max(np.maximum(cell, self.dims - 1 - cell), axis=1)
+        active = np.arange(n)
+
+        while len(active):
+            for k in np.unique(shell[active]):
+                queries = active[shell[active] == k]
+                triangle_tests += self._search_shell(points, queries, cell[queries], k, best_d2, closest, best_tri)
+
+            # every triangle outside the searched block of cells is at least as far as
+            # the nearest face of the block, stop once the best triangle is closer than that
+            k = shell[active][:, None]
+            block_lo = self.origin + (cell[active] - k) * self.cell_size
+            block_hi = self.origin + (cell[active] + k + 1) * self.cell_size
+            p = points[active]
+            bound = np.min(np.minimum(p - block_lo, block_hi - p), axis=1)
+            done = (best_d2[active] <= bound * bound) | (shell[active] >= last[active])
+            active = active[~done]
+            shell[active] += 1
+
+        return closest, best_tri, triangle_tests
+
+    def _search_shell(self, points, queries, cells, k, best_d2, closest, best_tri):
+        # tests the triangles of every cell in shell k around each query's cell,
+        # returns the number of triangles tested
+        q, neighbors = self._shell_cells(cells, k)
+
+        # skip cells that are already farther away than the query's best triangle
+        p = points[queries[q]]
+        cell_lo = self.origin + neighbors * self.cell_size
+        gap = np.maximum(0.0, np.maximum(cell_lo - p, p - (cell_lo + self.cell_size)))
+        near = np.sum(gap * gap, axis=1) < best_d2[queries[q]]
+        q, ids = q[near], self._cell_ids(neighbors[near])
+        owner, pos = expand_ranges(self.cell_start[ids], self.cell_start[ids + 1] - self.cell_start[ids])
+        return test_triangles(points, queries[q[owner]], self.cell_tris[pos], self.tri_geom, best_d2, closest, best_tri)
+
+
+class DistanceFieldTriangles:
+    # precomputed unsigned distance field around the mesh for constant time queries.
+    # a sparse voxel grid covers the band of space within `band` of the surface and
+    # every voxel stores the few triangles that can be nearest to some point inside
+    # of it, so a query is a voxel lookup plus an exact test of those candidates.
+    # queries outside the band fall back to the wrapped tree
+    def __init__(self, tree, voxel_size=None, band=None, batch_size=2048):
+        self.tree = tree
+        self.vertices = tree.vertices
+        self.triangles = tree.triangles
+        self.tri_geom = tree.tri_geom
+        if voxel_size is None:
+            voxel_size = 0.5 * np.mean(np.max(tree.tri_bbox_max - tree.tri_bbox_min, axis=1))
+        if band is None:
+            band = 2 * voxel_size
+        self.voxel_size = voxel_size
+        self.band = band
+        self.origin = tree.tri_bbox_min.min(axis=0) - band
+        self.dims = np.maximum(1, np.ceil((tree.tri_bbox_max.max(axis=0) + band - self.origin) / voxel_size).astype(np.int64))
+        half_diag = 0.5 * np.sqrt(3.0) * voxel_size
+
+        # voxels that might be in the band: the ones touching a triangle's bounding box
+        # grown by the band. done a batch of triangles at a time to bound the memory
+        pad = band + half_diag
+        lo = self._voxel_of(tree.tri_bbox_min - pad, clip=True)
+        hi = self._voxel_of(tree.tri_bbox_max + pad, clip=True)
+        keys = [np.zeros(0, dtype=np.int64)]
+        for start in range(0, len(lo), batch_size):
+            _, voxels = cells_in_boxes(lo[start:start + batch_size], hi[start:start + batch_size])
+            keys.append(np.unique(self._voxel_ids(voxels)))
+        keys = np.unique(np.concatenate(keys))
+
+        # keep the voxels that really reach into the band
+        centers = self._voxel_centers(keys)
+        _, center_dist, _ = tree.closest_points(centers, batch_size=batch_size)
+        keep = center_dist <= band + half_diag
+        self.keys, centers, center_dist = keys[keep], centers[keep], center_dist[keep]
+
+        # for any x in a voxel with center c, the nearest triangle T* of x satisfies
+        # |c - T*| <= |x - T*| + r <= |x - T_c| + r <= |c - T_c| + 2r (r = half
+        # diagonal), so the triangles within |c - T_c| + 2r of c are all candidates
+        counts, cand_tris = [], []
+        for start in range(0, len(self.keys), batch_size):
+            stop = start + batch_size
+            q, _, _, t = tree.within_radius_batch(centers[start:stop], center_dist[start:stop] + 2 * half_diag)
+            counts.append(np.bincount(q, minlength=len(centers[start:stop])))
+            cand_tris.append(t)
+        counts = np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)
+        # the candidates of voxel keys[i] are cand_tris[cand_start[i]:cand_start[i + 1]]
+        self.cand_tris = np.concatenate(cand_tris) if cand_tris else np.zeros(0, dtype=np.int64)
+        self.cand_start = np.concatenate([[0], np.cumsum(counts)])
+
+    def _voxel_of(self, points, clip=False):
+        voxels = np.floor((points - self.origin) / self.voxel_size).astype(np.int64)
+        return np.clip(voxels, 0, self.dims - 1) if clip else voxels
+
+    def _voxel_ids(self, voxels):
+        # linear index of (ix, iy, iz) voxels, x varies fastest
+        return voxels[..., 0] + self.dims[0] * (voxels[..., 1] + self.dims[1] * voxels[..., 2])
+
+    def _voxel_centers(self, ids):
+        voxels = np.stack([ids % self.dims[0], (ids // self.dims[0]) % self.dims[1],
+                           ids // (self.dims[0] * self.dims[1])], axis=1)
+        return self.origin + (voxels + 0.5) * self.voxel_size
+
+    def closest_point(self, p, hint=-1, stats=None):
+        closest, dists, tris = self.closest_points(np.asarray(p, dtype=float)[None], np.array([hint]), stats=stats)
+        return closest[0], dists[0], tris[0]
+
+    def closest_points(self, points, hints=None, batch_size=2048, stats=None):
+        # same contract as KDTreeTriangles.closest_points, the hints are only
+        # used for the queries that fall back to the tree. stats counts the voxel
+        # lookups, their triangle tests and the fallbacks (whose tree search is
+        # counted into it as well)
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        n = len(points)
+        best_d2 = np.full(n, np.inf)
+        closest = np.zeros((n, 3))
+        best_tri = np.full(n, -1, dtype=np.int64)
+
+        # look up every query's voxel among the stored ones
+        voxels = self._voxel_of(points)
+        inside = np.all((voxels >= 0) & (voxels < self.dims), axis=1)
+        ids = np.where(inside, self._voxel_ids(voxels), -1)
+        slot = np.minimum(np.searchsorted(self.keys, ids), max(0, len(self.keys) - 1))
+        stored = inside & (self.keys[slot] == ids) if len(self.keys) else np.zeros(n, dtype=bool)
+        hits = np.flatnonzero(stored)
+
+        # exact refinement against the voxel's candidates
+        starts = self.cand_start[slot[hits]]
+        owner, pos = expand_ranges(starts, self.cand_start[slot[hits] + 1] - starts)
+        triangle_tests = test_triangles(points, hits[owner], self.cand_tris[pos], self.tri_geom, best_d2, closest, best_tri)
+
+        # everything outside the band goes through the tree
+        misses = np.flatnonzero(~stored)
+        if stats is not None:
+            record_stats(stats, {"queries": len(hits), "triangle_tests": triangle_tests, "fallbacks": len(misses)})
+        if len(misses):
+            closest[misses], _, best_tri[misses] = self.tree.closest_points(
+                points[misses], None if hints is None else np.asarray(hints)[misses], batch_size=batch_size, stats=stats)
+        dists = np.linalg.norm(closest - points, axis=1)
+        return closest, dists, best_tri
+
+
+class MeshWalkTriangles:
+    # closest points for tracked queries (pointer tips, ICP samples) by walking the
+    # mesh instead of searching it. each query starts at a given triangle, usually
+    # the one found for it in the previous frame, and moves to whichever edge
+    # neighbor is closer until none is. a walk can stall where the closest point is
+    # a vertex (the edge neighbors tie), so a stalled query also tests every
+    # triangle around the current one's vertices and keeps walking if one is closer.
+    # the walk ends in a local optimum, which is the answer for the small motions
+    # between frames. queries without a start triangle or whose walk does not
+    # settle within max_steps fall back to the wrapped tree
+    def __init__(self, tree, neighbors=None, max_steps=16):
+        self.tree = tree
+        self.vertices = tree.vertices
+        self.triangles = tree.triangles
+        self.tri_geom = tree.tri_geom
+        self.adjacency = triangle_adjacency(tree.triangles, neighbors)
+        self.ring_tris, self.ring_start = vertex_rings(tree.triangles)
+        self.max_steps = max_steps
+
+    def closest_point(self, p, hint=-1, stats=None):
+        closest, dists, tris = self.closest_points(np.asarray(p, dtype=float)[None], np.array([hint]), stats=stats)
+        return closest[0], dists[0], tris[0]
+
+    def closest_points(self, points, hints=None, batch_size=2048, stats=None):
+        # same contract as KDTreeTriangles.closest_points, hints are the start triangles.
+        # stats collects the triangle tests of the walk and how many queries fell back,
+        # the tree search of those is counted into it as well
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        n = len(points)
+        hints = np.full(n, -1, dtype=np.int64) if hints is None else np.asarray(hints, dtype=np.int64)
+        tris = hints.copy()
+        closest = np.zeros((n, 3))
+        walking = np.flatnonzero(tris >= 0)
+        closest[walking] = icp.closest_points_from_geometry(points[walking], self.tri_geom[tris[walking]])
+        best_d2 = np.sum((closest - points) ** 2, axis=1)
+        triangle_tests = len(walking)
+
+        for _ in range(self.max_steps):
+            if len(walking) == 0:
+                break
+            # one step to the nearest edge neighbor
+            nb = self.adjacency[tris[walking]]
+            q, k = np.nonzero(nb >= 0)
+            moved = self._step(points, walking, q, nb[q, k], tris, closest, best_d2)
+            triangle_tests += len(q)
+
+            # stalled queries look at the whole vertex ring before giving up
+            stalled = np.setdiff1d(walking, moved, assume_unique=True)
+            starts = self.ring_start[tris[stalled]]
+            q, pos = expand_ranges(starts, self.ring_start[tris[stalled] + 1] - starts)
+            moved_ring = self._step(points, stalled, q, self.ring_tris[pos], tris, closest, best_d2)
+            triangle_tests += len(q)
+            walking = np.union1d(moved, moved_ring)
+
+        # no start triangle or no local optimum within max_steps: use the tree
+        fallback = np.union1d(np.flatnonzero(hints < 0), walking)
+        if stats is not None:
+            record_stats(stats, {"queries": n - len(fallback), "triangle_tests": triangle_tests,
+                                 "fallbacks": len(fallback)})
+        if len(fallback):
+            closest[fallback], _, tris[fallback] = self.tree.closest_points(
+                points[fallback], tris[fallback], batch_size=batch_size, stats=stats)
+        dists = np.linalg.norm(closest - points, axis=1)
+        return closest, dists, tris
+
+    def _step(self, points, queries, q, t, tris, closest, best_d2):
+        # tests triangle t[i] against points[queries[q[i]]], moves every query to its
+        # nearest candidate where that beats the current triangle, returns the movers
+        if len(q) == 0:
+            return np.zeros(0, dtype=np.int64)
+        c = icp.closest_points_from_geometry(points[queries[q]], self.tri_geom[t])
+        d2 = np.sum((c - points[queries[q]]) ** 2, axis=1)
+        order = np.lexsort((d2, q))
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = q[order[1:]] != q[order[:-1]]
+        sel = order[first]
+        sel = sel[d2[sel] < best_d2[queries[q[sel]]]]
+        moved = queries[q[sel]]
+        tris[moved], closest[moved], best_d2[moved] = t[sel], c[sel], d2[sel]
+        return moved
+
+
+def decimate_mesh(vertices, triangles, cell_size):
+    # coarser version of a mesh by vertex clustering: the vertices in each cubic cell
+    # of a cell_size grid are merged into their mean, triangles that collapse to an
+    # edge or a point are dropped and so are repeats of the same triangle. returns the
+    # new (vertices, triangles), only the vertices some triangle still uses are kept
+    vertices = np.asarray(vertices, dtype=float)
+    cells = np.floor((vertices - vertices.min(axis=0)) / cell_size).astype(np.int64)
+    _, cluster, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    cluster = cluster.ravel()
+    merged = np.stack([np.bincount(cluster, weights=vertices[:, k]) for k in range(3)], axis=1) / counts[:, None]
+
+    tris = cluster[np.asarray(triangles, dtype=np.int64)]
+    tris = tris[(tris[:, 0] != tris[:, 1]) & (tris[:, 1] != tris[:, 2]) & (tris[:, 2] != tris[:, 0])]
+    _, first = np.unique(np.sort(tris, axis=1), axis=0, return_index=True)
+    tris = tris[np.sort(first)]
+
+    used, tris = np.unique(tris, return_inverse=True)
+    return merged[used], tris.reshape(-1, 3)
+
+
+class MeshPyramid:
+    # coarse to fine versions of a mesh for multi-resolution ICP, each with its own
+    # index. levels[0] is the given index of the full mesh, every further level has
+    # about 1/reduction of the vertices of the one before it (decimate_mesh with
+    # cells whose area is reduction times larger) and an index of the same class.
+    # stops early once decimating doesn't shrink the mesh anymore
+    def __init__(self, tree, n_levels=3, reduction=4.0):
+        self.levels = [tree]
+        tri_verts = tree.vertices[tree.triangles]
+        area = 0.5 * np.sum(np.linalg.norm(np.cross(tri_verts[:, 1] - tri_verts[:, 0],
+                                                    tri_verts[:, 2] - tri_verts[:, 0]), axis=1))
+        # one vertex per cell_size^2 of surface gives about as many vertices as the mesh has
+        base = np.sqrt(area / max(1, len(tree.vertices)))
+        for level in range(1, n_levels):
+            vertices, triangles = decimate_mesh(tree.vertices, tree.triangles, base * reduction ** (level / 2))
+            if len(triangles) == 0 or len(triangles) >= len(self.levels[-1].triangles):
+                break
+            self.levels.append(type(tree)(vertices, triangles, leaf_size=tree.leaf_size))
+
+    def __len__(self):
+        return len(self.levels)
+
+
+def mesh_file_hash(path):
+    # content hash of a mesh file, used to key saved indexes
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+def load_or_build_index(mesh_path, vertices, triangles, cache_dir, index_cls=KDTreeTriangles, **kwargs):
+    # loads the index for mesh_path from cache_dir if it was saved before for the same
+    # file contents and settings, otherwise builds it and saves it for the next run
+    mesh_hash = mesh_file_hash(mesh_path)
+    parts = [os.path.splitext(os.path.basename(mesh_path))[0], index_cls.__name__]
+    parts += [f"{key}{value}" for key, value in sorted(kwargs.items())]
+    name = "-".join(parts + [mesh_hash[:16]]) + ".npz"
+    path = os.path.join(cache_dir, name)
+
+    if os.path.exists(path):
+        try:
+            return index_cls.load(path, mesh_hash)
+        except (ValueError, KeyError, EOFError, OSError, zipfile.BadZipFile):
+            pass # stale file from another version or a broken one, rebuild it below
+
+    tree = index_cls(vertices, triangles, **kwargs)
+    os.makedirs(cache_dir, exist_ok=True)
+    # written next to the final name and moved over it, a run killed while saving
+    # leaves a stray temporary file instead of a broken index
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            tree.save(f, mesh_hash)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return tree
+
+
+def share_arrays(arrays):
+    # copies a dict of arrays into one new shared memory block. returns the block
+    # (the caller owns it: close and unlink when done), a small picklable layout that
+    # attach_arrays turns back into the arrays in other processes, and the dict of
+    # shared arrays for this one
+    layout, offset = [], 0
+    for key, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        layout.append((key, array.dtype.str, array.shape, offset))
+        offset += -(-array.nbytes // 64) * 64 # keep every array 64 byte aligned
+    block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    views = _array_views(block, layout)
+    for key, array in arrays.items():
+        views[key][...] = array
+    return block, (block.name, layout), views
+
+def _array_views(block, layout):
+    return {key: np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=start)
+            for key, dtype, shape, start in layout}
+
+def attach_arrays(shared):
+    # zero-copy views of the arrays behind a share_arrays layout, returns the block
+    # (keep it referenced while the views are used) and the dict of arrays
+    name, layout = shared
+    block = shared_memory.SharedMemory(name=name)
+    return block, _array_views(block, layout)
+
+# the tree each pool worker attached to when it started
+_worker_tree = None
+
+def _attach_worker(tree_cls, shared, leaf_size, root):
+    global _worker_tree
+    block, arrays = attach_arrays(shared)
+    _worker_tree = tree_cls.from_arrays(arrays, leaf_size, root)
+    _worker_tree._block = block
+
+def _answer_slice(task):
+    # closest points for queries[lo:hi], written straight into the shared outputs
+    shared, lo, hi, batch_size = task
+    block, arrays = attach_arrays(shared)
+    closest, dists, tris = _worker_tree.closest_points(arrays["points"][lo:hi], batch_size=batch_size)
+    arrays["closest"][lo:hi], arrays["dists"][lo:hi], arrays["tris"][lo:hi] = closest, dists, tris
+    del arrays
+    block.close()
+
+class ParallelClosestPoints:
+    # answers large query batches on several processes. the tree arrays (vertices,
+    # triangles, nodes, boxes, packed triangle data) go into shared memory once and
+    # every worker of the pool attaches to them zero-copy when it starts, instead of
+    # rebuilding the tree or unpickling a copy of it. each call shares the query
+    # points and output arrays the same way and hands the workers slices of them
+    def __init__(self, tree, n_workers=None):
+        self.block, self.shared, _ = share_arrays(tree.to_arrays())
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.pool = multiprocessing.Pool(self.n_workers, initializer=_attach_worker,
+                                         initargs=(type(tree), self.shared, tree.leaf_size, tree.root))
+
+    def closest_points(self, points, batch_size=2048, chunk_size=None):
+        # same returns as KDTreeTriangles.closest_points. chunk_size is the number of
+        # queries per task, by default the batch is split evenly over the workers
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        n = len(points)
+        chunk_size = chunk_size or max(1, -(-n // self.n_workers))
+        block, shared, arrays = share_arrays({"points": points, "closest": np.zeros((n, 3)),
+                                              "dists": np.zeros(n), "tris": np.zeros(n, dtype=np.int64)})
+        try:
+            tasks = [(shared, lo, min(n, lo + chunk_size), batch_size) for lo in range(0, n, chunk_size)]
+            self.pool.map(_answer_slice, tasks)
+            return arrays["closest"].copy(), arrays["dists"].copy(), arrays["tris"].copy()
+        finally:
+            del arrays # views must go before the block can close
+            block.close()
+            block.unlink()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.block.close()
+        self.block.unlink()
+
+    def __enter__(self):
+        return self
 
-        dist, closest_point, tri_idx = best
-        return closest_point, dist, tri_idx[0]
+    def __exit__(self, *exc):
+        self.close()
 
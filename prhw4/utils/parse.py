@@ -25,9 +25,23 @@ def parse_mesh(path):
   vertices_inds = []
   for line in data[2+num_vertices:2+num_vertices+num_triangles]:
     coords = [int(x) for x in line.split()]
-    vertices_inds.append(coords[0:3])
+    vertices_inds.append(coords) # i1 i2 i3 followed by the neighbor triangles n1 n2 n3
   return vertices_ct, vertices_inds
 
+def parse_modes(path):
+  # atlas modes file: mode 0 is the mean shape, modes 1..Nmodes are vertex displacements
+  with open(path, 'r') as f:
+    data = f.readlines()
+  header = dict(field.split('=') for field in data[0].split()[1:])
+  num_vertices = int(header['Nvertices'])
+  num_modes = int(header['Nmodes'])
+
+  modes = []
+  for m in range(num_modes + 1):
+    first = 2 + m * (num_vertices + 1) # each block is a "Mode m" line then one line per vertex
+    modes.append([[float(x) for x in line.split(',')] for line in data[first:first + num_vertices]])
+  return np.array(modes) # (Nmodes + 1, Nvertices, 3)
+
 def parse_readings(path, num_trackers_bA, num_trackers_bB):
   with open(path, 'r') as f:
     data = f.readlines()
@@ -49,6 +49,127 @@ def point_cloud_registration(a, b):
 
     return F
 
+# Weighted Kabsch: F minimizing sum(w_i |F a_i - b_i|^2), weights >= 0 and at least
+# 3 of them positive. Weighted centroids and cross-covariance, the rest is as above.
+# Zero weights drop their points, ICP uses this to down weight outliers
+def weighted_point_cloud_registration(a, b, weights):
+
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    w = np.asarray(weights, dtype=float)
+    assert a.shape == b.shape and a.ndim == 2 and a.shape[1] == 3 and w.shape == (a.shape[0],)
+    assert np.all(w >= 0) and np.count_nonzero(w) >= 3
+
+    w = w / w.sum()
+    ca = w @ a
+    cb = w @ b
+    A = a - ca
+    B = b - cb
+    H = A.T @ (w[:, None] * B)
+
+    U, S, Vt = np.linalg.svd(H)
+    V = Vt.T
+    D = np.eye(3)
+    if np.linalg.det(V @ U.T) < 0:
+       D[2, 2] = -1.0
+    if np.linalg.det(V @ U.T) == 0:
+        raise ValueError("Singular matrix encountered in SVD for point cloud registration.")
+    R = V @ D @ U.T
+
+    F = np.eye(4)
+    F[:3, :3] = R
+    F[:3, 3] = cb - R @ ca
+    return F
+
+# Point-to-plane registration, one linearized step (Chen and Medioni)
+# Finds F minimizing sum(((F a_i - b_i) . n_i)^2): distances of the moved points to
+# the planes through b_i with normals n_i, so points can slide along the surface
+# instead of being pulled onto b_i. Assumes a small rotation, R ~ I + [w]x, which
+# makes the residuals linear in the 6 unknowns (w, t). ICP calls it every iteration
+# with a = the current samples, so the step only has to be small near convergence.
+# weights (>= 0, one per point) scale the squared residuals, None weighs all equally
+def point_to_plane_registration(a, b, normals, weights=None):
+
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    normals = np.asarray(normals, dtype=float)
+    assert a.shape == b.shape == normals.shape and a.ndim == 2 and a.shape[1] == 3
+    assert a.shape[0] >= 6
+
+    # Rotate about the centroid, keeps the columns of the system on the same scale
+    ca = a.mean(axis=0)
+    A = a - ca
+
+    # Residual ((R A_i + ca + t) - b_i) . n_i ~ (a_i - b_i) . n_i + w . (A_i x n_i) + t . n_i
+    J = np.hstack([np.cross(A, normals), normals])
+    r = np.sum((a - b) * normals, axis=1)
+    if weights is not None:
+        root_w = np.sqrt(np.asarray(weights, dtype=float))
+        J, r = J * root_w[:, None], r * root_w
+    # lstsq instead of the normal equations: a flat patch leaves some motions
+    # unconstrained and those get the minimum norm (zero) step
+    x, _, _, _ = np.linalg.lstsq(J, -r, rcond=None)
+    w, t = x[:3], x[3:]
+
+    # Exact rotation about w so F stays rigid
+    R = rotation_exp(w)
+
+    F = np.eye(4)
+    F[:3, :3] = R
+    F[:3, 3] = ca + t - R @ ca
+    return F
+
+# Rotation vector <-> rotation matrix (Rodrigues), and rigid transforms <-> twists
+# xi = (w, v) in se(3), the Lie algebra of the rigid motions. Iterates of F in
+# twist coordinates can be added and extrapolated like plain vectors
+def skew(w):
+    return np.array([[0.0, -w[2], w[1]],
+                     [w[2], 0.0, -w[0]],
+                     [-w[1], w[0], 0.0]])
+
+def rotation_exp(w):
+    theta = np.linalg.norm(w)
+    K = skew(w)
+    if theta > 0:
+        return np.eye(3) + np.sin(theta) / theta * K + (1 - np.cos(theta)) / theta**2 * (K @ K)
+    return np.eye(3)
+
+def rotation_log(R):
+    # Inverse of rotation_exp for rotations by less than pi
+    cos_theta = np.clip((np.trace(R) - 1) / 2, -1.0, 1.0)
+    theta = np.arccos(cos_theta)
+    w = np.array([R[2, 1] - R[1, 2], R[0, 2] - R[2, 0], R[1, 0] - R[0, 1]]) / 2
+    if theta < 1e-8:
+        return w # sin(theta) ~ theta
+    return theta / np.sin(theta) * w
+
+def se3_exp(xi):
+    # Twist (w, v) -> HTM, the translation is V(w) v
+    w, v = np.asarray(xi[:3], dtype=float), np.asarray(xi[3:], dtype=float)
+    theta = np.linalg.norm(w)
+    K = skew(w)
+    if theta > 1e-2:
+        a, b = (1 - np.cos(theta)) / theta**2, (theta - np.sin(theta)) / theta**3
+    else:
+        # Taylor series, the closed forms cancel badly for small angles
+        a, b = 1 / 2 - theta**2 / 24, 1 / 6 - theta**2 / 120
+    F = np.eye(4)
+    F[:3, :3] = rotation_exp(w)
+    F[:3, 3] = (np.eye(3) + a * K + b * (K @ K)) @ v
+    return F
+
+def se3_log(F):
+    # HTM -> twist (w, v), inverse of se3_exp
+    w = rotation_log(F[:3, :3])
+    theta = np.linalg.norm(w)
+    K = skew(w)
+    if theta > 1e-2:
+        c = (1 - theta * np.sin(theta) / (2 * (1 - np.cos(theta)))) / theta**2
+    else:
+        c = 1 / 12 + theta**2 / 720
+    V_inv = np.eye(3) - K / 2 + c * (K @ K)
+    return np.concatenate([w, V_inv @ F[:3, 3]])
+
 def random_pcr_test():
     # Generate random PC
     num_points = 100